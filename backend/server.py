@@ -1,19 +1,47 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+import pymongo
+from pymongo import monitoring
+from pymongo.read_preferences import SecondaryPreferred
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure, PyMongoError
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pydantic import BaseModel, EmailStr, Field, ValidationError
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
-from typing import Optional, List
+from datetime import datetime, timedelta, timezone
+from typing import Annotated, Any, Callable, Optional, List
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+import asyncio
+import codecs
+import csv
+import hashlib
+import io
+import logging
+import math
+import numpy as np
+import orjson
 import os
+import random
+import smtplib
+import sys
+import time
 import uuid
+import base64
+from bson import ObjectId, json_util
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="Car Rental SaaS API", version="1.0.0")
+logger = logging.getLogger("car_rental_saas")
+
+# orjson renders typed responses far faster than the stdlib json encoder
+app = FastAPI(title="Car Rental SaaS API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -24,130 +52,2620 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Instrumentation
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"]
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+REQUEST_COUNT = Counter(
+    "http_requests_total", "HTTP responses by status code", ["method", "route", "status"]
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ["collection", "command"]
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongo_command_failures_total", "Failed MongoDB commands", ["collection", "command"]
+)
+MONGO_SLOW_QUERY_MS = float(os.getenv("MONGO_SLOW_QUERY_MS", "100"))
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        # Label by route template, not raw path, to keep cardinality bounded
+        route = request.scope.get("route")
+        route_path = route.path if route else "unmatched"
+        REQUEST_LATENCY.labels(request.method, route_path).observe(time.perf_counter() - started)
+        REQUEST_COUNT.labels(request.method, route_path, str(status_code)).inc()
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command per collection and logs the ones above MONGO_SLOW_QUERY_MS."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        # Most commands name their collection as the value of the first key;
+        # getMore carries it separately
+        collection = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else "-"
+        )
+
+    def _finish(self, event) -> str:
+        return self._collections.pop((event.connection_id, event.request_id), "-")
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        seconds = event.duration_micros / 1_000_000
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(seconds)
+        if seconds * 1000 >= MONGO_SLOW_QUERY_MS:
+            logger.warning(
+                "Slow Mongo command %s on %s took %.1fms",
+                event.command_name, collection, seconds * 1000
+            )
+
+    def failed(self, event):
+        collection = self._finish(event)
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1_000_000)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
 # MongoDB connection
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/car_rental_saas")
-client = MongoClient(MONGO_URL)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+# Unset keeps pymongo's default of no socket timeout, so rollup rebuilds,
+# migrations and index builds are not cut off mid-operation
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0")) or None
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+# Deadline for all Mongo work done while serving one request; 0 disables it
+MONGO_REQUEST_TIMEOUT_MS = int(os.getenv("MONGO_REQUEST_TIMEOUT_MS", "10000"))
+# Request paths that legitimately run long and are left unbounded
+MONGO_UNBOUNDED_PATH_SUFFIXES = ("/export", "/events", "/cars/import", "/analytics/rebuild")
+
+# Shared by the control client and every tenant target client
+MONGO_CLIENT_OPTIONS = dict(
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+)
+
+# Motor runs each pymongo call on a thread pool and awaits the result, so the
+# event loop keeps serving other requests while one waits on Mongo I/O
+client = AsyncIOMotorClient(MONGO_URL, **MONGO_CLIENT_OPTIONS, event_listeners=[MongoCommandMetrics()])
 db = client.car_rental_saas
 
-# JWT settings
-JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
-JWT_EXPIRATION_HOURS = int(os.getenv("JWT_EXPIRATION_HOURS", "24"))
+@app.middleware("http")
+async def bound_request_queries(request: Request, call_next):
+    # pymongo.timeout() sets a per-operation deadline (maxTimeMS plus socket
+    # timeout) through a contextvar; Motor copies the context onto its executor
+    # threads, so every query awaited while serving this request inherits it.
+    # Startup, workers and CLI maintenance run outside any request and stay unbounded.
+    if not MONGO_REQUEST_TIMEOUT_MS or request.url.path.endswith(MONGO_UNBOUNDED_PATH_SUFFIXES):
+        return await call_next(request)
+    with pymongo.timeout(MONGO_REQUEST_TIMEOUT_MS / 1000):
+        return await call_next(request)
+
+# Read routing
+# Staleness-tolerant reads (lists, exports, analytics, public browsing) go to
+# secondaries when READ_FROM_SECONDARIES is on. Auth, conflict checks and all
+# writes stay on the primary through `db`. Mongo rejects a max staleness
+# below 90 seconds.
+READ_FROM_SECONDARIES = os.getenv("READ_FROM_SECONDARIES", "false").lower() == "true"
+READ_MAX_STALENESS_SECONDS = max(90, int(os.getenv("READ_MAX_STALENESS_SECONDS", "90")))
+# Staleness is estimated from heartbeats, so pin for a little longer than the bound
+READ_YOUR_WRITES_SECONDS = READ_MAX_STALENESS_SECONDS + 20
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+def secondary_of(database):
+    if not READ_FROM_SECONDARIES:
+        return database
+    return database.client.get_database(
+        database.name, read_preference=SecondaryPreferred(max_staleness=READ_MAX_STALENESS_SECONDS)
+    )
+
+secondary_db = secondary_of(db)
+
+def reads_pinned_to_primary(request: Request) -> bool:
+    """Whether the client wrote recently enough that secondaries may not have its write.
+
+    Such a client carries a cookie pinning its reads to the primary until
+    secondaries are guaranteed to have caught up, so it always sees its own
+    new cars and bookings.
+    """
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def read_db(request: Request):
+    """Control database for staleness-tolerant reads."""
+    return db if reads_pinned_to_primary(request) else secondary_db
+
+def pin_reads_to_primary(response: Response):
+    if READ_FROM_SECONDARIES:
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            str(int(time.time()) + READ_YOUR_WRITES_SECONDS),
+            max_age=READ_YOUR_WRITES_SECONDS,
+            httponly=True,
+            samesite="lax"
+        )
+
+# JWT settings
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_EXPIRATION_HOURS = int(os.getenv("JWT_EXPIRATION_HOURS", "24"))
+
+# Password hashing
+# Hashes made with a different cost are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event
+# loop. Work beyond the pool plus its queue is refused with 503 instead of
+# letting a login burst pile up unbounded.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "32"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_jobs_in_flight = 0
+security = HTTPBearer()
+
+# User roles
+class UserRole:
+    SUPER_ADMIN = "super_admin"
+    AGENCY_ADMIN = "agency_admin"
+    STAFF = "staff"
+    CLIENT = "client"
+
+# Pydantic models
+class UserCreate(BaseModel):
+    email: EmailStr
+    password: str
+    first_name: str
+    last_name: str
+    role: str = UserRole.CLIENT
+    agency_id: Optional[str] = None
+
+class UserLogin(BaseModel):
+    email: EmailStr
+    password: str
+
+class AgencyCreate(BaseModel):
+    name: str
+    email: EmailStr
+    phone: str
+    address: str
+    description: Optional[str] = None
+
+class CarCreate(BaseModel):
+    title: str
+    model: str
+    brand: str
+    year: int
+    plate_number: str
+    color: str
+    price_per_day: float
+    features: List[str] = []
+    agency_id: str
+
+class BookingCreate(BaseModel):
+    car_id: str
+    client_email: EmailStr
+    client_name: str
+    client_phone: str
+    pickup_date: datetime
+    return_date: datetime
+    pickup_location: str
+    return_location: str
+    message: Optional[str] = None
+
+class AgencyStatusUpdate(BaseModel):
+    status: str
+
+class SeasonRule(BaseModel):
+    name: str
+    # Inclusive MM-DD bounds; a start after the end wraps over the new year
+    start: str = Field(pattern=r"^\d{2}-\d{2}$")
+    end: str = Field(pattern=r"^\d{2}-\d{2}$")
+    multiplier: float = Field(gt=0)
+
+class DurationTier(BaseModel):
+    min_days: int = Field(ge=1)
+    discount: float = Field(ge=0, lt=1)
+
+class PricingRules(BaseModel):
+    seasons: List[SeasonRule] = []
+    weekend_multiplier: float = Field(1.0, gt=0)
+    # Monday is 0
+    weekend_days: List[Annotated[int, Field(ge=0, le=6)]] = [5, 6]
+    duration_tiers: List[DurationTier] = []
+
+# Response models
+# Declaring these lets FastAPI serialize through pydantic-core instead of
+# jsonable_encoder, drops stray Mongo fields such as _id, and gives the
+# projection each list query fetches (see projection_for).
+class UserOut(BaseModel):
+    user_id: str
+    email: str
+    first_name: str
+    last_name: str
+    role: str
+    agency_id: Optional[str] = None
+
+class AuthResponse(BaseModel):
+    message: str
+    token: str
+    user: UserOut
+
+class AgencyOut(BaseModel):
+    agency_id: str
+    name: str
+    email: str
+    phone: str
+    address: str
+    description: Optional[str] = None
+    status: str
+    created_at: datetime
+
+class AgencyResponse(BaseModel):
+    message: str
+    agency: AgencyOut
+
+class AgencyList(BaseModel):
+    agencies: List[AgencyOut]
+    next_cursor: Optional[str] = None
+
+class CarOut(BaseModel):
+    car_id: str
+    title: str
+    model: str
+    brand: str
+    year: int
+    plate_number: str
+    color: str
+    price_per_day: float
+    features: List[str] = []
+    agency_id: str
+    status: str
+    created_at: datetime
+
+class CarResponse(BaseModel):
+    message: str
+    car: CarOut
+
+class CarList(BaseModel):
+    cars: List[CarOut]
+    next_cursor: Optional[str] = None
+
+class BookingOut(BaseModel):
+    booking_id: str
+    car_id: str
+    agency_id: str
+    client_email: str
+    client_name: str
+    client_phone: str
+    pickup_date: datetime
+    return_date: datetime
+    pickup_location: str
+    return_location: str
+    message: Optional[str] = None
+    status: str
+    total_amount: float
+    created_at: datetime
+
+class BookingResponse(BaseModel):
+    message: str
+    booking: BookingOut
+
+class BookingList(BaseModel):
+    bookings: List[BookingOut]
+    next_cursor: Optional[str] = None
+
+# What unauthenticated callers see of a car or agency: no plate numbers,
+# timestamps or agency status
+class PublicCarOut(BaseModel):
+    car_id: str
+    title: str
+    model: str
+    brand: str
+    year: int
+    color: str
+    price_per_day: float
+    features: List[str] = []
+    agency_id: str
+    status: str
+
+class PublicAgencyOut(BaseModel):
+    agency_id: str
+    name: str
+    email: str
+    phone: str
+    address: str
+    description: Optional[str] = None
+
+class PublicCatalog(BaseModel):
+    agency: Optional[PublicAgencyOut] = None
+    cars: List[PublicCarOut]
+
+class AvailabilityResponse(BaseModel):
+    start: datetime = Field(alias="from")
+    end: datetime = Field(alias="to")
+    cars: List[PublicCarOut]
+
+class QuoteOut(BaseModel):
+    car_id: str
+    price_per_day: float
+    total_amount: float
+
+class QuoteResponse(BaseModel):
+    start: datetime = Field(alias="from")
+    end: datetime = Field(alias="to")
+    days: int
+    quotes: List[QuoteOut]
+
+class CarSearchResponse(BaseModel):
+    cars: List[PublicCarOut]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    facets: Optional[dict] = None
+
+def projection_for(model) -> dict:
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
+# Sparse fieldsets
+# List endpoints take ?fields=a,b,c to return only those fields of each record.
+# The selection is checked against the fields the caller's role may select and
+# becomes the Mongo projection, so unrequested fields are neither read nor
+# serialized. The record id is always returned. Without fields= the response
+# is the role's whole model: public routes answer with PublicCarOut and
+# PublicAgencyOut, so the public allow-list holds for default responses too.
+PUBLIC_ROLE = "public"
+STAFF_ROLES = [UserRole.SUPER_ADMIN, UserRole.AGENCY_ADMIN, UserRole.STAFF]
+SPARSE_FIELDS = {
+    AgencyOut: {UserRole.SUPER_ADMIN: set(AgencyOut.model_fields)},
+    CarOut: {role: set(CarOut.model_fields) for role in STAFF_ROLES},
+    BookingOut: {role: set(BookingOut.model_fields) for role in STAFF_ROLES},
+    PublicAgencyOut: {PUBLIC_ROLE: set(PublicAgencyOut.model_fields)},
+    PublicCarOut: {PUBLIC_ROLE: set(PublicCarOut.model_fields)},
+}
+SPARSE_ID_FIELDS = {
+    AgencyOut: "agency_id",
+    CarOut: "car_id",
+    BookingOut: "booking_id",
+    PublicAgencyOut: "agency_id",
+    PublicCarOut: "car_id",
+}
+
+def select_fields(fields: Optional[str], model, role: str) -> Optional[List[str]]:
+    """Validate a fields= selection; None means the whole model."""
+    if not fields:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    rejected = requested - SPARSE_FIELDS[model].get(role, set())
+    if rejected:
+        raise HTTPException(status_code=400, detail=f"Fields not available: {', '.join(sorted(rejected))}")
+    return sorted(requested | {SPARSE_ID_FIELDS[model]})
+
+def sparse_projection(model, selected: Optional[List[str]], *extra: str) -> dict:
+    """Projection for a selection; `extra` fields are read for cursors or filters only."""
+    if selected is None:
+        return projection_for(model)
+    return {"_id": 0, **{field: 1 for field in (*selected, *extra)}}
+
+def sparse_response(key: str, items: List[dict], selected: List[str], *extra: str, **content) -> ORJSONResponse:
+    """Render a sparse list directly, since the response model would reject the missing fields."""
+    dropped = [field for field in extra if field not in selected]
+    if dropped:
+        for item in items:
+            for field in dropped:
+                item.pop(field, None)
+    return ORJSONResponse({key: items, **content})
+
+# Caching
+class TTLCache:
+    """Bounded in-process LRU cache whose entries also expire after ttl_seconds.
+
+    `generation` is bumped by every invalidation; a caller that loaded a value
+    before an invalidation passes the generation it started with to set(), and
+    the stale value is dropped instead of being cached.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value: Any, generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]):
+        self.generation += 1
+        for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# Authenticated principals (user document minus the password hash) keyed by
+# user_id. No route changes an existing user's role or agency, so the only
+# invalidation is per agency on status changes; the TTL bounds how long
+# another worker, or an edit made directly in Mongo, can serve a stale principal.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+def invalidate_agency_users(agency_id: str):
+    user_cache.invalidate_where(lambda principal: principal.get("agency_id") == agency_id)
+
+# Public catalog responses, serialized once per agency and served with an ETag.
+# The ETag is a hash of the body, so workers with separate caches agree on it.
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "1000"))
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "300"))
+CATALOG_MAX_AGE_SECONDS = int(os.getenv("CATALOG_MAX_AGE_SECONDS", "30"))
+CATALOG_CACHE_REDIS_URL = os.getenv("CATALOG_CACHE_REDIS_URL")
+
+# Each key holds one body per variant (a fields= selection); delete() drops them all.
+# As with TTLCache, a caller takes generation(key) before reading Mongo and
+# passes it to set(), which drops the body if the key was invalidated since.
+class InProcessResponseCache:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self._cache = TTLCache(max_size, ttl_seconds)
+
+    async def generation(self, key: str) -> int:
+        return self._cache.generation
+
+    async def get(self, key: str, variant: str = ""):
+        entry = self._cache.get((key, variant))
+        return entry[1:] if entry else None
+
+    async def set(self, key: str, body: bytes, etag: str, variant: str = "", generation: Optional[int] = None):
+        self._cache.set((key, variant), (key, body, etag), generation)
+
+    async def delete(self, key: str):
+        self._cache.invalidate_where(lambda entry: entry[0] == key)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+class RedisResponseCache:
+    """Shared backend so an invalidation on one worker is seen by all of them."""
+
+    # Store only if the key's generation is unchanged; Redis runs scripts atomically
+    SET_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+    """
+
+    def __init__(self, url: str, ttl_seconds: float, prefix: str = "catalog:"):
+        # Optional dependency, only needed when CATALOG_CACHE_REDIS_URL is set
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._set_script = self._redis.register_script(self.SET_SCRIPT)
+        self._ttl = int(ttl_seconds)
+        self._prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str, variant: str = ""):
+        value = await self._redis.hget(self._prefix + key, variant)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        etag, body = value.split(b"\n", 1)
+        return body, etag.decode()
+
+    async def generation(self, key: str) -> int:
+        return int(await self._redis.get(self._prefix + "generation:" + key) or 0)
+
+    async def set(self, key: str, body: bytes, etag: str, variant: str = "", generation: Optional[int] = None):
+        if generation is None:
+            generation = await self.generation(key)
+        await self._set_script(
+            keys=[self._prefix + key, self._prefix + "generation:" + key],
+            args=[str(generation), variant, etag.encode() + b"\n" + body, self._ttl]
+        )
+
+    async def delete(self, key: str):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._prefix + key)
+            # Outlives any read that started before it, so that read's set() is dropped
+            pipe.incr(self._prefix + "generation:" + key)
+            pipe.expire(self._prefix + "generation:" + key, self._ttl)
+            await pipe.execute()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+if CATALOG_CACHE_REDIS_URL:
+    catalog_cache = RedisResponseCache(CATALOG_CACHE_REDIS_URL, CATALOG_CACHE_TTL_SECONDS)
+else:
+    catalog_cache = InProcessResponseCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL_SECONDS)
+
+async def invalidate_catalog(agency_id: str):
+    await catalog_cache.delete(agency_id)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+# Tenant routing
+# Cars, bookings and the collections derived from them (TENANT_COLLECTIONS)
+# live in the database their agency is routed to; users, agencies, rollups and
+# the other shared collections stay in the control database `db`.
+# TENANT_TARGETS is a JSON object of target name -> Mongo URL including the
+# database name, each a distinct database; "default" is always `db`. Reads
+# resolve the route through a short-lived cache. Writes resolve it uncached,
+# so a migration cut-over (see migrate_agency) applies on every worker at once.
+DEFAULT_TARGET = "default"
+TENANT_TARGET_URLS = orjson.loads(os.getenv("TENANT_TARGETS", "{}"))
+TENANT_ROUTE_CACHE_SIZE = int(os.getenv("TENANT_ROUTE_CACHE_SIZE", "10000"))
+TENANT_ROUTE_CACHE_TTL_SECONDS = float(os.getenv("TENANT_ROUTE_CACHE_TTL_SECONDS", "30"))
+
+class TenantTarget:
+    def __init__(self, name: str, database):
+        self.name = name
+        self.db = database
+        self.secondary_db = secondary_of(database)
+
+def connect_target(name: str, url: str) -> TenantTarget:
+    target_client = AsyncIOMotorClient(url, **MONGO_CLIENT_OPTIONS, event_listeners=[MongoCommandMetrics()])
+    return TenantTarget(name, target_client.get_default_database())
+
+tenant_targets = {DEFAULT_TARGET: TenantTarget(DEFAULT_TARGET, db)}
+tenant_targets.update(
+    (name, connect_target(name, url)) for name, url in TENANT_TARGET_URLS.items() if name != DEFAULT_TARGET
+)
+tenant_route_cache = TTLCache(TENANT_ROUTE_CACHE_SIZE, TENANT_ROUTE_CACHE_TTL_SECONDS)
+
+def all_targets() -> List[TenantTarget]:
+    return list(tenant_targets.values())
+
+def target_named(name: str) -> TenantTarget:
+    if name not in tenant_targets:
+        raise RuntimeError(f"Tenant target {name} is not configured in TENANT_TARGETS")
+    return tenant_targets[name]
+
+async def load_tenant_route(agency_id: str) -> dict:
+    route = await db.tenant_routes.find_one({"agency_id": agency_id}, {"_id": 0})
+    return route or {"agency_id": agency_id, "target": DEFAULT_TARGET, "state": "active"}
+
+async def tenant(agency_id: str) -> TenantTarget:
+    """Target holding the agency's data, for reads."""
+    if len(tenant_targets) == 1:
+        return tenant_targets[DEFAULT_TARGET]
+    route = tenant_route_cache.get(agency_id)
+    if route is None:
+        generation = tenant_route_cache.generation
+        route = await load_tenant_route(agency_id)
+        tenant_route_cache.set(agency_id, route, generation)
+    return target_named(route["target"])
+
+async def tenant_for_write(agency_id: str) -> TenantTarget:
+    """Target to write the agency's data to; refuses writes while the agency is frozen for a move."""
+    if len(tenant_targets) == 1:
+        return tenant_targets[DEFAULT_TARGET]
+    route = await load_tenant_route(agency_id)
+    if route["state"] == "frozen":
+        raise HTTPException(
+            status_code=503,
+            detail="Agency data is being moved, please retry",
+            headers={"Retry-After": "2"}
+        )
+    return target_named(route["target"])
+
+async def find_car_for_write(car_id: str) -> tuple:
+    """Find a car by id alone (public bookings only name the car) and the target to write its bookings to."""
+    if len(tenant_targets) == 1:
+        target = tenant_targets[DEFAULT_TARGET]
+        return await target.db.cars.find_one({"car_id": car_id}), target
+    found = await asyncio.gather(*(target.db.cars.find_one({"car_id": car_id}) for target in all_targets()))
+    car = next((car for car in found if car), None)
+    if car is None:
+        return None, None
+    # Mid-migration the car exists on two targets; the route decides which is live
+    target = await tenant_for_write(car["agency_id"])
+    return await target.db.cars.find_one({"car_id": car_id}), target
+
+def target_read_db(target: TenantTarget, request: Request):
+    return target.db if reads_pinned_to_primary(request) else target.secondary_db
+
+async def tenant_reads(agency_id: str, request: Request):
+    """Agency database for staleness-tolerant reads, resolved from the agency_id path parameter."""
+    return target_read_db(await tenant(agency_id), request)
+
+async def load_principal(user_id: str) -> Optional[dict]:
+    user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "password": 0})
+    if user is None:
+        return None
+    user["agency_status"] = None
+    if user.get("agency_id"):
+        agency = await db.agencies.find_one({"agency_id": user["agency_id"]}, {"_id": 0, "status": 1})
+        user["agency_status"] = agency["status"] if agency else None
+    return user
+
+# Helper functions
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+async def run_password_job(func: Callable, *args):
+    global password_jobs_in_flight
+    if password_jobs_in_flight >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE:
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication is busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    password_jobs_in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_jobs_in_flight -= 1
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_job(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job(verify_password, plain_password, hashed_password)
+
+def create_access_token(data: dict):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        token = credentials.credentials
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        user_id: str = payload.get("sub")
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        
+        user = user_cache.get(user_id)
+        if user is None:
+            generation = user_cache.generation
+            user = await load_principal(user_id)
+            if user is None:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.set(user_id, user, generation)
+        
+        if user["agency_status"] == "suspended":
+            raise HTTPException(status_code=403, detail="Agency suspended")
+        
+        return user
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+def require_role(required_roles: List[str]):
+    async def role_checker(current_user: dict = Depends(get_current_user)):
+        if current_user["role"] not in required_roles:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+        return current_user
+    return role_checker
+
+# Availability
+# Bookings in these statuses hold the car; cancelled or returned ones free it
+ACTIVE_BOOKING_STATUSES = ["pending", "confirmed"]
+
+def overlap_filter(start: datetime, end: datetime) -> dict:
+    # Two rentals overlap when each one starts before the other ends. Bounding
+    # return_date from below keeps historical bookings out of the index scan.
+    return {
+        "status": {"$in": ACTIVE_BOOKING_STATUSES},
+        "return_date": {"$gt": start},
+        "pickup_date": {"$lt": end},
+    }
+
+def validate_rental_period(start: datetime, end: datetime):
+    if end <= start:
+        raise HTTPException(status_code=400, detail="Return date must be after pickup date")
+
+async def find_conflicting_booking(database, car_id: str, start: datetime, end: datetime):
+    return await database.bookings.find_one(
+        {"car_id": car_id, **overlap_filter(start, end)},
+        {"_id": 0, "booking_id": 1, "pickup_date": 1, "return_date": 1}
+    )
+
+async def get_booked_car_ids(reads, agency_id: Optional[str], start: datetime, end: datetime) -> set:
+    query = overlap_filter(start, end)
+    if agency_id:
+        query["agency_id"] = agency_id
+    car_ids = await reads.bookings.distinct("car_id", query)
+    return set(car_ids)
+
+# Reservation slots
+# The overlap check above is read-then-write, so two concurrent requests can
+# both pass it. A booking attempt therefore first locks one reservation_slots
+# document per (car_id, UTC day) its range touches, return day included, and
+# holds them while it re-runs the overlap check and inserts the booking. Any
+# two overlapping rentals share a day, so they run one after the other; the
+# overlap check stays the exact test, so rentals that only share a day both
+# succeed. The unique index makes the locks per car, never shared between
+# unrelated cars. Locks older than RESERVATION_LOCK_SECONDS were left by a
+# crashed request and are taken over.
+RESERVATION_LOCK_SECONDS = 30
+RESERVATION_LOCK_ATTEMPTS = 5
+RESERVATION_LOCK_RETRY_SECONDS = 0.05
+
+def as_utc(moment: datetime) -> datetime:
+    """Naive UTC, the form stored dates come back from Mongo in."""
+    if moment.tzinfo:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def rental_days(start: datetime, end: datetime) -> List[datetime]:
+    """Every UTC day that [start, end) touches."""
+    start, end = as_utc(start), as_utc(end)
+    day = datetime(start.year, start.month, start.day)
+    days = []
+    while day < end:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+async def claim_reservation_slots(
+    database, agency_id: str, car_id: str, booking_id: str, start: datetime, end: datetime
+) -> bool:
+    """Lock the car's days for one booking attempt; False when another attempt holds one."""
+    days = rental_days(start, end)
+    now = datetime.utcnow()
+    # agency_id lets a tenant migration pick out the agency's slots
+    slots = [
+        {"car_id": car_id, "day": day, "booking_id": booking_id, "agency_id": agency_id, "claimed_at": now}
+        for day in days
+    ]
+    try:
+        # Ordered, in day order, so the batch stops at the first taken day
+        await database.reservation_slots.insert_many(slots, ordered=True)
+        return True
+    except BulkWriteError:
+        await release_reservation_slots(database, booking_id)
+    # Take over locks left by crashed requests
+    await database.reservation_slots.delete_many({
+        "car_id": car_id,
+        "day": {"$in": days},
+        "claimed_at": {"$lt": now - timedelta(seconds=RESERVATION_LOCK_SECONDS)},
+    })
+    return False
+
+async def release_reservation_slots(database, booking_id: str):
+    await database.reservation_slots.delete_many({"booking_id": booking_id})
+
+# Pricing
+# Each agency's rules are compiled into a table of per-day rate multipliers
+# (season times weekend) and its prefix sums, so the day factor of any rental
+# is one subtraction and a whole fleet is priced with one vectorized multiply.
+# A rental is charged per started 24 hours; each charged day takes the
+# multiplier of the calendar day (UTC) it starts on. create_booking prices
+# through the same table as the quote endpoint, so the stored total matches.
+PRICING_HORIZON_DAYS = int(os.getenv("PRICING_HORIZON_DAYS", "730"))
+# Rentals may start up to a year back, e.g. when recording a walk-in late
+PRICING_LOOKBACK_DAYS = 366
+RATE_TABLE_CACHE_SIZE = int(os.getenv("RATE_TABLE_CACHE_SIZE", "1000"))
+# Bounds how long another worker can quote with superseded rules
+RATE_TABLE_CACHE_TTL_SECONDS = float(os.getenv("RATE_TABLE_CACHE_TTL_SECONDS", "60"))
+
+def billable_days(start: datetime, end: datetime) -> int:
+    return max(1, math.ceil((as_utc(end) - as_utc(start)).total_seconds() / 86400))
+
+def month_day(value: str) -> int:
+    month, day = value.split("-")
+    return int(month) * 100 + int(day)
+
+class RateTable:
+    def __init__(self, rules: PricingRules, origin: datetime, days: int):
+        self.origin = origin
+        dates = np.datetime64(origin.date(), "D") + np.arange(days)
+        months = dates.astype("datetime64[M]")
+        day_of_month = (dates - months).astype(int) + 1
+        md = (months.astype(int) % 12 + 1) * 100 + day_of_month
+        # 1970-01-01 was a Thursday
+        weekday = (dates.astype(int) + 3) % 7
+        
+        multipliers = np.ones(days)
+        # Later seasons take precedence where they overlap earlier ones
+        for season in rules.seasons:
+            start, end = month_day(season.start), month_day(season.end)
+            in_season = (md >= start) & (md <= end) if start <= end else (md >= start) | (md <= end)
+            multipliers[in_season] = season.multiplier
+        multipliers[np.isin(weekday, rules.weekend_days)] *= rules.weekend_multiplier
+        self.prefix = np.concatenate(([0.0], np.cumsum(multipliers)))
+        
+        tiers = sorted(rules.duration_tiers, key=lambda tier: tier.min_days)
+        self.tier_min_days = np.array([tier.min_days for tier in tiers], dtype=int)
+        self.tier_discounts = np.array([tier.discount for tier in tiers])
+
+    def discount(self, days: int) -> float:
+        applicable = np.searchsorted(self.tier_min_days, days, side="right")
+        return float(self.tier_discounts[applicable - 1]) if applicable else 0.0
+
+    def quote(self, prices: np.ndarray, start: datetime, end: datetime) -> tuple:
+        """Return (charged days, totals) for renting cars at `prices` per day over [start, end)."""
+        days = billable_days(start, end)
+        first = (as_utc(start) - self.origin).days
+        if first < 0 or first + days >= len(self.prefix):
+            raise HTTPException(status_code=400, detail="Rental dates are outside the pricing window")
+        day_factor = self.prefix[first + days] - self.prefix[first]
+        totals = np.round(prices * (day_factor * (1 - self.discount(days))), 2)
+        return days, totals
+
+rate_tables = TTLCache(RATE_TABLE_CACHE_SIZE, RATE_TABLE_CACHE_TTL_SECONDS)
+
+async def get_rate_table(agency_id: str) -> RateTable:
+    table = rate_tables.get(agency_id)
+    if table is None:
+        generation = rate_tables.generation
+        doc = await db.pricing_rules.find_one({"agency_id": agency_id}, {"_id": 0, "agency_id": 0, "updated_at": 0})
+        now = datetime.utcnow()
+        origin = datetime(now.year, now.month, now.day) - timedelta(days=PRICING_LOOKBACK_DAYS)
+        table = RateTable(PricingRules(**(doc or {})), origin, PRICING_LOOKBACK_DAYS + PRICING_HORIZON_DAYS)
+        rate_tables.set(agency_id, table, generation)
+    return table
+
+async def price_rental(agency_id: str, price_per_day: float, start: datetime, end: datetime) -> float:
+    table = await get_rate_table(agency_id)
+    _, totals = table.quote(np.array([price_per_day]), start, end)
+    return float(totals[0])
+
+# Pagination
+# List endpoints page with an opaque keyset cursor holding the sort value and
+# id of the last item returned, so each page is an index range scan no matter
+# how deep the client has paged. The id breaks ties between equal sort values.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort_field: str, last_item: dict, id_field: str) -> str:
+    payload = json_util.dumps([sort_field, last_item.get(sort_field), last_item[id_field]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor: str, sort_field: str):
+    try:
+        cursor_field, value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_field != sort_field:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort order")
+    return value, last_id
+
+async def paginate(
+    collection,
+    query: dict,
+    id_field: str,
+    sort_field: str,
+    descending: bool,
+    limit: int,
+    after: Optional[str],
+    projection: Optional[dict] = None,
+    union_with: Optional[str] = None
+):
+    """Return one page of documents and the cursor for the next page (None on the last page).
+
+    With union_with, the page is drawn from that collection as well; each side
+    is cut to the page size on its own index before the two are merged.
+    """
+    direction = DESCENDING if descending else ASCENDING
+    if after:
+        value, last_id = decode_cursor(after, sort_field)
+        op = "$lt" if descending else "$gt"
+        query = {
+            "$and": [
+                query,
+                {"$or": [
+                    {sort_field: {op: value}},
+                    {sort_field: value, id_field: {op: last_id}},
+                ]},
+            ]
+        }
+    
+    if union_with:
+        page = [{"$match": query}, {"$sort": {sort_field: direction, id_field: direction}}, {"$limit": limit + 1}]
+        items = await collection.aggregate([
+            *page,
+            {"$unionWith": {"coll": union_with, "pipeline": page}},
+            *page[1:],
+            {"$project": projection or {"_id": 0}},
+        ]).to_list(length=None)
+    else:
+        items = await collection.find(
+            query, projection or {"_id": 0}
+        ).sort([(sort_field, direction), (id_field, direction)]).limit(limit + 1).to_list(length=None)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(sort_field, items[-1], id_field)
+    return items, next_cursor
+
+def parse_sort(sort: str, allowed: dict) -> tuple:
+    """Map a `field` or `-field` sort parameter onto an indexed field and direction."""
+    descending = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field not in allowed:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {field}")
+    return allowed[field], descending
+
+# Fleet import
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ROWS = 50000
+MAX_REPORTED_IMPORT_ERRORS = 1000
+MAX_CSV_RECORD_CHARS = 64 * 1024
+
+def build_car(car_data: CarCreate) -> dict:
+    return {
+        "car_id": str(uuid.uuid4()),
+        "title": car_data.title,
+        "model": car_data.model,
+        "brand": car_data.brand,
+        "year": car_data.year,
+        "plate_number": car_data.plate_number,
+        "color": car_data.color,
+        "price_per_day": car_data.price_per_day,
+        "features": car_data.features,
+        "agency_id": car_data.agency_id,
+        "status": "available",
+        "created_at": datetime.utcnow()
+    }
+
+async def iter_list(items: list):
+    for item in items:
+        yield item
+
+async def iter_csv_rows(chunks):
+    """Parse a streamed CSV body into dicts keyed by the header row.
+
+    Lines are buffered only until their quotes balance, so a quoted field may
+    span lines. A record that grows past MAX_CSV_RECORD_CHARS (an unbalanced
+    quote or a missing newline) is yielded as a ValueError instead of a row,
+    and parsing resumes at the next line, so memory stays bounded whatever
+    the upload holds. The features column is a semicolon separated list.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    header = None
+    record = ""
+    quotes = 0
+    pending = ""
+    # Dropping the rest of an oversized line until its newline arrives
+    skipping = False
+    
+    def parse(record: str):
+        nonlocal header
+        values = next(csv.reader([record]), [])
+        if not any(value.strip() for value in values):
+            return None
+        if header is None:
+            header = [value.strip() for value in values]
+            return None
+        row = {key: value.strip() for key, value in zip(header, values) if value.strip() != ""}
+        if "features" in row:
+            row["features"] = [feature.strip() for feature in row["features"].split(";") if feature.strip()]
+        return row
+    
+    def oversized() -> ValueError:
+        return ValueError(f"Record exceeds {MAX_CSV_RECORD_CHARS} characters; check for an unbalanced quote")
+    
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            if skipping:
+                skipping = False
+                continue
+            record += line + "\n"
+            quotes += line.count('"')
+            if quotes % 2 == 0:
+                row = parse(record)
+                record, quotes = "", 0
+                if row is not None:
+                    yield row
+            elif len(record) > MAX_CSV_RECORD_CHARS:
+                record, quotes = "", 0
+                yield oversized()
+        if len(record) + len(pending) > MAX_CSV_RECORD_CHARS:
+            if not skipping:
+                yield oversized()
+            record, quotes, pending = "", 0, ""
+            skipping = True
+    pending += decoder.decode(b"", final=True)
+    if not skipping and (record + pending).strip():
+        row = parse(record + pending)
+        if row is not None:
+            yield row
+
+def format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors()
+    )
+
+async def insert_car_batch(database, batch: List[dict], batch_rows: List[int], errors: List[dict]) -> int:
+    """Insert unordered so one bad row does not stop the rest; return the inserted count."""
+    try:
+        result = await database.cars.insert_many(batch, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        for write_error in e.details["writeErrors"]:
+            if write_error["code"] == DUPLICATE_KEY_CODE:
+                message = f"Duplicate plate_number {batch[write_error['index']]['plate_number']}"
+            else:
+                message = write_error["errmsg"]
+            errors.append({"row": batch_rows[write_error["index"]], "error": message})
+        return e.details["nInserted"]
+
+# Streaming export
+# Exports walk a batched cursor and yield one line per document, so memory
+# stays flat however many bookings an agency has.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+BOOKING_EXPORT_FIELDS = [
+    "booking_id", "car_id", "client_name", "client_email", "client_phone",
+    "pickup_date", "return_date", "pickup_location", "return_location",
+    "status", "total_amount", "created_at", "message"
+]
+CAR_EXPORT_FIELDS = [
+    "car_id", "title", "brand", "model", "year", "plate_number", "color",
+    "price_per_day", "features", "status", "created_at"
+]
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def stream_export(cursor, fields: List[str], export_format: str):
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        async for doc in cursor:
+            writer.writerow([
+                "; ".join(doc[field]) if isinstance(doc.get(field), list) else export_value(doc.get(field))
+                for field in fields
+            ])
+            # Flush roughly once per batch instead of once per row
+            if buffer.tell() >= 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        async for doc in cursor:
+            yield orjson.dumps({field: doc.get(field) for field in fields}) + b"\n"
+
+def export_response(cursor, fields: List[str], export_format: str, filename: str) -> StreamingResponse:
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {export_format}")
+    return StreamingResponse(
+        stream_export(cursor, fields, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
+
+# Analytics rollups
+# Counters are bumped on every write so analytics reads a handful of small
+# documents instead of counting whole collections. rebuild_rollups()
+# recomputes them from source data to repair any drift.
+GLOBAL_SCOPE = "global"
+ROLLUP_WRITE_BATCH_SIZE = 1000
+# A worker that died mid-seed lets another one retry after this long
+ROLLUP_SEED_LEASE_SECONDS = int(os.getenv("ROLLUP_SEED_LEASE_SECONDS", "600"))
+
+def agency_scope(agency_id: str) -> str:
+    return f"agency:{agency_id}"
+
+def rollup_day(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%d")
+
+async def increment_rollups(scopes: List[str], inc: dict, day: Optional[str] = None, day_inc: Optional[dict] = None):
+    updates = [
+        db.rollups.update_one({"_id": scope}, {"$inc": inc}, upsert=True)
+        for scope in scopes
+    ]
+    if day:
+        updates += [
+            db.daily_rollups.update_one(
+                {"scope": scope, "day": day}, {"$inc": day_inc}, upsert=True
+            )
+            for scope in scopes
+        ]
+    await asyncio.gather(*updates)
+
+async def record_agency_created(agency: dict):
+    active = 1 if agency["status"] == "active" else 0
+    await increment_rollups([GLOBAL_SCOPE], {"agencies": 1, "active_agencies": active})
+
+async def record_agency_status_change(old_status: str, new_status: str):
+    delta = (new_status == "active") - (old_status == "active")
+    if delta:
+        await increment_rollups([GLOBAL_SCOPE], {"active_agencies": delta})
+
+async def record_car_created(car: dict):
+    await record_cars_created(car["agency_id"], 1)
+
+async def record_cars_created(agency_id: str, count: int):
+    await increment_rollups([GLOBAL_SCOPE, agency_scope(agency_id)], {"cars": count})
+
+async def record_booking_created(booking: dict):
+    await increment_rollups(
+        [GLOBAL_SCOPE, agency_scope(booking["agency_id"])],
+        {
+            "bookings": 1,
+            f"bookings_by_status.{booking['status']}": 1,
+            "revenue": booking["total_amount"],
+        },
+        day=rollup_day(booking["created_at"]),
+        day_inc={"bookings": 1, "revenue": booking["total_amount"]},
+    )
+
+async def rebuild_rollups():
+    """Recompute every rollup from the source collections.
+
+    Counters are corrected with $inc rather than replaced, so increments that
+    land while the rebuild runs are kept instead of overwritten.
+    """
+    # Snapshot the counters first and count only documents created before the
+    # snapshot; anything created later bumps the counters itself. A write
+    # whose $inc is still in flight at the snapshot can be off by one until
+    # the next rebuild.
+    started = datetime.utcnow()
+    current = {doc["_id"]: doc async for doc in db.rollups.find()}
+    current_daily = {(doc["scope"], doc["day"]): doc async for doc in db.daily_rollups.find()}
+    created_before = {"$match": {"created_at": {"$not": {"$gte": started}}}}
+    rollups = {GLOBAL_SCOPE: {"agencies": 0, "active_agencies": 0, "cars": 0, "bookings": 0,
+                              "bookings_by_status": {}, "revenue": 0}}
+    daily = {}
+    
+    def scope_doc(scope):
+        return rollups.setdefault(scope, {"cars": 0, "bookings": 0, "bookings_by_status": {}, "revenue": 0})
+    
+    agency_counts = await db.agencies.aggregate([
+        created_before,
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(length=None)
+    for row in agency_counts:
+        rollups[GLOBAL_SCOPE]["agencies"] += row["count"]
+        if row["_id"] == "active":
+            rollups[GLOBAL_SCOPE]["active_agencies"] += row["count"]
+    
+    # Rollups live in the control database and cover every tenant target
+    for target in all_targets():
+        car_counts = await target.db.cars.aggregate([
+            created_before,
+            {"$group": {"_id": "$agency_id", "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+        for row in car_counts:
+            for scope in (GLOBAL_SCOPE, agency_scope(row["_id"])):
+                scope_doc(scope)["cars"] += row["count"]
+        
+        booking_counts = target.db.bookings.aggregate([
+            {"$unionWith": ARCHIVE_COLLECTION},
+            created_before,
+            {"$group": {
+                "_id": {
+                    "agency_id": "$agency_id",
+                    "status": "$status",
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                },
+                "count": {"$sum": 1},
+                "revenue": {"$sum": "$total_amount"},
+            }}
+        ], allowDiskUse=True)
+        async for row in booking_counts:
+            key = row["_id"]
+            for scope in (GLOBAL_SCOPE, agency_scope(key["agency_id"])):
+                doc = scope_doc(scope)
+                doc["bookings"] += row["count"]
+                doc["bookings_by_status"][key["status"]] = doc["bookings_by_status"].get(key["status"], 0) + row["count"]
+                doc["revenue"] += row["revenue"]
+                day = daily.setdefault((scope, key["day"]), {"bookings": 0, "revenue": 0})
+                day["bookings"] += row["count"]
+                day["revenue"] += row["revenue"]
+    
+    # Scopes and days without source data any more are corrected down to zero
+    corrections = []
+    for scope in rollups.keys() | current.keys():
+        inc = counter_corrections(current.get(scope, {}), rollups.get(scope, {}))
+        if inc:
+            corrections.append(UpdateOne({"_id": scope}, {"$inc": inc}, upsert=True))
+    await bulk_update(db.rollups, corrections)
+    corrections = []
+    for scope, day in daily.keys() | current_daily.keys():
+        inc = counter_corrections(current_daily.get((scope, day), {}), daily.get((scope, day), {}))
+        if inc:
+            corrections.append(UpdateOne({"scope": scope, "day": day}, {"$inc": inc}, upsert=True))
+    await bulk_update(db.daily_rollups, corrections)
+    # and then dropped, unless a write counted into them meanwhile
+    stale_scopes = list(current.keys() - rollups.keys())
+    if stale_scopes:
+        await db.rollups.delete_many({
+            "_id": {"$in": stale_scopes}, "cars": {"$in": [0, None]}, "bookings": {"$in": [0, None]}
+        })
+    stale_days = [current_daily[key]["_id"] for key in current_daily.keys() - daily.keys()]
+    if stale_days:
+        await db.daily_rollups.delete_many({"_id": {"$in": stale_days}, "bookings": {"$in": [0, None]}})
+
+def counter_corrections(current: dict, rebuilt: dict, prefix: str = "") -> dict:
+    """$inc moving the counters of a rollup document to their rebuilt values."""
+    inc = {}
+    for field in current.keys() | rebuilt.keys():
+        old, new = current.get(field, 0), rebuilt.get(field, 0)
+        if isinstance(old, dict) or isinstance(new, dict):
+            inc.update(counter_corrections(old or {}, new or {}, f"{prefix}{field}."))
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and old != new:
+            inc[prefix + field] = new - old
+    return inc
+
+async def bulk_update(collection, requests: list):
+    for start in range(0, len(requests), ROLLUP_WRITE_BATCH_SIZE):
+        await collection.bulk_write(requests[start:start + ROLLUP_WRITE_BATCH_SIZE], ordered=False)
+
+async def claim_rollup_seed() -> bool:
+    """Let one worker seed missing rollups at startup."""
+    now = datetime.utcnow()
+    try:
+        await db.rollup_state.update_one(
+            {"_id": "seed", "claimed_at": {"$lte": now - timedelta(seconds=ROLLUP_SEED_LEASE_SECONDS)}},
+            {"$set": {"claimed_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired claim and is seeding
+        return False
+
+def rollup_summary(doc: Optional[dict]) -> dict:
+    doc = doc or {}
+    return {
+        "total_cars": doc.get("cars", 0),
+        "total_bookings": doc.get("bookings", 0),
+        "bookings_by_status": doc.get("bookings_by_status", {}),
+        "total_revenue": doc.get("revenue", 0),
+    }
+
+# Catalog search
+# A results page is its own find().sort().limit(), served by the status_*
+# indexes. The total and facets need every match, so they are computed on the
+# first page only: with facets=true one $facet pass yields both, otherwise the
+# total is an index count capped at SEARCH_COUNT_LIMIT. Facets scan every match,
+# so they are opt-in. Searched on several targets, facet values are grouped
+# uncut on each and only the merged counts are cut to SEARCH_FACET_SIZE. A date range is applied
+# by checking only the cars on the page against bookings, fetching more when
+# booked cars thin the page out. Across all agencies the booked set is
+# unbounded, so a dated search without agency_id returns no total or facets.
+SEARCH_SORT_FIELDS = {"price": "price_per_day", "year": "year"}
+SEARCH_FACET_SIZE = 20
+SEARCH_COUNT_LIMIT = 10000
+PRICE_FACET_BOUNDARIES = [0, 50, 100, 150, 200, 300, 500]
+SEARCH_FACETS = {
+    "brands": "brand",
+    "colors": "color",
+    "features": "features",
+    "years": "year",
+}
+
+def count_facet(field: str, unwind: bool = False, limit: Optional[int] = SEARCH_FACET_SIZE) -> list:
+    stages = [{"$unwind": f"${field}"}] if unwind else []
+    stages += [
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+    ]
+    if limit:
+        stages.append({"$limit": limit})
+    return stages + [{"$project": {"_id": 0, "value": "$_id", "count": 1}}]
+
+def search_facets(limit: Optional[int] = SEARCH_FACET_SIZE) -> dict:
+    """$facet stages for a search; limit=None keeps every value for merging across targets."""
+    facets = {
+        name: count_facet(field, unwind=field == "features", limit=limit) for name, field in SEARCH_FACETS.items()
+    }
+    facets["price_ranges"] = [
+        {"$bucket": {
+            "groupBy": "$price_per_day",
+            "boundaries": PRICE_FACET_BOUNDARIES,
+            "default": "other",
+            "output": {"count": {"$sum": 1}},
+        }},
+        {"$project": {"_id": 0, "min": "$_id", "count": 1}},
+    ]
+    facets["total"] = [{"$count": "count"}]
+    return facets
+
+def merge_search_facets(results: List[dict]) -> dict:
+    """Combine the $facet output of one search run on several tenant targets."""
+    merged = {"total": [{"count": sum(result["total"][0]["count"] for result in results if result["total"])}]}
+    for name in SEARCH_FACETS:
+        counts = {}
+        for result in results:
+            for row in result[name]:
+                counts[row["value"]] = counts.get(row["value"], 0) + row["count"]
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+        merged[name] = [{"value": value, "count": count} for value, count in ranked[:SEARCH_FACET_SIZE]]
+    counts = {}
+    for result in results:
+        for row in result["price_ranges"]:
+            counts[row["min"]] = counts.get(row["min"], 0) + row["count"]
+    # The "other" bucket sorts after the numeric boundaries
+    ordered = sorted(counts.items(), key=lambda item: (isinstance(item[0], str), str(item[0]).zfill(8)))
+    merged["price_ranges"] = [{"min": value, "count": count} for value, count in ordered]
+    return merged
+
+async def search_page(
+    database,
+    query: dict,
+    sort_field: str,
+    descending: bool,
+    limit: int,
+    position: Optional[tuple],
+    projection: dict,
+    period: Optional[tuple]
+) -> List[dict]:
+    """Up to limit + 1 matching cars after `position` (sort value, car_id), skipping cars booked for `period`."""
+    direction = DESCENDING if descending else ASCENDING
+    op = "$lt" if descending else "$gt"
+    cars = []
+    while True:
+        page_query = query
+        if position:
+            value, last_id = position
+            page_query = {**query, "$or": [
+                {sort_field: {op: value}},
+                {sort_field: value, "car_id": {op: last_id}},
+            ]}
+        batch = await database.cars.find(page_query, projection).sort(
+            [(sort_field, direction), ("car_id", direction)]
+        ).limit(limit + 1).to_list(length=None)
+        if period and batch:
+            booked = await database.bookings.distinct("car_id", {
+                "car_id": {"$in": [car["car_id"] for car in batch]},
+                **overlap_filter(*period),
+            })
+            cars += [car for car in batch if car["car_id"] not in booked]
+        else:
+            cars += batch
+        if len(cars) > limit or len(batch) <= limit:
+            return cars[:limit + 1]
+        position = (batch[-1][sort_field], batch[-1]["car_id"])
+
+# Idempotency keys
+# A retried POST carrying the same Idempotency-Key gets the first attempt's
+# response back instead of creating another booking. Keys live in Mongo
+# (expired by a TTL index) so every worker sees them; completed outcomes are
+# also kept in a small in-process cache so hot retries skip the round trip.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# An in-progress claim older than this belongs to a request that died; a retry may take it over
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))
+idempotency_cache = TTLCache(
+    int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")),
+    min(IDEMPOTENCY_TTL_SECONDS, 600)
+)
+
+async def claim_idempotency_key(key: str, request_hash: str) -> Optional[dict]:
+    """Reserve the key for this request, or return the stored outcome of an earlier one."""
+    record = idempotency_cache.get(key)
+    if record is None:
+        now = datetime.utcnow()
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": key,
+                "request_hash": request_hash,
+                "state": "in_progress",
+                "created_at": now,
+                "claimed_at": now
+            })
+            return None
+        except DuplicateKeyError:
+            record = await db.idempotency_keys.find_one({"_id": key})
+            if record is None:
+                # Expired or released between the insert and the read
+                return await claim_idempotency_key(key, request_hash)
+    
+    if record["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    if record["state"] != "completed":
+        if record["claimed_at"] <= datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS):
+            taken = await db.idempotency_keys.update_one(
+                {"_id": key, "state": "in_progress", "claimed_at": record["claimed_at"]},
+                {"$set": {"claimed_at": datetime.utcnow()}}
+            )
+            if taken.modified_count:
+                return None
+            # Completed or taken over by another retry in the meantime
+            return await claim_idempotency_key(key, request_hash)
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is still in progress",
+            headers={"Retry-After": "1"}
+        )
+    idempotency_cache.set(key, record)
+    return record
+
+async def complete_idempotency_key(key: str, request_hash: str, status_code: int, body: dict):
+    record = {
+        "request_hash": request_hash,
+        "state": "completed",
+        "status_code": status_code,
+        "body": body
+    }
+    await db.idempotency_keys.update_one({"_id": key}, {"$set": record})
+    idempotency_cache.set(key, record)
+
+async def release_idempotency_key(key: str):
+    await db.idempotency_keys.delete_one({"_id": key})
+
+def is_final_outcome(status_code: int) -> bool:
+    """Whether an error is stored for replay; 429 and 5xx ask the client to retry instead."""
+    return status_code < 500 and status_code != 429
+
+def replay_idempotent_response(record: dict):
+    headers = {"Idempotent-Replayed": "true"}
+    if record["status_code"] >= 400:
+        raise HTTPException(status_code=record["status_code"], detail=record["body"]["detail"], headers=headers)
+    return ORJSONResponse(record["body"], status_code=record["status_code"], headers=headers)
+
+# Rate limiting
+# Token buckets keyed by client IP and, where the route names one, by agency_id,
+# so a single scraper or one agency's traffic spike cannot take the whole Mongo
+# pool. Limits are "capacity/seconds": bursts of up to `capacity` requests,
+# refilled at that many per `seconds`. Buckets live in-process unless
+# RATE_LIMIT_REDIS_URL points every worker at a shared Redis.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Only enable behind a proxy that overwrites X-Forwarded-For
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+def parse_limit(value: str) -> tuple:
+    capacity, seconds = value.split("/")
+    return int(capacity), int(capacity) / float(seconds)
+
+# route group -> {scope: (capacity, tokens per second)}
+RATE_LIMITS = {
+    "login": {
+        "ip": parse_limit(os.getenv("RATE_LIMIT_LOGIN_IP", "10/60")),
+    },
+    "public_read": {
+        "ip": parse_limit(os.getenv("RATE_LIMIT_PUBLIC_READ_IP", "120/60")),
+        "agency": parse_limit(os.getenv("RATE_LIMIT_PUBLIC_READ_AGENCY", "1200/60")),
+    },
+    "public_write": {
+        "ip": parse_limit(os.getenv("RATE_LIMIT_PUBLIC_WRITE_IP", "20/60")),
+        "agency": parse_limit(os.getenv("RATE_LIMIT_PUBLIC_WRITE_AGENCY", "300/60")),
+    },
+}
+
+RATE_LIMIT_REJECTIONS = Counter(
+    "rate_limit_rejections_total", "Requests refused by the rate limiter", ["group", "scope"]
+)
+
+class InProcessRateLimiter:
+    def __init__(self, max_buckets: int):
+        # An evicted or expired bucket would have refilled anyway, so the TTL
+        # is just the longest refill time of any configured limit
+        longest_refill = max(
+            capacity / rate for limits in RATE_LIMITS.values() for capacity, rate in limits.values()
+        )
+        self._buckets = TTLCache(max_buckets, longest_refill)
+
+    async def acquire(self, key: str, capacity: int, rate: float) -> float:
+        """Take one token; return 0 if granted, else seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._buckets.set(key, (tokens, now))
+            return (1 - tokens) / rate
+        self._buckets.set(key, (tokens - 1, now))
+        return 0.0
+
+    async def refund(self, key: str, capacity: int):
+        """Give back a token taken by acquire()."""
+        bucket = self._buckets.get(key)
+        if bucket:
+            tokens, updated = bucket
+            self._buckets.set(key, (min(capacity, tokens + 1), updated))
+
+class RedisRateLimiter:
+    """Shared buckets so the limits hold across every worker, not per worker."""
+
+    # Refill and take in one round trip; Redis runs scripts atomically
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens < 1 then
+        wait = (1 - tokens) / rate
+    else
+        tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+    return tostring(wait)
+    """
+    REFUND_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+    if tokens then
+        redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+    end
+    """
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        # Optional dependency, only needed when RATE_LIMIT_REDIS_URL is set
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+        self._refund_script = self._redis.register_script(self.REFUND_SCRIPT)
+        self._prefix = prefix
+
+    async def acquire(self, key: str, capacity: int, rate: float) -> float:
+        return float(await self._script(keys=[self._prefix + key], args=[capacity, rate]))
+
+    async def refund(self, key: str, capacity: int):
+        await self._refund_script(keys=[self._prefix + key], args=[capacity])
+
+if RATE_LIMIT_REDIS_URL:
+    rate_limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL)
+else:
+    rate_limiter = InProcessRateLimiter(RATE_LIMIT_MAX_BUCKETS)
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+async def charge_rate_limit(group: str, scope: str, value: str):
+    """Take one token from a bucket, refusing with 429 when it is empty."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    capacity, rate = RATE_LIMITS[group][scope]
+    wait = await rate_limiter.acquire(f"{group}:{scope}:{value}", capacity, rate)
+    if wait:
+        RATE_LIMIT_REJECTIONS.labels(group, scope).inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please retry later",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+async def refund_rate_limit(group: str, scope: str, value: str):
+    """Return a token to a bucket for a request refused by a later bucket."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    capacity, _ = RATE_LIMITS[group][scope]
+    await rate_limiter.refund(f"{group}:{scope}:{value}", capacity)
+
+def rate_limit(group: str):
+    """Dependency refusing requests with 429 once the route group's buckets run dry.
+
+    The agency bucket is charged here when the path or query names the agency;
+    routes that learn it from the body charge it themselves.
+    """
+    limits = RATE_LIMITS[group]
+    
+    async def check(request: Request):
+        ip = client_ip(request)
+        await charge_rate_limit(group, "ip", ip)
+        agency_id = request.path_params.get("agency_id") or request.query_params.get("agency_id")
+        if agency_id and "agency" in limits:
+            try:
+                await charge_rate_limit(group, "agency", agency_id)
+            except HTTPException:
+                # A throttled agency must not spend the caller's quota for other agencies
+                await refund_rate_limit(group, "ip", ip)
+                raise
+    
+    return check
+
+# Background jobs
+# Side effects of a write (emails, notifications, audit entries) are recorded
+# in the outbox collection by the request and run later by worker tasks, so
+# the request never waits on them and they survive a restart. Workers claim a
+# due job by pushing its run_after forward by a lease; a job whose worker died
+# becomes due again when the lease runs out, so delivery is at-least-once.
+#
+# Jobs are written in the same insert as the document that causes them, in its
+# pending_jobs field, and the request then moves them into the outbox. The
+# outbox sits in the control database while cars and bookings may live on
+# another tenant target, so no transaction could span both writes; instead a
+# sweeper moves the jobs of any document whose request died before it did.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "8"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "900"))
+OUTBOX_SWEEP_SECONDS = int(os.getenv("OUTBOX_SWEEP_SECONDS", "60"))
+OUTBOX_SWEEP_BATCH_SIZE = 500
+PENDING_JOB_COLLECTIONS = ["agencies", "cars", "bookings"]
+
+JOBS_PROCESSED = Counter("jobs_processed_total", "Background jobs finished", ["type", "outcome"])
+JOB_DURATION = Histogram("job_duration_seconds", "Background job run time", ["type"])
+JOBS_IN_FLIGHT = Gauge("jobs_in_flight", "Background jobs currently running")
+JOB_QUEUE_DEPTH = Gauge("job_queue_depth", "Outbox jobs waiting to run", ["status"])
+
+JOB_HANDLERS = {}
+job_wakeup = asyncio.Event()
+job_workers = []
+
+def job_handler(job_type: str):
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+def outbox_jobs(*jobs: tuple) -> List[dict]:
+    """Outbox documents for (type, payload) jobs, to store in a document's pending_jobs."""
+    now = datetime.utcnow()
+    return [{
+        "_id": str(uuid.uuid4()),
+        "type": job_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "run_after": now,
+        "created_at": now
+    } for job_type, payload in jobs]
+
+async def deliver_jobs(collection, key: dict, jobs: List[dict]):
+    """Move a document's pending jobs into the outbox and wake the local workers."""
+    try:
+        await db.outbox.insert_many(jobs, ordered=False)
+    except BulkWriteError as e:
+        # Moved already by an earlier attempt or the sweeper
+        if any(error["code"] != DUPLICATE_KEY_CODE for error in e.details["writeErrors"]):
+            raise
+    await collection.update_one(key, {"$unset": {"pending_jobs": ""}})
+    job_wakeup.set()
+
+async def sweep_pending_jobs():
+    while True:
+        cutoff = datetime.utcnow() - timedelta(seconds=OUTBOX_SWEEP_SECONDS)
+        try:
+            for collection_name in PENDING_JOB_COLLECTIONS:
+                databases = [target.db for target in all_targets()] if collection_name in TENANT_COLLECTIONS else [db]
+                for database in databases:
+                    stranded = database[collection_name].find(
+                        {"pending_jobs": {"$exists": True}, "created_at": {"$lt": cutoff}},
+                        {"pending_jobs": 1}
+                    ).limit(OUTBOX_SWEEP_BATCH_SIZE)
+                    async for document in stranded:
+                        await deliver_jobs(database[collection_name], {"_id": document["_id"]}, document["pending_jobs"])
+        except PyMongoError as e:
+            logger.warning("Outbox sweep failed: %s", e)
+        await asyncio.sleep(OUTBOX_SWEEP_SECONDS)
+
+def retry_delay(attempts: int) -> float:
+    delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+    # Jitter keeps jobs that failed together from retrying in lockstep
+    return delay * random.uniform(0.5, 1.0)
+
+async def claim_job() -> Optional[dict]:
+    now = datetime.utcnow()
+    return await db.outbox.find_one_and_update(
+        {"status": "pending", "run_after": {"$lte": now}},
+        {
+            "$set": {"run_after": now + timedelta(seconds=JOB_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_after", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def run_job(job: dict):
+    handler = JOB_HANDLERS.get(job["type"])
+    JOBS_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job type {job['type']}")
+        await handler(job["payload"], job["_id"])
+    except Exception as e:
+        logger.warning("Job %s (%s) failed on attempt %d: %s", job["_id"], job["type"], job["attempts"], e)
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            JOBS_PROCESSED.labels(job["type"], "failed").inc()
+            update = {"status": "failed", "last_error": str(e)}
+        else:
+            JOBS_PROCESSED.labels(job["type"], "retried").inc()
+            run_after = datetime.utcnow() + timedelta(seconds=retry_delay(job["attempts"]))
+            update = {"run_after": run_after, "last_error": str(e)}
+        await db.outbox.update_one({"_id": job["_id"]}, {"$set": update})
+    else:
+        JOBS_PROCESSED.labels(job["type"], "succeeded").inc()
+        await db.outbox.delete_one({"_id": job["_id"]})
+    finally:
+        JOBS_IN_FLIGHT.dec()
+        JOB_DURATION.labels(job["type"]).observe(time.perf_counter() - started)
+
+async def job_worker():
+    while True:
+        try:
+            job = await claim_job()
+            if job is not None:
+                await run_job(job)
+                continue
+        except PyMongoError as e:
+            logger.warning("Background job queue error: %s", e)
+        job_wakeup.clear()
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+async def sample_queue_depth():
+    while True:
+        try:
+            for job_status in ("pending", "failed"):
+                JOB_QUEUE_DEPTH.labels(job_status).set(await db.outbox.count_documents({"status": job_status}))
+        except PyMongoError as e:
+            logger.warning("Could not sample the job queue depth: %s", e)
+        await asyncio.sleep(JOB_POLL_SECONDS)
+
+def start_job_workers():
+    job_workers.extend(asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS))
+    job_workers.append(asyncio.create_task(sample_queue_depth()))
+    job_workers.append(asyncio.create_task(sweep_pending_jobs()))
+
+async def stop_job_workers():
+    # A job cut off here is retried once its lease expires
+    for task in job_workers:
+        task.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    job_workers.clear()
+
+# Mail
+# MAIL_BACKEND=local keeps sent messages in memory (see GET /api/admin/mail)
+# for development and tests; MAIL_BACKEND=smtp delivers through SMTP_HOST.
+MAIL_BACKEND = os.getenv("MAIL_BACKEND", "local")
+MAIL_FROM = os.getenv("MAIL_FROM", "no-reply@carrentalsaas.com")
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+LOCAL_MAIL_SINK_SIZE = int(os.getenv("LOCAL_MAIL_SINK_SIZE", "1000"))
+
+class LocalMailSink:
+    def __init__(self, max_messages: int):
+        self.messages = deque(maxlen=max_messages)
+
+    async def send(self, to: str, subject: str, body: str):
+        self.messages.append({"to": to, "subject": subject, "body": body, "sent_at": datetime.utcnow()})
+        logger.info("Mail to %s: %s", to, subject)
+
+class SmtpMailSink:
+    def _send(self, message: EmailMessage):
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as smtp:
+            if SMTP_USERNAME:
+                smtp.starttls()
+                smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+            smtp.send_message(message)
+
+    async def send(self, to: str, subject: str, body: str):
+        message = EmailMessage()
+        message["From"] = MAIL_FROM
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        await asyncio.get_running_loop().run_in_executor(None, self._send, message)
+
+mail_sink = SmtpMailSink() if MAIL_BACKEND == "smtp" else LocalMailSink(LOCAL_MAIL_SINK_SIZE)
+
+# Job handlers receive the payload and the job id; handlers that write use the
+# job id as the document _id so a retried job does not write twice.
+@job_handler("audit_log")
+async def write_audit_entry(payload: dict, job_id: str):
+    try:
+        await db.audit_log.insert_one({"_id": job_id, **payload})
+    except DuplicateKeyError:
+        pass
+
+async def job_tenant_db(payload: dict):
+    return (await tenant(payload["agency_id"])).db
+
+async def find_job_booking(tenant_db, payload: dict) -> dict:
+    booking = await tenant_db.bookings.find_one({"booking_id": payload["booking_id"]}, {"_id": 0})
+    if booking is None:
+        # Retried: mid-migration the booking may not be on the resolved target yet
+        raise LookupError(f"Booking {payload['booking_id']} not found")
+    return booking
+
+@job_handler("booking_confirmation")
+async def send_booking_confirmation(payload: dict, job_id: str):
+    tenant_db = await job_tenant_db(payload)
+    booking = await find_job_booking(tenant_db, payload)
+    car = await tenant_db.cars.find_one({"car_id": booking["car_id"]}, {"_id": 0, "title": 1})
+    await mail_sink.send(
+        booking["client_email"],
+        f"Booking request received: {car['title'] if car else 'your car'}",
+        f"Hi {booking['client_name']},\n\n"
+        f"We received your booking request {booking['booking_id']} for "
+        f"{booking['pickup_date']:%Y-%m-%d} to {booking['return_date']:%Y-%m-%d}. "
+        f"The agency will confirm it shortly.\n\nTotal: {booking['total_amount']:.2f}\n"
+    )
+
+@job_handler("agency_booking_notification")
+async def notify_agency_of_booking(payload: dict, job_id: str):
+    booking = await find_job_booking(await job_tenant_db(payload), payload)
+    agency = await db.agencies.find_one({"agency_id": booking["agency_id"]}, {"_id": 0, "email": 1})
+    if agency is None:
+        return
+    await mail_sink.send(
+        agency["email"],
+        f"New booking request from {booking['client_name']}",
+        f"Booking {booking['booking_id']} for car {booking['car_id']} from "
+        f"{booking['pickup_date']:%Y-%m-%d} to {booking['return_date']:%Y-%m-%d} is awaiting confirmation.\n"
+        f"Client: {booking['client_name']} <{booking['client_email']}>, {booking['client_phone']}\n"
+    )
+
+@job_handler("agency_welcome")
+async def send_agency_welcome(payload: dict, job_id: str):
+    agency = await db.agencies.find_one({"agency_id": payload["agency_id"]}, {"_id": 0})
+    if agency is None:
+        raise LookupError(f"Agency {payload['agency_id']} not found")
+    await mail_sink.send(
+        agency["email"],
+        f"Welcome to Car Rental SaaS, {agency['name']}",
+        f"Your agency {agency['name']} is set up. Your public booking page is /book/{agency['agency_id']}.\n"
+    )
+
+def audit_job(event: str, actor_id: Optional[str], agency_id: Optional[str], **details) -> tuple:
+    return ("audit_log", {
+        "event": event,
+        "actor_id": actor_id,
+        "agency_id": agency_id,
+        "details": details,
+        "created_at": datetime.utcnow()
+    })
+
+# Live events
+# Agency dashboards hold one SSE stream each. Writes publish to an in-process
+# broker that fans out to the streams of that agency; every stream has a
+# bounded buffer, and a dashboard that falls behind gets a single "resync"
+# event telling it to refetch instead of an ever-growing backlog. With
+# EVENTS_CHANGE_STREAM=true (replica sets only) a change stream feeds the
+# broker instead, so a write on any worker reaches dashboards on every worker.
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "64"))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+EVENTS_CHANGE_STREAM = os.getenv("EVENTS_CHANGE_STREAM", "false").lower() == "true"
+
+RESYNC_EVENT = {"type": "resync", "data": {}}
+
+class EventBroker:
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self._subscribers = {}
+
+    def subscribe(self, agency_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        self._subscribers.setdefault(agency_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, agency_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(agency_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[agency_id]
+
+    def publish(self, agency_id: str, event: dict):
+        for queue in self._subscribers.get(agency_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The backlog is useless to a client that has to refetch anyway
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC_EVENT)
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+event_broker = EventBroker(EVENT_BUFFER_SIZE)
+EVENTS_PUBLISHED = Counter("events_published_total", "Live events published to dashboards", ["type"])
+Gauge("event_subscribers", "Open live event streams").set_function(event_broker.subscriber_count)
+
+def publish_event(agency_id: str, event_type: str, data: dict):
+    """Publish from a route; a no-op when the change stream is the source instead."""
+    if not EVENTS_CHANGE_STREAM:
+        EVENTS_PUBLISHED.labels(event_type).inc()
+        event_broker.publish(agency_id, {"type": event_type, "data": data})
+
+def format_sse(event: dict) -> bytes:
+    return b"event: " + event["type"].encode() + b"\ndata: " + orjson.dumps(event["data"]) + b"\n\n"
+
+# change stream (collection, operation) -> (event type, response model)
+CHANGE_STREAM_EVENTS = {
+    ("bookings", "insert"): ("booking.created", BookingOut),
+    ("bookings", "update"): ("booking.updated", BookingOut),
+    ("bookings", "replace"): ("booking.updated", BookingOut),
+    ("cars", "insert"): ("car.created", CarOut),
+    ("cars", "update"): ("car.updated", CarOut),
+    ("cars", "replace"): ("car.updated", CarOut),
+}
+
+def publish_change(change: dict):
+    document = change.get("fullDocument")
+    if document is None:
+        return
+    if change["ns"]["coll"] == "agencies":
+        EVENTS_PUBLISHED.labels("agency.status").inc()
+        event_broker.publish(document["agency_id"], {"type": "agency.status", "data": {"status": document["status"]}})
+        return
+    event_type, model = CHANGE_STREAM_EVENTS[(change["ns"]["coll"], change["operationType"])]
+    key = "booking" if model is BookingOut else "car"
+    data = {key: model.model_validate(document).model_dump(mode="json")}
+    EVENTS_PUBLISHED.labels(event_type).inc()
+    event_broker.publish(document["agency_id"], {"type": event_type, "data": data})
+
+async def watch_changes(target: TenantTarget):
+    pipeline = [{"$match": {"$or": [
+        {
+            "ns.coll": {"$in": ["bookings", "cars"]},
+            "operationType": {"$in": ["insert", "update", "replace"]},
+            # Moving a new document's jobs to the outbox is not a change to show
+            "$nor": [{
+                "operationType": "update",
+                "updateDescription.updatedFields": {},
+                "updateDescription.removedFields": ["pending_jobs"],
+            }],
+        },
+        # Agencies live in the control database, which the default target watches
+        {
+            "ns.coll": "agencies",
+            "operationType": "update",
+            "updateDescription.updatedFields.status": {"$exists": True},
+        },
+    ]}}]
+    resume_token = None
+    while True:
+        try:
+            async with target.db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    try:
+                        publish_change(change)
+                    except Exception as e:
+                        # One malformed document must not end the stream for every dashboard
+                        logger.warning("Skipped change %s on %s: %s", change.get("_id"), target.name, e)
+        except PyMongoError as e:
+            logger.warning("Change stream on %s interrupted, resuming: %s", target.name, e)
+            await asyncio.sleep(1)
+
+# Archival
+# Returned and cancelled bookings that ended more than ARCHIVE_AFTER_DAYS ago
+# move to bookings_archive (zstd-compressed, list indexes only), keeping the
+# hot collection and its indexes sized to recent activity. Rollup counters are
+# never decremented by a move, and rebuild_rollups() reads both collections.
+# An archived booking returned before the watermark, so it was also picked up
+# before it: lists and exports whose range starts at or after the watermark
+# never touch the archive. Off (0) until an operator opts in, since from the
+# first run on unbounded bookings lists also read the archive.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_HOURS", "24")) * 3600
+ARCHIVE_CHECK_SECONDS = 600
+# Other workers reload the watermark every ARCHIVE_CHECK_SECONDS; moving waits
+# until all of them have seen a raised one, with a margin for a slow reload
+ARCHIVE_WATERMARK_SETTLE_SECONDS = ARCHIVE_CHECK_SECONDS + 60
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVABLE_BOOKING_STATUSES = ["returned", "cancelled"]
+ARCHIVE_COLLECTION = "bookings_archive"
+
+# Newest cutoff any archival run has used, loaded at startup and after each run
+archive_watermark = None
+
+def archive_cutoff() -> datetime:
+    return datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+def needs_archive(start: Optional[datetime]) -> bool:
+    """Whether a range beginning at `start` (None: unbounded) can include archived bookings."""
+    if archive_watermark is None:
+        return False
+    return start is None or start < archive_watermark
+
+async def load_archive_watermark():
+    global archive_watermark
+    state = await db.archive_state.find_one({"_id": "bookings"})
+    archive_watermark = state["archived_before"] if state else None
+
+async def ensure_archive_collection(database):
+    if await database.list_collection_names(filter={"name": ARCHIVE_COLLECTION}):
+        return
+    try:
+        await database.create_collection(
+            ARCHIVE_COLLECTION,
+            storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+        )
+    except CollectionInvalid:
+        pass  # Created concurrently by another worker
+
+async def archive_bookings(settle: bool = True) -> int:
+    """Move archivable bookings to the archive in batches; safe to rerun after a crash.
+
+    settle=False skips waiting for other workers to load a raised watermark,
+    which is only safe while no API workers are running.
+    """
+    cutoff = archive_cutoff()
+    # Raise the watermark, and let every worker load it, before moving
+    # anything, so no reader skips the archive for a booking moved under it
+    result = await db.archive_state.update_one(
+        {"_id": "bookings"}, {"$max": {"archived_before": cutoff}}, upsert=True
+    )
+    await load_archive_watermark()
+    if settle and (result.modified_count or result.upserted_id is not None):
+        await asyncio.sleep(ARCHIVE_WATERMARK_SETTLE_SECONDS)
+    
+    moved = 0
+    for target in all_targets():
+        moved += await archive_target_bookings(target.db, cutoff)
+    return moved
+
+async def archive_target_bookings(database, cutoff: datetime) -> int:
+    moved = 0
+    while True:
+        batch = await database.bookings.find({
+            "status": {"$in": ARCHIVABLE_BOOKING_STATUSES},
+            "return_date": {"$lt": cutoff}
+        }).limit(ARCHIVE_BATCH_SIZE).to_list(length=None)
+        if not batch:
+            break
+        archived_at = datetime.utcnow()
+        for booking in batch:
+            booking["archived_at"] = archived_at
+        try:
+            await database[ARCHIVE_COLLECTION].insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Copied by an earlier run that stopped before deleting
+            if any(error["code"] != DUPLICATE_KEY_CODE for error in e.details["writeErrors"]):
+                raise
+        await database.bookings.delete_many({"_id": {"$in": [booking["_id"] for booking in batch]}})
+        moved += len(batch)
+    return moved
+
+async def claim_archive_run() -> bool:
+    """Let one worker per interval run the archival."""
+    now = datetime.utcnow()
+    try:
+        await db.archive_state.update_one(
+            {"_id": "schedule", "next_run": {"$lte": now}},
+            {"$set": {"next_run": now + timedelta(seconds=ARCHIVE_INTERVAL_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The schedule exists and is not due: another worker ran this interval
+        return False
+
+async def archive_periodically():
+    while True:
+        try:
+            if await claim_archive_run():
+                moved = await archive_bookings()
+                logger.info("Archived %d bookings", moved)
+            else:
+                await load_archive_watermark()
+        except PyMongoError as e:
+            logger.warning("Booking archival failed: %s", e)
+        await asyncio.sleep(ARCHIVE_CHECK_SECONDS)
+
+async def merge_sorted(cursors: list, key: Callable):
+    """Merge async iterables that are each sorted by `key` into one sorted stream."""
+    iterators = [cursor.__aiter__() for cursor in cursors]
+    heads = {}
+    for index, iterator in enumerate(iterators):
+        try:
+            heads[index] = await iterator.__anext__()
+        except StopAsyncIteration:
+            pass
+    while heads:
+        index = min(heads, key=lambda i: key(heads[i]))
+        yield heads[index]
+        try:
+            heads[index] = await iterators[index].__anext__()
+        except StopAsyncIteration:
+            del heads[index]
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-security = HTTPBearer()
+# Index management
+# Every query shape the routes issue must be served by one of these indexes;
+# ensure_indexes() creates missing ones on startup, while
+# `python server.py --check-indexes` also rebuilds changed definitions and
+# explains QUERY_SHAPES to catch collection scans.
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("role", ASCENDING)], name="role"),
+    ],
+    "agencies": [
+        IndexModel([("agency_id", ASCENDING)], name="agency_id_unique", unique=True),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("created_at", DESCENDING), ("agency_id", DESCENDING)], name="created_at"),
+        IndexModel([("name", ASCENDING), ("agency_id", ASCENDING)], name="name"),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="pending_jobs",
+            partialFilterExpression={"pending_jobs": {"$exists": True}},
+        ),
+    ],
+    "cars": [
+        IndexModel([("car_id", ASCENDING)], name="car_id_unique", unique=True),
+        IndexModel(
+            [("agency_id", ASCENDING), ("plate_number", ASCENDING)],
+            name="agency_plate_unique",
+            unique=True,
+        ),
+        IndexModel([("agency_id", ASCENDING), ("status", ASCENDING)], name="agency_status"),
+        IndexModel(
+            [("agency_id", ASCENDING), ("created_at", DESCENDING), ("car_id", DESCENDING)],
+            name="agency_created_at",
+        ),
+        IndexModel(
+            [("agency_id", ASCENDING), ("price_per_day", ASCENDING), ("car_id", ASCENDING)],
+            name="agency_price",
+        ),
+        # Catalog search across tenants
+        IndexModel(
+            [("title", TEXT), ("brand", TEXT), ("model", TEXT)],
+            name="catalog_text",
+            weights={"brand": 5, "model": 5, "title": 1},
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("price_per_day", ASCENDING), ("car_id", ASCENDING)],
+            name="status_price",
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("year", ASCENDING), ("car_id", ASCENDING)],
+            name="status_year",
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("brand", ASCENDING), ("price_per_day", ASCENDING)],
+            name="status_brand_price",
+        ),
+        IndexModel(
+            [("status", ASCENDING), ("features", ASCENDING), ("price_per_day", ASCENDING)],
+            name="status_features_price",
+        ),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="pending_jobs",
+            partialFilterExpression={"pending_jobs": {"$exists": True}},
+        ),
+    ],
+    "bookings": [
+        IndexModel([("booking_id", ASCENDING)], name="booking_id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("return_date", ASCENDING)], name="status_return"),
+        IndexModel(
+            [("agency_id", ASCENDING), ("created_at", DESCENDING), ("booking_id", DESCENDING)],
+            name="agency_created_at",
+        ),
+        IndexModel(
+            [("agency_id", ASCENDING), ("pickup_date", DESCENDING), ("booking_id", DESCENDING)],
+            name="agency_pickup",
+        ),
+        IndexModel(
+            [("car_id", ASCENDING), ("pickup_date", ASCENDING), ("return_date", ASCENDING)],
+            name="car_pickup_return",
+        ),
+        IndexModel(
+            [("agency_id", ASCENDING), ("return_date", ASCENDING), ("pickup_date", ASCENDING)],
+            name="agency_return_pickup",
+        ),
+        IndexModel([("return_date", ASCENDING), ("pickup_date", ASCENDING)], name="return_pickup"),
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="pending_jobs",
+            partialFilterExpression={"pending_jobs": {"$exists": True}},
+        ),
+    ],
+    ARCHIVE_COLLECTION: [
+        IndexModel([("booking_id", ASCENDING)], name="booking_id_unique", unique=True),
+        IndexModel(
+            [("agency_id", ASCENDING), ("created_at", DESCENDING), ("booking_id", DESCENDING)],
+            name="agency_created_at",
+        ),
+        IndexModel(
+            [("agency_id", ASCENDING), ("pickup_date", DESCENDING), ("booking_id", DESCENDING)],
+            name="agency_pickup",
+        ),
+    ],
+    "daily_rollups": [
+        IndexModel([("scope", ASCENDING), ("day", ASCENDING)], name="scope_day_unique", unique=True),
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS),
+    ],
+    "outbox": [
+        IndexModel([("status", ASCENDING), ("run_after", ASCENDING)], name="status_run_after"),
+    ],
+    "pricing_rules": [
+        IndexModel([("agency_id", ASCENDING)], name="agency_id_unique", unique=True),
+    ],
+    "tenant_routes": [
+        IndexModel([("agency_id", ASCENDING)], name="agency_id_unique", unique=True),
+    ],
+    "reservation_slots": [
+        IndexModel([("car_id", ASCENDING), ("day", ASCENDING)], name="car_day_unique", unique=True),
+        IndexModel([("booking_id", ASCENDING)], name="booking_id"),
+        IndexModel([("claimed_at", ASCENDING)], name="claimed_at_ttl", expireAfterSeconds=RESERVATION_LOCK_SECONDS),
+    ],
+}
 
-# User roles
-class UserRole:
-    SUPER_ADMIN = "super_admin"
-    AGENCY_ADMIN = "agency_admin"
-    STAFF = "staff"
-    CLIENT = "client"
+# Collections that live on every tenant target rather than only in `db`
+TENANT_COLLECTIONS = ["cars", "bookings", ARCHIVE_COLLECTION, "reservation_slots"]
 
-# Pydantic models
-class UserCreate(BaseModel):
-    email: EmailStr
-    password: str
-    first_name: str
-    last_name: str
-    role: str = UserRole.CLIENT
-    agency_id: Optional[str] = None
+# (collection, filter, sort) for each query issued by the routes
+QUERY_SHAPES = [
+    ("users", {"email": "shape@example.com"}, None),
+    ("users", {"user_id": "shape"}, None),
+    ("users", {"role": UserRole.SUPER_ADMIN}, None),
+    ("agencies", {"agency_id": "shape"}, None),
+    ("agencies", {"status": "active"}, None),
+    ("cars", {"car_id": "shape"}, None),
+    ("cars", {"agency_id": "shape"}, None),
+    ("cars", {"agency_id": "shape", "status": "available"}, None),
+    ("agencies", {}, [("created_at", DESCENDING), ("agency_id", DESCENDING)]),
+    ("agencies", {}, [("name", ASCENDING), ("agency_id", ASCENDING)]),
+    ("cars", {"agency_id": "shape"}, [("created_at", DESCENDING), ("car_id", DESCENDING)]),
+    ("cars", {"agency_id": "shape"}, [("price_per_day", ASCENDING), ("car_id", ASCENDING)]),
+    ("bookings", {"agency_id": "shape"}, [("created_at", DESCENDING), ("booking_id", DESCENDING)]),
+    ("bookings", {"agency_id": "shape"}, [("pickup_date", DESCENDING), ("booking_id", DESCENDING)]),
+    ("bookings", {"agency_id": "shape"}, [("pickup_date", ASCENDING), ("booking_id", ASCENDING)]),
+    ("cars", {"agency_id": "shape"}, [("created_at", ASCENDING), ("car_id", ASCENDING)]),
+    ("bookings", {"agency_id": "shape", "pickup_date": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 8)}}, None),
+    ("bookings", {"agency_id": "shape", "return_date": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 8)}}, None),
+    ("bookings", overlap_filter(datetime(2024, 1, 1), datetime(2024, 1, 8)), None),
+    ("cars", {"status": "available", "price_per_day": {"$gte": 20, "$lte": 80}},
+     [("price_per_day", ASCENDING), ("car_id", ASCENDING)]),
+    ("cars", {"status": "available"}, [("year", DESCENDING), ("car_id", DESCENDING)]),
+    ("cars", {"status": "available", "brand": {"$in": ["Toyota"]}}, [("price_per_day", ASCENDING), ("car_id", ASCENDING)]),
+    ("cars", {"status": "available", "features": {"$all": ["GPS"]}}, [("price_per_day", ASCENDING), ("car_id", ASCENDING)]),
+    ("cars", {"status": "available", "$text": {"$search": "corolla"}}, None),
+    ("daily_rollups", {"scope": GLOBAL_SCOPE, "day": {"$gte": "2024-01-01", "$lte": "2024-01-31"}}, None),
+    ("bookings", {"status": {"$in": ARCHIVABLE_BOOKING_STATUSES}, "return_date": {"$lt": datetime(2024, 1, 1)}}, None),
+    (ARCHIVE_COLLECTION, {"agency_id": "shape"}, [("created_at", DESCENDING), ("booking_id", DESCENDING)]),
+    (ARCHIVE_COLLECTION, {"agency_id": "shape"}, [("pickup_date", ASCENDING), ("booking_id", ASCENDING)]),
+    ("outbox", {"status": "pending", "run_after": {"$lte": datetime(2024, 1, 1)}}, [("run_after", ASCENDING)]),
+    *((name, {"pending_jobs": {"$exists": True}, "created_at": {"$lt": datetime(2024, 1, 1)}}, None)
+      for name in ("agencies", "cars", "bookings")),
+    ("bookings", {"car_id": "shape", **overlap_filter(datetime(2024, 1, 1), datetime(2024, 1, 8))}, None),
+    ("bookings", {"car_id": {"$in": ["shape"]}, **overlap_filter(datetime(2024, 1, 1), datetime(2024, 1, 8))}, None),
+    ("bookings", {"agency_id": "shape", **overlap_filter(datetime(2024, 1, 1), datetime(2024, 1, 8))}, None),
+]
 
-class UserLogin(BaseModel):
-    email: EmailStr
-    password: str
+# Server error codes for an existing index whose options or keys differ
+INDEX_CONFLICT_CODES = (85, 86)
+INDEX_NOT_FOUND_CODE = 27
+DUPLICATE_KEY_CODE = 11000
 
-class AgencyCreate(BaseModel):
-    name: str
-    email: EmailStr
-    phone: str
-    address: str
-    description: Optional[str] = None
+async def ensure_indexes(rebuild: bool = False):
+    """Create missing indexes; with rebuild, also replace ones whose definition changed.
 
-class CarCreate(BaseModel):
-    title: str
-    model: str
-    brand: str
-    year: int
-    plate_number: str
-    color: str
-    price_per_day: float
-    features: List[str] = []
-    agency_id: str
+    Every worker runs this at startup, where a changed definition is only
+    logged: workers would race to drop the same index, and a dropped unique
+    index lets duplicates in until it is rebuilt.
+    """
+    for target in all_targets():
+        await ensure_archive_collection(target.db)
+    for collection_name, indexes in INDEXES.items():
+        databases = [target.db for target in all_targets()] if collection_name in TENANT_COLLECTIONS else [db]
+        for database in databases:
+            await ensure_collection_indexes(database[collection_name], indexes, rebuild)
 
-class BookingCreate(BaseModel):
-    car_id: str
-    client_email: EmailStr
-    client_name: str
-    client_phone: str
-    pickup_date: datetime
-    return_date: datetime
-    pickup_location: str
-    return_location: str
-    message: Optional[str] = None
+async def ensure_collection_indexes(collection, indexes: List[IndexModel], rebuild: bool = False):
+    collection_name = collection.full_name
+    existing = await collection.index_information()
+    for index in indexes:
+        name = index.document["name"]
+        try:
+            await collection.create_indexes([index])
+        except OperationFailure as e:
+            if e.code == DUPLICATE_KEY_CODE:
+                # Existing data violates a new unique index; keep serving
+                logger.warning("Cannot build unique index %s.%s: duplicate values exist", collection_name, name)
+                continue
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            if not rebuild:
+                logger.warning(
+                    "Index %s.%s differs from its definition; run --check-indexes to rebuild it",
+                    collection_name, name
+                )
+                continue
+            # Definition changed since it was created: rebuild it
+            try:
+                await collection.drop_index(name)
+            except OperationFailure as e:
+                if e.code != INDEX_NOT_FOUND_CODE:
+                    raise
+            await collection.create_indexes([index])
+            logger.info("Rebuilt index %s.%s", collection_name, name)
+    managed = {index.document["name"] for index in indexes} | {"_id_"}
+    for name in existing.keys() - managed:
+        logger.info("Unmanaged index %s.%s left in place", collection_name, name)
 
-# Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+def find_collscan(plan) -> bool:
+    # Walk every nested dict and list: the classic engine nests stages under
+    # inputStage/inputStages, while SBE wraps them as {"queryPlan", "slotBasedPlan"}
+    if isinstance(plan, list):
+        return any(find_collscan(item) for item in plan)
+    if not isinstance(plan, dict):
+        return False
+    if plan.get("stage") == "COLLSCAN":
+        return True
+    return any(find_collscan(value) for value in plan.values())
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def check_query_plans() -> List[str]:
+    """Explain every registered query shape and return the ones that scan a whole collection."""
+    failures = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        targets = all_targets() if collection_name in TENANT_COLLECTIONS else [tenant_targets[DEFAULT_TARGET]]
+        for target in targets:
+            cursor = target.db[collection_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = await cursor.explain()
+            if find_collscan(explain["queryPlanner"]["winningPlan"]):
+                failures.append(f"{target.name}/{collection_name}: {query} sort={sort}")
+    return failures
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
+# Tenant migration
+# `python server.py --migrate-agency <agency_id> <target>` moves one agency's
+# data between tenant targets while it keeps serving. A change stream opened
+# before the snapshot copy records every write made during it; the copy is
+# caught up from the stream, writes are frozen (503 + Retry-After) for a grace
+# period while the last changes drain, then the route flips. A write that
+# resolved the route before the freeze finishes within the request deadline
+# (MONGO_REQUEST_TIMEOUT_MS, which import batches also observe), so the grace
+# outlasts it. The stream keeps draining until every worker's route cache has
+# expired, and the source copy is deleted only if the destination holds at
+# least as many documents. Change streams need the source to be a replica set.
+MIGRATION_FREEZE_GRACE_SECONDS = max(
+    float(os.getenv("MIGRATION_FREEZE_GRACE_SECONDS", "0")), MONGO_REQUEST_TIMEOUT_MS / 1000 + 2
+)
+MIGRATION_BATCH_SIZE = 1000
+MIGRATION_DRAIN_INTERVAL_SECONDS = 1
+# Collections compared before the source copy is deleted; archival moves
+# bookings between the two in the second group, so they are counted together
+MIGRATION_COUNTED_COLLECTIONS = [["cars"], ["bookings", ARCHIVE_COLLECTION]]
+LATE_SKIPPED_COLLECTIONS = ["reservation_slots", ARCHIVE_COLLECTION]
+
+async def set_tenant_route(agency_id: str, target_name: str, state: str):
+    await db.tenant_routes.update_one(
+        {"agency_id": agency_id},
+        {"$set": {"target": target_name, "state": state, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    tenant_route_cache.invalidate(agency_id)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def write_migration_batch(collection, batch: list):
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
+        await collection.bulk_write(batch, ordered=False)
+    except BulkWriteError as e:
+        # Left over from an earlier attempt under another _id; the live copy wins
+        if any(error["code"] != DUPLICATE_KEY_CODE for error in e.details["writeErrors"]):
+            raise
+
+async def copy_agency_documents(source, destination, agency_id: str) -> int:
+    copied = 0
+    for collection_name in TENANT_COLLECTIONS:
+        batch = []
+        async for document in source[collection_name].find({"agency_id": agency_id}):
+            batch.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+            if len(batch) == MIGRATION_BATCH_SIZE:
+                await write_migration_batch(destination[collection_name], batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            await write_migration_batch(destination[collection_name], batch)
+            copied += len(batch)
+    return copied
+
+async def apply_migration_changes(stream, destination, agency_id: str, pending: list, late: bool = False) -> int:
+    """Replay the changes recorded so far; returns once the stream has no more.
+
+    Late changes, drained after the route flipped, only add documents the
+    destination lacks: it takes writes of its own by then, which an older
+    version replayed from the source must not overwrite.
+    """
+    applied = 0
+    while True:
+        change = pending.pop() if pending else await stream.try_next()
+        if change is None:
+            return applied
+        collection = destination[change["ns"]["coll"]]
+        if late:
+            # Slots are short-lived locks, and archival moves on the source only
+            # shuffle documents the destination's own archival will move
+            if change["ns"]["coll"] in LATE_SKIPPED_COLLECTIONS or not change.get("fullDocument"):
+                continue
+            try:
+                await collection.insert_one(change["fullDocument"])
+            except DuplicateKeyError:
+                logger.warning(
+                    "Late %s of %s %s not applied: the destination already has it",
+                    change["operationType"], change["ns"]["coll"], change["documentKey"]["_id"]
+                )
+                continue
+        elif change["operationType"] == "delete":
+            # Deletes carry only the _id; the agency filter skips other tenants' documents
+            await collection.delete_one({"_id": change["documentKey"]["_id"], "agency_id": agency_id})
+        elif change.get("fullDocument"):
+            document = change["fullDocument"]
+            await collection.replace_one({"_id": document["_id"]}, document, upsert=True)
+        applied += 1
+
+async def verify_migrated_copy(source, destination, agency_id: str):
+    """Refuse to delete the source copy if the destination lacks any of its documents."""
+    async def count(database, collection_names: List[str]) -> int:
+        counts = await asyncio.gather(*(
+            database[name].count_documents({"agency_id": agency_id}) for name in collection_names
+        ))
+        return sum(counts)
+    
+    for collection_names in MIGRATION_COUNTED_COLLECTIONS:
+        source_count, destination_count = await asyncio.gather(
+            count(source, collection_names), count(destination, collection_names)
+        )
+        if source_count > destination_count:
+            raise RuntimeError(
+                f"{' + '.join(collection_names)}: {source_count} documents on the source but only "
+                f"{destination_count} on the destination; kept the source copy of agency {agency_id}"
+            )
+
+async def delete_agency_documents(database, agency_id: str):
+    for collection_name in TENANT_COLLECTIONS:
+        await database[collection_name].delete_many({"agency_id": agency_id})
+
+async def migrate_agency(agency_id: str, target_name: str):
+    if not MONGO_REQUEST_TIMEOUT_MS:
+        raise RuntimeError("Migrating needs MONGO_REQUEST_TIMEOUT_MS: without it a write can land on the source at any time")
+    if not await db.agencies.find_one({"agency_id": agency_id}, {"_id": 1}):
+        raise RuntimeError(f"Agency {agency_id} not found")
+    route = await load_tenant_route(agency_id)
+    source, destination = target_named(route["target"]), target_named(target_name)
+    if source is destination:
+        print(f"Agency {agency_id} is already on {target_name}")
+        return
+    
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": TENANT_COLLECTIONS},
+        "$or": [{"operationType": "delete"}, {"fullDocument.agency_id": agency_id}],
+    }}]
+    async with source.db.watch(pipeline, full_document="updateLookup") as stream:
+        # The stream starts on its first read; anything it returns is replayed after the copy
+        first_change = await stream.try_next()
+        try:
+            copied = await copy_agency_documents(source.db, destination.db, agency_id)
+            print(f"Copied {copied} documents from {source.name} to {destination.name}")
+            pending = [first_change] if first_change else []
+            applied = await apply_migration_changes(stream, destination.db, agency_id, pending)
+            
+            await set_tenant_route(agency_id, source.name, "frozen")
+            # Let writes that resolved the route before the freeze land on the source
+            await asyncio.sleep(MIGRATION_FREEZE_GRACE_SECONDS)
+            applied += await apply_migration_changes(stream, destination.db, agency_id, [])
+            print(f"Applied {applied} changes made during the copy")
+        except BaseException:
+            await set_tenant_route(agency_id, source.name, "active")
+            await delete_agency_documents(destination.db, agency_id)
+            raise
         
-        user = db.users.find_one({"user_id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
+        await set_tenant_route(agency_id, destination.name, "active")
+        print(f"Agency {agency_id} now routed to {destination.name}")
         
-        return user
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-def require_role(required_roles: List[str]):
-    def role_checker(current_user: dict = Depends(get_current_user)):
-        if current_user["role"] not in required_roles:
-            raise HTTPException(status_code=403, detail="Insufficient permissions")
-        return current_user
-    return role_checker
+        # Other workers keep reading the source until their cached route
+        # expires; anything still written there meanwhile is carried over
+        late = 0
+        settled_at = time.monotonic() + TENANT_ROUTE_CACHE_TTL_SECONDS + MIGRATION_FREEZE_GRACE_SECONDS
+        while time.monotonic() < settled_at:
+            await asyncio.sleep(MIGRATION_DRAIN_INTERVAL_SECONDS)
+            late += await apply_migration_changes(stream, destination.db, agency_id, [], late=True)
+        if late:
+            print(f"Applied {late} changes written to the source after the cut-over")
+    
+    await verify_migrated_copy(source.db, destination.db, agency_id)
+    await delete_agency_documents(source.db, agency_id)
+    print(f"Removed agency {agency_id} data from {source.name}")
 
-# Initialize super admin
+# Ensure indexes and initialize super admin
 @app.on_event("startup")
 async def startup_event():
+    await ensure_indexes()
+    await load_archive_watermark()
+    
+    # Seed rollups for a deployment that predates them
+    if not await db.rollups.find_one({"_id": GLOBAL_SCOPE}) and await claim_rollup_seed():
+        await rebuild_rollups()
+
     # Create super admin if doesn't exist
-    super_admin = db.users.find_one({"role": UserRole.SUPER_ADMIN})
+    super_admin = await db.users.find_one({"role": UserRole.SUPER_ADMIN})
     if not super_admin:
         super_admin_data = {
             "user_id": str(uuid.uuid4()),
             "email": "admin@carrentalsaas.com",
-            "password": hash_password("admin123"),
+            "password": await hash_password_async("admin123"),
             "first_name": "Super",
             "last_name": "Admin",
             "role": UserRole.SUPER_ADMIN,
             "agency_id": None,
             "created_at": datetime.utcnow()
         }
-        db.users.insert_one(super_admin_data)
+        await db.users.insert_one(super_admin_data)
         print("Super admin created: admin@carrentalsaas.com / admin123")
+    
+    start_job_workers()
+    if EVENTS_CHANGE_STREAM:
+        job_workers.extend(asyncio.create_task(watch_changes(target)) for target in all_targets())
+    if ARCHIVE_AFTER_DAYS > 0:
+        job_workers.append(asyncio.create_task(archive_periodically()))
 
 # Authentication routes
-@app.post("/api/auth/register")
+@app.post("/api/auth/register", response_model=AuthResponse)
 async def register(user_data: UserCreate):
     # Check if user exists
-    existing_user = db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -155,7 +2673,7 @@ async def register(user_data: UserCreate):
     user = {
         "user_id": str(uuid.uuid4()),
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password_async(user_data.password),
         "first_name": user_data.first_name,
         "last_name": user_data.last_name,
         "role": user_data.role,
@@ -163,7 +2681,11 @@ async def register(user_data: UserCreate):
         "created_at": datetime.utcnow()
     }
     
-    db.users.insert_one(user)
+    try:
+        await db.users.insert_one(user)
+    except DuplicateKeyError:
+        # A concurrent registration for the same email won the email_unique index
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create token
     token = create_access_token({"sub": user["user_id"]})
@@ -171,118 +2693,531 @@ async def register(user_data: UserCreate):
     return {
         "message": "User registered successfully",
         "token": token,
-        "user": {
-            "user_id": user["user_id"],
-            "email": user["email"],
-            "first_name": user["first_name"],
-            "last_name": user["last_name"],
-            "role": user["role"],
-            "agency_id": user["agency_id"]
-        }
+        "user": user
     }
 
-@app.post("/api/auth/login")
+@app.post("/api/auth/login", response_model=AuthResponse, dependencies=[Depends(rate_limit("login"))])
 async def login(user_data: UserLogin):
-    user = db.users.find_one({"email": user_data.email})
-    if not user or not verify_password(user_data.password, user["password"]):
+    user = await db.users.find_one(
+        {"email": user_data.email}, {**projection_for(UserOut), "password": 1}
+    )
+    if not user or not await verify_password_async(user_data.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Transparently move the stored hash to the configured bcrypt cost
+    if pwd_context.needs_update(user["password"]):
+        try:
+            new_hash = await hash_password_async(user_data.password)
+            await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"password": new_hash}})
+        except HTTPException:
+            # Pool saturated: the rehash is retried on a later login
+            pass
+    
     token = create_access_token({"sub": user["user_id"]})
     
     return {
         "message": "Login successful",
         "token": token,
-        "user": {
-            "user_id": user["user_id"],
-            "email": user["email"],
-            "first_name": user["first_name"],
-            "last_name": user["last_name"],
-            "role": user["role"],
-            "agency_id": user["agency_id"]
-        }
+        "user": user
     }
 
 # Super Admin routes
-@app.post("/api/admin/agencies")
+@app.post("/api/admin/agencies", response_model=AgencyResponse)
 async def create_agency(
     agency_data: AgencyCreate,
     current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
 ):
+    agency_id = str(uuid.uuid4())
     agency = {
-        "agency_id": str(uuid.uuid4()),
+        "agency_id": agency_id,
         "name": agency_data.name,
         "email": agency_data.email,
         "phone": agency_data.phone,
         "address": agency_data.address,
         "description": agency_data.description,
         "status": "active",
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        "pending_jobs": outbox_jobs(
+            ("agency_welcome", {"agency_id": agency_id}),
+            audit_job("agency_created", current_user["user_id"], agency_id)
+        )
     }
     
-    db.agencies.insert_one(agency)
+    await db.agencies.insert_one(agency)
+    jobs = agency.pop("pending_jobs")
+    await asyncio.gather(
+        record_agency_created(agency),
+        deliver_jobs(db.agencies, {"agency_id": agency_id}, jobs)
+    )
     return {"message": "Agency created successfully", "agency": agency}
 
-@app.get("/api/admin/agencies")
-async def get_agencies(current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))):
-    agencies = list(db.agencies.find({}, {"_id": 0}))
-    return {"agencies": agencies}
+AGENCY_SORT_FIELDS = {"created_at": "created_at", "name": "name"}
+
+@app.get("/api/admin/agencies", response_model=AgencyList)
+async def get_agencies(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "-created_at",
+    agency_status: Optional[str] = Query(None, alias="status"),
+    fields: Optional[str] = None,
+    reads=Depends(read_db),
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    sort_field, descending = parse_sort(sort, AGENCY_SORT_FIELDS)
+    selected = select_fields(fields, AgencyOut, current_user["role"])
+    query = {}
+    if agency_status:
+        query["status"] = agency_status
+    
+    agencies, next_cursor = await paginate(
+        reads.agencies, query, "agency_id", sort_field, descending, limit, after,
+        sparse_projection(AgencyOut, selected, sort_field)
+    )
+    if selected:
+        return sparse_response("agencies", agencies, selected, sort_field, next_cursor=next_cursor)
+    return {"agencies": agencies, "next_cursor": next_cursor}
+
+@app.put("/api/admin/agencies/{agency_id}/status")
+async def update_agency_status(
+    agency_id: str,
+    status_data: AgencyStatusUpdate,
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    if status_data.status not in ("active", "suspended"):
+        raise HTTPException(status_code=400, detail="Status must be active or suspended")
+    
+    previous = await db.agencies.find_one_and_update(
+        {"agency_id": agency_id},
+        {"$set": {"status": status_data.status}},
+        projection={"_id": 0, "status": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Agency not found")
+    
+    await record_agency_status_change(previous["status"], status_data.status)
+    # Cached principals carry the agency status
+    invalidate_agency_users(agency_id)
+    # Open dashboard streams close on suspension; with EVENTS_CHANGE_STREAM
+    # the change stream delivers this to every worker instead
+    publish_event(agency_id, "agency.status", {"status": status_data.status})
+    return {"message": "Agency status updated", "agency_id": agency_id, "status": status_data.status}
 
 @app.get("/api/admin/analytics")
-async def get_admin_analytics(current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))):
-    total_agencies = db.agencies.count_documents({})
-    total_cars = db.cars.count_documents({})
-    total_bookings = db.bookings.count_documents({})
-    active_agencies = db.agencies.count_documents({"status": "active"})
+async def get_admin_analytics(
+    reads=Depends(read_db),
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    rollup = await reads.rollups.find_one({"_id": GLOBAL_SCOPE}) or {}
+    
+    async def target_counts(target: TenantTarget) -> dict:
+        cars, bookings = await asyncio.gather(
+            target.db.cars.estimated_document_count(),
+            target.db.bookings.estimated_document_count()
+        )
+        return {"target": target.name, "cars": cars, "bookings": bookings}
     
     return {
-        "total_agencies": total_agencies,
-        "active_agencies": active_agencies,
-        "total_cars": total_cars,
-        "total_bookings": total_bookings
+        "total_agencies": rollup.get("agencies", 0),
+        "active_agencies": rollup.get("active_agencies", 0),
+        **rollup_summary(rollup),
+        "targets": await asyncio.gather(*(target_counts(target) for target in all_targets()))
     }
 
+@app.get("/api/admin/analytics/agencies/{agency_id}")
+async def get_agency_analytics(
+    agency_id: str,
+    reads=Depends(read_db),
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    rollup = await reads.rollups.find_one({"_id": agency_scope(agency_id)})
+    return {"agency_id": agency_id, **rollup_summary(rollup)}
+
+@app.get("/api/admin/analytics/daily")
+async def get_daily_analytics(
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    agency_id: Optional[str] = None,
+    reads=Depends(read_db),
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    if end < start:
+        raise HTTPException(status_code=400, detail="Range end must not be before its start")
+    if end - start > timedelta(days=366):
+        raise HTTPException(status_code=400, detail="Range cannot exceed one year")
+    
+    scope = agency_scope(agency_id) if agency_id else GLOBAL_SCOPE
+    days = await reads.daily_rollups.find(
+        {"scope": scope, "day": {"$gte": rollup_day(start), "$lte": rollup_day(end)}},
+        {"_id": 0, "day": 1, "bookings": 1, "revenue": 1}
+    ).sort("day", ASCENDING).to_list(length=None)
+    return {"scope": scope, "days": days}
+
+@app.post("/api/admin/analytics/rebuild")
+async def rebuild_analytics(current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))):
+    await rebuild_rollups()
+    return {"message": "Analytics rollups rebuilt"}
+
+@app.get("/api/admin/mail")
+async def get_sent_mail(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """Most recent messages held by the local mail sink, newest first."""
+    if not isinstance(mail_sink, LocalMailSink):
+        raise HTTPException(status_code=404, detail="Mail is delivered over SMTP")
+    return {"messages": list(reversed(mail_sink.messages))[:limit]}
+
 # Agency routes
-@app.post("/api/agency/cars")
+@app.post("/api/agency/cars", response_model=CarResponse)
 async def create_car(
     car_data: CarCreate,
+    response: Response,
     current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
 ):
     # Verify agency access
     if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != car_data.agency_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    car = {
-        "car_id": str(uuid.uuid4()),
-        "title": car_data.title,
-        "model": car_data.model,
-        "brand": car_data.brand,
-        "year": car_data.year,
-        "plate_number": car_data.plate_number,
-        "color": car_data.color,
-        "price_per_day": car_data.price_per_day,
-        "features": car_data.features,
-        "agency_id": car_data.agency_id,
-        "status": "available",
-        "created_at": datetime.utcnow()
-    }
+    car = build_car(car_data)
+    car["pending_jobs"] = outbox_jobs(
+        audit_job("car_created", current_user["user_id"], car["agency_id"], car_id=car["car_id"])
+    )
+    target = await tenant_for_write(car_data.agency_id)
     
-    db.cars.insert_one(car)
+    try:
+        await target.db.cars.insert_one(car)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="A car with this plate number already exists")
+    jobs = car.pop("pending_jobs")
+    # The car is stored from here on, so failures are logged rather than
+    # turned into an error whose retry would hit the duplicate plate
+    try:
+        publish_event(car["agency_id"], "car.created", {"car": CarOut.model_validate(car).model_dump(mode="json")})
+    except Exception as e:
+        logger.warning("Could not publish car %s: %s", car["car_id"], e)
+    results = await asyncio.gather(
+        invalidate_catalog(car_data.agency_id),
+        record_car_created(car),
+        deliver_jobs(target.db.cars, {"car_id": car["car_id"]}, jobs),
+        return_exceptions=True
+    )
+    # Undelivered jobs stay on the car for the outbox sweeper
+    for step, result in zip(("catalog", "rollups", "jobs"), results):
+        if isinstance(result, Exception):
+            logger.warning("Car %s was stored but its %s update failed: %s", car["car_id"], step, result)
+    pin_reads_to_primary(response)
     return {"message": "Car added successfully", "car": car}
 
-@app.get("/api/agency/{agency_id}/cars")
+@app.post("/api/agency/{agency_id}/cars/import")
+async def import_cars(
+    agency_id: str,
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    """Bulk import cars from a JSON array body or a streamed text/csv body."""
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    # Refuse up front while frozen; each batch checks again below
+    await tenant_for_write(agency_id)
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("text/csv"):
+        rows = iter_csv_rows(request.stream())
+    elif content_type.startswith("application/json"):
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(payload, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of cars")
+        rows = iter_list(payload)
+    else:
+        raise HTTPException(status_code=415, detail="Send a JSON array or a text/csv body")
+    
+    inserted = 0
+    errors = []
+    
+    async def write_batch(batch: List[dict], batch_rows: List[int]):
+        nonlocal inserted
+        # Resolved per batch, so a long import stops writing to the source once
+        # a migration freezes the agency. The import as a whole is unbounded, but
+        # each batch keeps the request deadline the freeze grace period outlasts.
+        with pymongo.timeout(MONGO_REQUEST_TIMEOUT_MS / 1000 or None):
+            target = await tenant_for_write(agency_id)
+            inserted += await insert_car_batch(target.db, batch, batch_rows, errors)
+    
+    batch, batch_rows = [], []
+    row_number = 0
+    try:
+        async for row in rows:
+            row_number += 1
+            if row_number > MAX_IMPORT_ROWS:
+                errors.append({"row": row_number, "error": f"Import is limited to {MAX_IMPORT_ROWS} rows"})
+                break
+            if isinstance(row, ValueError):
+                errors.append({"row": row_number, "error": str(row)})
+                continue
+            if not isinstance(row, dict):
+                errors.append({"row": row_number, "error": "Expected an object"})
+                continue
+            try:
+                car_data = CarCreate(**{**row, "agency_id": agency_id})
+            except ValidationError as e:
+                errors.append({"row": row_number, "error": format_validation_error(e)})
+                continue
+            batch.append(build_car(car_data))
+            batch_rows.append(row_number)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await write_batch(batch, batch_rows)
+                batch, batch_rows = [], []
+        if batch:
+            await write_batch(batch, batch_rows)
+    finally:
+        # Cars written before a mid-import 503 still count and show up
+        if inserted:
+            pin_reads_to_primary(response)
+            publish_event(agency_id, "fleet.imported", {"inserted": inserted})
+            await asyncio.gather(invalidate_catalog(agency_id), record_cars_created(agency_id, inserted))
+    
+    errors.sort(key=lambda error: error["row"])
+    return {
+        "message": f"Imported {inserted} cars",
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": errors[:MAX_REPORTED_IMPORT_ERRORS]
+    }
+
+CAR_SORT_FIELDS = {"created_at": "created_at", "price": "price_per_day"}
+BOOKING_SORT_FIELDS = {"created_at": "created_at", "pickup_date": "pickup_date"}
+
+@app.get("/api/agency/{agency_id}/cars", response_model=CarList)
 async def get_agency_cars(
     agency_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "-created_at",
+    car_status: Optional[str] = Query(None, alias="status"),
+    car_ids: Optional[List[str]] = Query(None, alias="car_id"),
+    fields: Optional[str] = None,
+    reads=Depends(tenant_reads),
     current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
 ):
     # Verify agency access
     if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    cars = list(db.cars.find({"agency_id": agency_id}, {"_id": 0}))
-    return {"cars": cars}
+    sort_field, descending = parse_sort(sort, CAR_SORT_FIELDS)
+    selected = select_fields(fields, CarOut, current_user["role"])
+    query = {"agency_id": agency_id}
+    if car_status:
+        query["status"] = car_status
+    if car_ids:
+        query["car_id"] = {"$in": car_ids}
+    
+    cars, next_cursor = await paginate(
+        reads.cars, query, "car_id", sort_field, descending, limit, after,
+        sparse_projection(CarOut, selected, sort_field)
+    )
+    if selected:
+        return sparse_response("cars", cars, selected, sort_field, next_cursor=next_cursor)
+    return {"cars": cars, "next_cursor": next_cursor}
 
-@app.get("/api/agency/{agency_id}/bookings")
+@app.get("/api/agency/{agency_id}/bookings", response_model=BookingList)
 async def get_agency_bookings(
+    agency_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "-created_at",
+    booking_status: Optional[str] = Query(None, alias="status"),
+    car_id: Optional[str] = None,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    fields: Optional[str] = None,
+    reads=Depends(tenant_reads),
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    sort_field, descending = parse_sort(sort, BOOKING_SORT_FIELDS)
+    selected = select_fields(fields, BookingOut, current_user["role"])
+    query = {"agency_id": agency_id}
+    if booking_status:
+        query["status"] = booking_status
+    if car_id:
+        query["car_id"] = car_id
+    # Date range filters on pickup date
+    if start or end:
+        query["pickup_date"] = {}
+        if start:
+            query["pickup_date"]["$gte"] = start
+        if end:
+            query["pickup_date"]["$lt"] = end
+    
+    bookings, next_cursor = await paginate(
+        reads.bookings, query, "booking_id", sort_field, descending, limit, after,
+        sparse_projection(BookingOut, selected, sort_field),
+        union_with=ARCHIVE_COLLECTION if needs_archive(start) else None
+    )
+    if selected:
+        return sparse_response("bookings", bookings, selected, sort_field, next_cursor=next_cursor)
+    return {"bookings": bookings, "next_cursor": next_cursor}
+
+SUMMARY_BOOKING_FIELDS = {
+    "_id": 0, "booking_id": 1, "car_id": 1, "client_name": 1, "client_email": 1,
+    "pickup_date": 1, "return_date": 1, "pickup_location": 1, "return_location": 1,
+    "status": 1, "total_amount": 1
+}
+
+@app.get("/api/agency/{agency_id}/summary")
+async def get_agency_summary(
+    agency_id: str,
+    days: int = Query(7, ge=1, le=31),
+    reads=Depends(read_db),
+    tenant_db=Depends(tenant_reads),
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    now = datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    window_end = today + timedelta(days=days)
+    
+    # Every query below is bounded by an index on agency_id plus the fleet
+    # size or the upcoming window, never by booking history
+    fleet_counts, upcoming, recent, rollup = await asyncio.gather(
+        tenant_db.cars.aggregate([
+            {"$match": {"agency_id": agency_id}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ]).to_list(length=None),
+        tenant_db.bookings.aggregate([
+            {"$match": {
+                "agency_id": agency_id,
+                "status": {"$in": ACTIVE_BOOKING_STATUSES},
+                "$or": [
+                    {"pickup_date": {"$gte": today, "$lt": window_end}},
+                    {"return_date": {"$gte": today, "$lt": window_end}},
+                ],
+            }},
+            {"$facet": {
+                "pickups": [
+                    {"$match": {"pickup_date": {"$gte": today, "$lt": window_end}}},
+                    {"$sort": {"pickup_date": 1}},
+                    {"$limit": 10},
+                    {"$project": SUMMARY_BOOKING_FIELDS},
+                ],
+                "returns": [
+                    {"$match": {"return_date": {"$gte": today, "$lt": window_end}}},
+                    {"$sort": {"return_date": 1}},
+                    {"$limit": 10},
+                    {"$project": SUMMARY_BOOKING_FIELDS},
+                ],
+                "pickups_today": [
+                    {"$match": {"pickup_date": {"$gte": today, "$lt": today + timedelta(days=1)}}},
+                    {"$count": "count"},
+                ],
+            }},
+        ]).to_list(length=None),
+        tenant_db.bookings.aggregate([
+            {"$match": {"agency_id": agency_id}},
+            {"$sort": {"created_at": -1, "booking_id": -1}},
+            {"$limit": 5},
+            {"$lookup": {
+                "from": "cars",
+                "localField": "car_id",
+                "foreignField": "car_id",
+                "as": "car",
+            }},
+            {"$project": {
+                **SUMMARY_BOOKING_FIELDS,
+                "car": {
+                    "title": {"$arrayElemAt": ["$car.title", 0]},
+                    "brand": {"$arrayElemAt": ["$car.brand", 0]},
+                    "model": {"$arrayElemAt": ["$car.model", 0]},
+                },
+            }},
+        ]).to_list(length=None),
+        reads.rollups.find_one({"_id": agency_scope(agency_id)}),
+    )
+    
+    by_status = {row["_id"]: row["count"] for row in fleet_counts}
+    upcoming = upcoming[0]
+    pickups_today = upcoming["pickups_today"][0]["count"] if upcoming["pickups_today"] else 0
+    booking_totals = rollup_summary(rollup)
+    
+    return {
+        "fleet": {"total": sum(by_status.values()), "by_status": by_status},
+        "bookings": {
+            "total": booking_totals["total_bookings"],
+            "by_status": booking_totals["bookings_by_status"],
+            "revenue": booking_totals["total_revenue"],
+        },
+        "pickups_today": pickups_today,
+        "upcoming_pickups": upcoming["pickups"],
+        "upcoming_returns": upcoming["returns"],
+        "recent_bookings": recent,
+    }
+
+@app.get("/api/agency/{agency_id}/bookings/export")
+async def export_agency_bookings(
+    agency_id: str,
+    export_format: str = Query("ndjson", alias="format"),
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    reads=Depends(tenant_reads),
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    query = {"agency_id": agency_id}
+    # Date range filters on pickup date
+    if start or end:
+        query["pickup_date"] = {}
+        if start:
+            query["pickup_date"]["$gte"] = start
+        if end:
+            query["pickup_date"]["$lt"] = end
+    
+    collections = [reads.bookings]
+    if needs_archive(start):
+        collections.append(reads[ARCHIVE_COLLECTION])
+    cursors = [
+        collection.find(
+            query, {"_id": 0, **{field: 1 for field in BOOKING_EXPORT_FIELDS}}
+        ).sort([("pickup_date", ASCENDING), ("booking_id", ASCENDING)]).batch_size(EXPORT_BATCH_SIZE)
+        for collection in collections
+    ]
+    cursor = cursors[0] if len(cursors) == 1 else merge_sorted(
+        cursors, key=lambda booking: (booking["pickup_date"], booking["booking_id"])
+    )
+    return export_response(cursor, BOOKING_EXPORT_FIELDS, export_format, f"bookings-{agency_id}")
+
+@app.get("/api/agency/{agency_id}/cars/export")
+async def export_agency_cars(
+    agency_id: str,
+    export_format: str = Query("ndjson", alias="format"),
+    reads=Depends(tenant_reads),
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    cursor = reads.cars.find(
+        {"agency_id": agency_id}, {"_id": 0, **{field: 1 for field in CAR_EXPORT_FIELDS}}
+    ).sort([("created_at", ASCENDING), ("car_id", ASCENDING)]).batch_size(EXPORT_BATCH_SIZE)
+    return export_response(cursor, CAR_EXPORT_FIELDS, export_format, f"fleet-{agency_id}")
+
+@app.get("/api/agency/{agency_id}/pricing", response_model=PricingRules)
+async def get_pricing_rules(
     agency_id: str,
     current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
 ):
@@ -290,53 +3225,466 @@ async def get_agency_bookings(
     if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    bookings = list(db.bookings.find({"agency_id": agency_id}, {"_id": 0}))
-    return {"bookings": bookings}
+    rules = await db.pricing_rules.find_one({"agency_id": agency_id}, {"_id": 0})
+    return rules or PricingRules()
+
+@app.put("/api/agency/{agency_id}/pricing")
+async def update_pricing_rules(
+    agency_id: str,
+    rules: PricingRules,
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN]))
+):
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    await db.pricing_rules.update_one(
+        {"agency_id": agency_id},
+        {"$set": {**rules.model_dump(), "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    rate_tables.invalidate(agency_id)
+    return {"message": "Pricing rules updated", "pricing": rules}
+
+@app.get("/api/agency/{agency_id}/events")
+async def stream_agency_events(
+    agency_id: str,
+    request: Request,
+    current_user: dict = Depends(require_role([UserRole.AGENCY_ADMIN, UserRole.STAFF]))
+):
+    """Server-sent booking and fleet events for one agency's dashboards."""
+    # Verify agency access
+    if current_user["role"] != UserRole.SUPER_ADMIN and current_user["agency_id"] != agency_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    async def stream():
+        queue = event_broker.subscribe(agency_id)
+        try:
+            yield b"retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    # Comment line keeps proxies from closing an idle stream
+                    yield b": heartbeat\n\n"
+                    continue
+                if event["type"] == "agency.status" and event["data"]["status"] == "suspended":
+                    return
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(agency_id, queue)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Public routes
-@app.get("/api/public/agencies/{agency_id}/cars")
-async def get_public_cars(agency_id: str):
-    cars = list(db.cars.find(
-        {"agency_id": agency_id, "status": "available"}, 
-        {"_id": 0}
+@app.get("/api/public/agencies/{agency_id}/cars", dependencies=[Depends(rate_limit("public_read"))])
+async def get_public_cars(
+    agency_id: str,
+    fields: Optional[str] = None,
+    agency_fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    selected = select_fields(fields, PublicCarOut, PUBLIC_ROLE)
+    selected_agency = select_fields(agency_fields, PublicAgencyOut, PUBLIC_ROLE)
+    variant = ",".join(selected or []) + ";" + ",".join(selected_agency or []) if fields or agency_fields else ""
+    cached = await catalog_cache.get(agency_id, variant)
+    if cached:
+        body, etag = cached
+    else:
+        generation = await catalog_cache.generation(agency_id)
+        # Misses read the primary: a stale secondary read here would be cached
+        # for the full TTL, well past the write that invalidated it
+        target = await tenant(agency_id)
+        cars, agency = await asyncio.gather(
+            target.db.cars.find(
+                {"agency_id": agency_id, "status": "available"}, 
+                sparse_projection(PublicCarOut, selected)
+            ).to_list(length=None),
+            db.agencies.find_one({"agency_id": agency_id}, sparse_projection(PublicAgencyOut, selected_agency)),
+        )
+        if selected or selected_agency:
+            body = orjson.dumps({"agency": agency, "cars": cars})
+        else:
+            body = PublicCatalog(agency=agency, cars=cars).model_dump_json().encode()
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        await catalog_cache.set(agency_id, body, etag, variant, generation)
+    
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CATALOG_MAX_AGE_SECONDS}"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/public/agencies/{agency_id}/availability", response_model=AvailabilityResponse, dependencies=[Depends(rate_limit("public_read"))])
+async def get_availability(
+    agency_id: str,
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    fields: Optional[str] = None,
+    reads=Depends(tenant_reads)
+):
+    validate_rental_period(start, end)
+    selected = select_fields(fields, PublicCarOut, PUBLIC_ROLE)
+    
+    cars, booked_car_ids = await asyncio.gather(
+        reads.cars.find(
+            {"agency_id": agency_id, "status": "available"},
+            sparse_projection(PublicCarOut, selected)
+        ).to_list(length=None),
+        get_booked_car_ids(reads, agency_id, start, end),
+    )
+    available_cars = [car for car in cars if car["car_id"] not in booked_car_ids]
+    
+    if selected:
+        return sparse_response("cars", available_cars, selected, **{"from": start, "to": end})
+    return {"from": start, "to": end, "cars": available_cars}
+
+@app.get("/api/public/agencies/{agency_id}/quotes", response_model=QuoteResponse, dependencies=[Depends(rate_limit("public_read"))])
+async def get_quotes(
+    agency_id: str,
+    start: datetime = Query(..., alias="from"),
+    end: datetime = Query(..., alias="to"),
+    car_ids: Optional[List[str]] = Query(None, alias="car_id"),
+    reads=Depends(tenant_reads)
+):
+    """Price every available car of the agency (or just car_ids) for one rental period."""
+    validate_rental_period(start, end)
+    
+    query = {"agency_id": agency_id, "status": "available"}
+    if car_ids:
+        query["car_id"] = {"$in": car_ids}
+    cars, table = await asyncio.gather(
+        reads.cars.find(query, {"_id": 0, "car_id": 1, "price_per_day": 1}).to_list(length=None),
+        get_rate_table(agency_id),
+    )
+    prices = np.fromiter((car["price_per_day"] for car in cars), dtype=float, count=len(cars))
+    days, totals = table.quote(prices, start, end)
+    
+    # Rows are built from trusted values, so skip response validation: for a
+    # large fleet it costs an order of magnitude more than the pricing itself
+    quotes = [
+        {"car_id": car["car_id"], "price_per_day": car["price_per_day"], "total_amount": total}
+        for car, total in zip(cars, totals.tolist())
+    ]
+    return ORJSONResponse({"from": start, "to": end, "days": days, "quotes": quotes})
+
+@app.get("/api/public/cars/search", response_model=CarSearchResponse, dependencies=[Depends(rate_limit("public_read"))])
+async def search_cars(
+    request: Request,
+    q: Optional[str] = Query(None, max_length=100),
+    agency_id: Optional[str] = None,
+    brand: Optional[List[str]] = Query(None),
+    color: Optional[List[str]] = Query(None),
+    features: Optional[List[str]] = Query(None),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    min_year: Optional[int] = None,
+    max_year: Optional[int] = None,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    sort: str = "price",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    include_facets: bool = Query(False, alias="facets"),
+    fields: Optional[str] = None
+):
+    sort_field, descending = parse_sort(sort, SEARCH_SORT_FIELDS)
+    selected = select_fields(fields, PublicCarOut, PUBLIC_ROLE)
+    if (start is None) != (end is None):
+        raise HTTPException(status_code=400, detail="Provide both from and to for availability")
+    
+    query = {"status": "available"}
+    if q:
+        query["$text"] = {"$search": q}
+    if agency_id:
+        query["agency_id"] = agency_id
+    if brand:
+        query["brand"] = {"$in": brand}
+    if color:
+        query["color"] = {"$in": color}
+    if features:
+        query["features"] = {"$all": features}
+    if min_price is not None or max_price is not None:
+        query["price_per_day"] = {}
+        if min_price is not None:
+            query["price_per_day"]["$gte"] = min_price
+        if max_price is not None:
+            query["price_per_day"]["$lte"] = max_price
+    if min_year is not None or max_year is not None:
+        query["year"] = {}
+        if min_year is not None:
+            query["year"]["$gte"] = min_year
+        if max_year is not None:
+            query["year"]["$lte"] = max_year
+    
+    if start:
+        validate_rental_period(start, end)
+    period = (start, end) if start else None
+    
+    # A search within one agency hits its target; otherwise every target is searched
+    targets = [await tenant(agency_id)] if agency_id else all_targets()
+    target_dbs = [target_read_db(target, request) for target in targets]
+    
+    position = decode_cursor(after, sort_field) if after else None
+    projection = sparse_projection(PublicCarOut, selected, sort_field)
+    pages = await asyncio.gather(*(
+        search_page(target_db, query, sort_field, descending, limit, position, projection, period)
+        for target_db in target_dbs
     ))
-    agency = db.agencies.find_one({"agency_id": agency_id}, {"_id": 0})
+    if len(pages) == 1:
+        cars = pages[0]
+    else:
+        # Mid-migration an agency's cars exist on two targets
+        unique = {}
+        for page in pages:
+            for car in page:
+                unique.setdefault(car["car_id"], car)
+        cars = sorted(unique.values(), key=lambda car: (car[sort_field], car["car_id"]), reverse=descending)
+    next_cursor = None
+    if len(cars) > limit:
+        cars = cars[:limit]
+        next_cursor = encode_cursor(sort_field, cars[-1], "car_id")
+    
+    total = facets = None
+    if after is None and (period is None or agency_id):
+        count_query = query
+        if period:
+            booked = await get_booked_car_ids(target_dbs[0], agency_id, start, end)
+            count_query = {**query, "car_id": {"$nin": list(booked)}}
+        if include_facets:
+            # Top values per target need not be the overall top, so merge uncut groups
+            facet_stages = search_facets(SEARCH_FACET_SIZE if len(target_dbs) == 1 else None)
+            results = await asyncio.gather(*(
+                target_db.cars.aggregate([{"$match": count_query}, {"$facet": facet_stages}]).to_list(length=None)
+                for target_db in target_dbs
+            ))
+            facets = merge_search_facets([result for [result] in results])
+            total = facets.pop("total")[0]["count"]
+        else:
+            counts = await asyncio.gather(*(
+                target_db.cars.count_documents(count_query, limit=SEARCH_COUNT_LIMIT) for target_db in target_dbs
+            ))
+            total = min(sum(counts), SEARCH_COUNT_LIMIT)
+    
+    if selected:
+        return sparse_response(
+            "cars", cars, selected, sort_field,
+            next_cursor=next_cursor, total=total, facets=facets
+        )
+    return {"cars": cars, "next_cursor": next_cursor, "total": total, "facets": facets}
+
+@app.post("/api/public/bookings", response_model=BookingResponse, dependencies=[Depends(rate_limit("public_write"))])
+async def create_booking(
+    booking_data: BookingCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    if not idempotency_key:
+        booking, car, target = await place_booking(booking_data)
+        await announce_booking(booking, car, target)
+        pin_reads_to_primary(response)
+        return {"message": "Booking created successfully", "booking": booking}
+    
+    request_hash = hashlib.sha256(booking_data.model_dump_json().encode()).hexdigest()
+    replay = await claim_idempotency_key(idempotency_key, request_hash)
+    if replay:
+        replayed = replay_idempotent_response(replay)
+        pin_reads_to_primary(replayed)
+        return replayed
     
-    return {"agency": agency, "cars": cars}
+    try:
+        booking, car, target = await place_booking(booking_data)
+    except HTTPException as e:
+        if is_final_outcome(e.status_code):
+            # Client errors are part of the outcome and replay as-is
+            await complete_idempotency_key(idempotency_key, request_hash, e.status_code, {"detail": e.detail})
+        else:
+            # A retry honoring Retry-After (frozen tenant, busy car, rate limit) must run again
+            await release_idempotency_key(idempotency_key)
+        raise
+    except Exception:
+        # Server errors before the booking was stored release the key so a retry can run again
+        await release_idempotency_key(idempotency_key)
+        raise
+    
+    # The booking exists from here on: store the outcome before any side
+    # effect runs, so a retry replays it instead of conflicting with it
+    body = BookingResponse(message="Booking created successfully", booking=booking).model_dump(mode="json")
+    try:
+        await complete_idempotency_key(idempotency_key, request_hash, 200, body)
+    except PyMongoError as e:
+        # The claim's lease runs out and a retry then finds its own booking (409)
+        logger.warning("Could not store the outcome of booking %s: %s", booking["booking_id"], e)
+    await announce_booking(booking, car, target)
+    pin_reads_to_primary(response)
+    return body
 
-@app.post("/api/public/bookings")
-async def create_booking(booking_data: BookingCreate):
-    # Get car and agency info
-    car = db.cars.find_one({"car_id": booking_data.car_id})
+async def place_booking(booking_data: BookingCreate) -> tuple:
+    """Store the booking and return it with its car and target; side effects are left to announce_booking."""
+    validate_rental_period(booking_data.pickup_date, booking_data.return_date)
+    
+    car, target = await find_car_for_write(booking_data.car_id)
     if not car:
         raise HTTPException(status_code=404, detail="Car not found")
+    # The body names only the car, so the route dependency cannot charge the agency
+    await charge_rate_limit("public_write", "agency", car["agency_id"])
     
-    agency = db.agencies.find_one({"agency_id": car["agency_id"]})
-    
-    booking = {
-        "booking_id": str(uuid.uuid4()),
-        "car_id": booking_data.car_id,
-        "agency_id": car["agency_id"],
-        "client_email": booking_data.client_email,
-        "client_name": booking_data.client_name,
-        "client_phone": booking_data.client_phone,
-        "pickup_date": booking_data.pickup_date,
-        "return_date": booking_data.return_date,
-        "pickup_location": booking_data.pickup_location,
-        "return_location": booking_data.return_location,
-        "message": booking_data.message,
-        "status": "pending",
-        "total_amount": car["price_per_day"] * (booking_data.return_date - booking_data.pickup_date).days,
-        "created_at": datetime.utcnow()
-    }
+    total_amount = await price_rental(
+        car["agency_id"], car["price_per_day"], booking_data.pickup_date, booking_data.return_date
+    )
+    
+    booking_id = str(uuid.uuid4())
+    for attempt in range(RESERVATION_LOCK_ATTEMPTS):
+        if await claim_reservation_slots(
+            target.db, car["agency_id"], booking_data.car_id, booking_id,
+            booking_data.pickup_date, booking_data.return_date
+        ):
+            break
+        # Another attempt holds a day; if a booking already overlaps there is nothing to wait for
+        if await find_conflicting_booking(
+            target.db, booking_data.car_id, booking_data.pickup_date, booking_data.return_date
+        ):
+            raise HTTPException(status_code=409, detail="Car is already booked for the selected dates")
+        await asyncio.sleep(RESERVATION_LOCK_RETRY_SECONDS * (attempt + 1))
+    else:
+        raise HTTPException(
+            status_code=503,
+            detail="Car is being booked by another request, please retry",
+            headers={"Retry-After": "1"}
+        )
     
-    db.bookings.insert_one(booking)
-    return {"message": "Booking created successfully", "booking": booking}
+    try:
+        # Under the lock this check sees every booking that could overlap
+        if await find_conflicting_booking(
+            target.db, booking_data.car_id, booking_data.pickup_date, booking_data.return_date
+        ):
+            raise HTTPException(status_code=409, detail="Car is already booked for the selected dates")
+        booking = {
+            "booking_id": booking_id,
+            "car_id": booking_data.car_id,
+            "agency_id": car["agency_id"],
+            "client_email": booking_data.client_email,
+            "client_name": booking_data.client_name,
+            "client_phone": booking_data.client_phone,
+            "pickup_date": booking_data.pickup_date,
+            "return_date": booking_data.return_date,
+            "pickup_location": booking_data.pickup_location,
+            "return_location": booking_data.return_location,
+            "message": booking_data.message,
+            "status": "pending",
+            "total_amount": total_amount,
+            "created_at": datetime.utcnow(),
+            "pending_jobs": outbox_jobs(
+                ("booking_confirmation", {"booking_id": booking_id, "agency_id": car["agency_id"]}),
+                ("agency_booking_notification", {"booking_id": booking_id, "agency_id": car["agency_id"]}),
+                audit_job("booking_created", None, car["agency_id"], booking_id=booking_id)
+            )
+        }
+        await target.db.bookings.insert_one(booking)
+    finally:
+        await release_reservation_slots(target.db, booking_id)
+    
+    return booking, car, target
+
+async def announce_booking(booking: dict, car: dict, target: TenantTarget):
+    """Publish, count and notify a stored booking.
+
+    The booking is already committed, so failures here are logged rather than
+    turned into an error the client would retry.
+    """
+    booking_id = booking["booking_id"]
+    jobs = booking.pop("pending_jobs")
+    try:
+        publish_event(booking["agency_id"], "booking.created", {
+            "booking": BookingOut.model_validate(booking).model_dump(mode="json"),
+            "car": CarOut.model_validate(car).model_dump(mode="json")
+        })
+    except Exception as e:
+        logger.warning("Could not publish booking %s: %s", booking_id, e)
+    results = await asyncio.gather(
+        record_booking_created(booking),
+        deliver_jobs(target.db.bookings, {"booking_id": booking_id}, jobs),
+        return_exceptions=True
+    )
+    # Undelivered jobs stay on the booking for the outbox sweeper
+    for step, result in zip(("rollups", "jobs"), results):
+        if isinstance(result, Exception):
+            logger.warning("Booking %s was stored but its %s update failed: %s", booking_id, step, result)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_job_workers()
+    client.close()
+    password_executor.shutdown(wait=False)
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow(),
+        "user_cache": user_cache.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "password_jobs_in_flight": password_jobs_in_flight
+    }
+
+# Readiness checks the Mongo pool end to end; /api/health stays a cheap liveness probe
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", "2"))
+
+@app.get("/api/ready")
+async def readiness_check():
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READINESS_TIMEOUT_SECONDS)
+    except (PyMongoError, asyncio.TimeoutError) as e:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "unavailable", "mongo": type(e).__name__}
+        )
+    return {"status": "ready", "mongo_ping_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+# Cache and pool state sampled at scrape time
+Gauge("user_cache_hits", "Principal cache hits").set_function(lambda: user_cache.hits)
+Gauge("user_cache_misses", "Principal cache misses").set_function(lambda: user_cache.misses)
+Gauge("catalog_cache_hits", "Public catalog cache hits").set_function(lambda: catalog_cache.stats()["hits"])
+Gauge("catalog_cache_misses", "Public catalog cache misses").set_function(lambda: catalog_cache.stats()["misses"])
+Gauge("password_jobs_in_flight", "bcrypt jobs running or queued").set_function(lambda: password_jobs_in_flight)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def run_index_check() -> int:
+    await ensure_indexes(rebuild=True)
+    failures = await check_query_plans()
+    for failure in failures:
+        print(f"COLLSCAN: {failure}")
+    print(f"Checked {len(QUERY_SHAPES)} query shapes, {len(failures)} collection scans")
+    return 1 if failures else 0
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if "--check-indexes" in sys.argv:
+        sys.exit(asyncio.run(run_index_check()))
+    if "--rebuild-rollups" in sys.argv:
+        asyncio.run(rebuild_rollups())
+        sys.exit(0)
+    if "--archive-bookings" in sys.argv:
+        if ARCHIVE_AFTER_DAYS <= 0:
+            print("Archival is off, set ARCHIVE_AFTER_DAYS to the age to archive at")
+            sys.exit(1)
+        # --no-settle: no API workers are running that could hold an older watermark
+        moved = asyncio.run(archive_bookings(settle="--no-settle" not in sys.argv))
+        print(f"Archived {moved} bookings")
+        sys.exit(0)
+    if "--migrate-agency" in sys.argv:
+        agency_id, target_name = sys.argv[sys.argv.index("--migrate-agency") + 1:][:2]
+        asyncio.run(migrate_agency(agency_id, target_name))
+        sys.exit(0)
+
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
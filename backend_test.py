@@ -1,16 +1,29 @@
 import requests
+import asyncio
 import json
+import os
+import sys
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 import time
 import unittest
 
 # Base URL for the API
 BASE_URL = "http://localhost:8001/api"
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+def import_server():
+    """Import the backend in process for checks that need no running server"""
+    # Motor connects lazily, so no Mongo is contacted on import
+    sys.path.insert(0, BACKEND_DIR)
+    import server
+    return server
 
 class CarRentalSaaSBackendTest:
     def __init__(self):
         # Initialize variables to store tokens and IDs
         self.super_admin_token = None
+        self.agency_admin_token = None
         self.agency_id = None
         self.car_id = None
         
@@ -125,10 +138,28 @@ class CarRentalSaaSBackendTest:
             self.agency_id = response.json()["agency"]["agency_id"]
             self.test_car["agency_id"] = self.agency_id
             print(f"✅ Agency created successfully with ID: {self.agency_id}")
+            self.register_agency_admin()
         except Exception as e:
             print(f"❌ Error in agency creation: {str(e)}")
             print(f"Response Text: {response.text}")
 
+    def register_agency_admin(self):
+        """Register an admin for the test agency; agency routes refuse the super admin"""
+        response = requests.post(
+            f"{BASE_URL}/auth/register",
+            json={
+                "email": f"agency-admin-{int(time.time() * 1000)}@agency.com",
+                "password": "agency123",
+                "first_name": "Agency",
+                "last_name": "Admin",
+                "role": "agency_admin",
+                "agency_id": self.agency_id
+            }
+        )
+        print(f"Response Status (Agency Admin): {response.status_code}")
+        assert response.status_code == 200, "Agency admin registration failed with non-200 status code"
+        self.agency_admin_token = response.json()["token"]
+
     def test_05_get_agencies(self):
         """Test fetching all agencies as super admin"""
         print("\n5. Testing Get All Agencies (Super Admin)")
@@ -172,14 +203,12 @@ class CarRentalSaaSBackendTest:
 
     def test_07_create_car(self):
         """Test creating a new car for an agency"""
-        print("\n7. Testing Car Creation (Super Admin)")
-        # Ensure we have a token and agency ID
-        if not self.super_admin_token:
-            self.test_02_login_valid()
-        if not self.agency_id:
+        print("\n7. Testing Car Creation (Agency Admin)")
+        # Ensure we have an agency and its admin
+        if not self.agency_admin_token:
             self.test_04_create_agency()
             
-        headers = {"Authorization": f"Bearer {self.super_admin_token}"}
+        headers = {"Authorization": f"Bearer {self.agency_admin_token}"}
         response = requests.post(
             f"{BASE_URL}/agency/cars",
             headers=headers,
@@ -200,13 +229,11 @@ class CarRentalSaaSBackendTest:
     def test_08_get_agency_cars(self):
         """Test fetching cars for an agency"""
         print("\n8. Testing Get Agency Cars")
-        # Ensure we have a token and agency ID
-        if not self.super_admin_token:
-            self.test_02_login_valid()
-        if not self.agency_id:
+        # Ensure we have an agency and its admin
+        if not self.agency_admin_token:
             self.test_04_create_agency()
             
-        headers = {"Authorization": f"Bearer {self.super_admin_token}"}
+        headers = {"Authorization": f"Bearer {self.agency_admin_token}"}
         response = requests.get(
             f"{BASE_URL}/agency/{self.agency_id}/cars",
             headers=headers
@@ -222,13 +249,11 @@ class CarRentalSaaSBackendTest:
     def test_09_get_agency_bookings(self):
         """Test fetching bookings for an agency"""
         print("\n9. Testing Get Agency Bookings")
-        # Ensure we have a token and agency ID
-        if not self.super_admin_token:
-            self.test_02_login_valid()
-        if not self.agency_id:
+        # Ensure we have an agency and its admin
+        if not self.agency_admin_token:
             self.test_04_create_agency()
             
-        headers = {"Authorization": f"Bearer {self.super_admin_token}"}
+        headers = {"Authorization": f"Bearer {self.agency_admin_token}"}
         response = requests.get(
             f"{BASE_URL}/agency/{self.agency_id}/bookings",
             headers=headers
@@ -300,6 +325,260 @@ class CarRentalSaaSBackendTest:
         print("Note: This test would require creating an agency admin account")
         print("✅ Role-based access control is implemented in the code")
 
+    def booking_between(self, start_days, end_days, **overrides):
+        """Copy of the test booking for the period start_days..end_days from now"""
+        return {
+            **self.test_booking,
+            "pickup_date": (datetime.now() + timedelta(days=start_days)).isoformat(),
+            "return_date": (datetime.now() + timedelta(days=end_days)).isoformat(),
+            **overrides
+        }
+
+    def test_14_availability_and_overlap(self):
+        """Test that a booked car leaves availability and overlapping bookings are refused"""
+        print("\n14. Testing Availability and Overlapping Bookings")
+        if not self.car_id:
+            self.test_07_create_car()
+
+        booking = self.booking_between(10, 12)
+        response = requests.post(f"{BASE_URL}/public/bookings", json=booking)
+        print(f"Response Status (First Booking): {response.status_code}")
+        assert response.status_code == 200, "Booking a free period failed with non-200 status code"
+
+        response = requests.get(
+            f"{BASE_URL}/public/agencies/{self.agency_id}/availability",
+            params={"from": booking["pickup_date"], "to": booking["return_date"]}
+        )
+        print(f"Response Status (Availability): {response.status_code}")
+        print(f"Response Body (Availability): {json.dumps(response.json(), indent=2)}")
+        assert response.status_code == 200, "Availability failed with non-200 status code"
+        available_ids = [car["car_id"] for car in response.json()["cars"]]
+        assert self.car_id not in available_ids, "Booked car is still listed as available"
+
+        response = requests.post(f"{BASE_URL}/public/bookings", json=self.booking_between(11, 13))
+        print(f"Response Status (Overlapping Booking): {response.status_code}")
+        print(f"Response Body (Overlapping Booking): {response.json()}")
+        assert response.status_code == 409, "Overlapping booking did not return 409 status code"
+        print("✅ Booked cars leave availability and overlapping bookings are refused")
+
+    def test_15_cursor_pagination(self):
+        """Test that following next_cursor walks the full car list exactly once"""
+        print("\n15. Testing Cursor Pagination")
+        if not self.agency_admin_token:
+            self.test_04_create_agency()
+
+        headers = {"Authorization": f"Bearer {self.agency_admin_token}"}
+        suffix = int(time.time())
+        for i in range(5):
+            car = {**self.test_car, "title": f"Paged Car {i}", "plate_number": f"PAGE{suffix}-{i}"}
+            response = requests.post(f"{BASE_URL}/agency/cars", headers=headers, json=car)
+            assert response.status_code == 200, "Car creation failed with non-200 status code"
+
+        response = requests.get(f"{BASE_URL}/agency/{self.agency_id}/cars", headers=headers, params={"limit": 100})
+        expected_ids = [car["car_id"] for car in response.json()["cars"]]
+
+        seen_ids = []
+        params = {"limit": 2}
+        while True:
+            response = requests.get(f"{BASE_URL}/agency/{self.agency_id}/cars", headers=headers, params=params)
+            assert response.status_code == 200, "Paged car list failed with non-200 status code"
+            page = response.json()
+            seen_ids.extend(car["car_id"] for car in page["cars"])
+            if not page["next_cursor"]:
+                break
+            params["after"] = page["next_cursor"]
+        print(f"Paged through {len(seen_ids)} cars, expected {len(expected_ids)}")
+
+        assert len(seen_ids) == len(set(seen_ids)), "A car was returned on more than one page"
+        assert seen_ids == expected_ids, "Paging did not return the same cars in the same order"
+        print("✅ next_cursor pages through the full result set")
+
+    def test_16_catalog_not_modified(self):
+        """Test that the public catalog answers a matching If-None-Match with 304"""
+        print("\n16. Testing Public Catalog ETag")
+        if not self.agency_id:
+            self.test_04_create_agency()
+
+        response = requests.get(f"{BASE_URL}/public/agencies/{self.agency_id}/cars")
+        etag = response.headers.get("ETag")
+        print(f"Response Status: {response.status_code}, ETag: {etag}")
+        assert response.status_code == 200, "Get public cars failed with non-200 status code"
+        assert etag, "Public catalog response missing ETag header"
+
+        response = requests.get(
+            f"{BASE_URL}/public/agencies/{self.agency_id}/cars",
+            headers={"If-None-Match": etag}
+        )
+        print(f"Response Status (If-None-Match): {response.status_code}")
+        assert response.status_code == 304, "Matching If-None-Match did not return 304 status code"
+        assert not response.content, "304 response carried a body"
+        print("✅ Unchanged catalog is revalidated with 304")
+
+    def test_17_csv_import_errors(self):
+        """Test that a CSV import inserts valid rows and reports the invalid ones"""
+        print("\n17. Testing CSV Import Row Errors")
+        if not self.agency_admin_token:
+            self.test_04_create_agency()
+
+        suffix = int(time.time())
+        csv_body = (
+            "title,model,brand,year,plate_number,color,price_per_day,features\n"
+            f"CSV Car,Model C,Brand C,2022,CSV{suffix}-1,Red,40,GPS;Bluetooth\n"
+            f"Bad Year,Model C,Brand C,not-a-year,CSV{suffix}-2,Red,40,\n"
+            f"Duplicate Plate,Model C,Brand C,2022,CSV{suffix}-1,Red,40,\n"
+        )
+        response = requests.post(
+            f"{BASE_URL}/agency/{self.agency_id}/cars/import",
+            headers={"Authorization": f"Bearer {self.agency_admin_token}", "Content-Type": "text/csv"},
+            data=csv_body.encode()
+        )
+        print(f"Response Status: {response.status_code}")
+        print(f"Response Body: {json.dumps(response.json(), indent=2)}")
+
+        assert response.status_code == 200, "CSV import failed with non-200 status code"
+        result = response.json()
+        assert result["inserted"] == 1, "CSV import did not insert exactly the valid row"
+        assert result["failed"] == 2, "CSV import did not report both invalid rows"
+        assert [error["row"] for error in result["errors"]] == [2, 3], "CSV import reported the wrong rows"
+        print("✅ CSV import inserts valid rows and reports row errors")
+
+    def test_18_idempotent_booking(self):
+        """Test that a repeated Idempotency-Key replays the booking and rejects a different body"""
+        print("\n18. Testing Idempotent Booking")
+        if not self.car_id:
+            self.test_07_create_car()
+
+        headers = {"Idempotency-Key": f"backend-test-{time.time()}"}
+        booking = self.booking_between(20, 22)
+        first = requests.post(f"{BASE_URL}/public/bookings", headers=headers, json=booking)
+        replay = requests.post(f"{BASE_URL}/public/bookings", headers=headers, json=booking)
+        print(f"Response Status (First/Replay): {first.status_code}/{replay.status_code}")
+
+        assert first.status_code == 200, "Idempotent booking failed with non-200 status code"
+        assert replay.status_code == 200, "Replayed booking did not return 200 status code"
+        assert replay.json()["booking"]["booking_id"] == first.json()["booking"]["booking_id"], \
+            "Replay created a second booking instead of returning the first"
+
+        response = requests.post(
+            f"{BASE_URL}/public/bookings",
+            headers=headers,
+            json={**booking, "client_name": "Someone Else"}
+        )
+        print(f"Response Status (Different Body): {response.status_code}")
+        print(f"Response Body (Different Body): {response.json()}")
+        assert response.status_code == 422, "Reused key with a different body did not return 422 status code"
+        print("✅ Idempotency-Key replays the first booking and rejects a different body")
+
+    def test_19_login_rate_limit(self):
+        """Test that repeated logins are throttled with 429 and Retry-After"""
+        print("\n19. Testing Login Rate Limit")
+        # Runs last: it exhausts this client's login bucket for the next minute
+        response = None
+        for attempt in range(50):
+            response = requests.post(
+                f"{BASE_URL}/auth/login",
+                json={"email": "ratelimit@example.com", "password": "wrongpassword"}
+            )
+            if response.status_code == 429:
+                break
+        print(f"Response Status after {attempt + 1} attempts: {response.status_code}")
+        print(f"Retry-After: {response.headers.get('Retry-After')}")
+
+        assert response.status_code == 429, "Repeated logins were never throttled with 429"
+        assert int(response.headers["Retry-After"]) >= 1, "429 response missing a usable Retry-After header"
+        print("✅ Login is rate limited with 429 and Retry-After")
+
+    def test_20_car_created_despite_rollup_failure(self):
+        """Test that a stored car is returned even when its rollup update fails (no server needed)"""
+        print("\n20. Testing Car Creation With a Failing Rollup Update")
+        server = import_server()
+        from fastapi import Response
+        stored = []
+
+        async def insert_one(document):
+            stored.append(document)
+
+        async def tenant_for_write(agency_id):
+            return SimpleNamespace(db=SimpleNamespace(cars=SimpleNamespace(insert_one=insert_one)))
+
+        async def record_car_created(car):
+            raise RuntimeError("rollup write failed")
+
+        async def skip(*args):
+            pass
+
+        stubs = {
+            "tenant_for_write": tenant_for_write,
+            "record_car_created": record_car_created,
+            "invalidate_catalog": skip,
+            "deliver_jobs": skip
+        }
+        originals = {name: getattr(server, name) for name in stubs}
+        for name, stub in stubs.items():
+            setattr(server, name, stub)
+        try:
+            agency_id = "rollup-failure-test"
+            car_data = server.CarCreate(**dict(self.test_car, agency_id=agency_id))
+            user = {"user_id": "rollup-failure-test", "role": server.UserRole.AGENCY_ADMIN, "agency_id": agency_id}
+            result = asyncio.run(server.create_car(car_data, Response(), user))
+        finally:
+            for name, original in originals.items():
+                setattr(server, name, original)
+        print(f"Response Body: {result['message']}")
+
+        assert len(stored) == 1, "Car was not stored"
+        assert result["car"]["car_id"] == stored[0]["car_id"], "Response does not carry the stored car"
+        print("✅ A failed rollup update is logged and the car is still returned")
+
+    def test_21_agency_limit_spares_ip_bucket(self):
+        """Test that a 429 from the agency bucket leaves the IP bucket untouched (no server needed)"""
+        print("\n21. Testing an Agency Rate Limit Against the Caller's IP Bucket")
+        server = import_server()
+        from fastapi import HTTPException
+        from starlette.requests import Request
+
+        def request(agency_id):
+            return Request({
+                "type": "http", "method": "GET", "path": "/", "headers": [], "query_string": b"",
+                "path_params": {"agency_id": agency_id}, "client": ("203.0.113.7", 0)
+            })
+
+        async def exercise():
+            check = server.rate_limit("public_read")
+            agency_capacity, _ = server.RATE_LIMITS["public_read"]["agency"]
+            ip_capacity, _ = server.RATE_LIMITS["public_read"]["ip"]
+            # Other callers have used up the throttled agency's bucket
+            for _ in range(agency_capacity):
+                await server.charge_rate_limit("public_read", "agency", "throttled-agency")
+            try:
+                await check(request("throttled-agency"))
+                status = 200
+            except HTTPException as e:
+                status = e.status_code
+            # The refused request must not have spent one of the caller's IP tokens
+            granted = 0
+            for _ in range(ip_capacity):
+                try:
+                    await check(request("other-agency"))
+                    granted += 1
+                except HTTPException:
+                    break
+            return status, granted, ip_capacity
+
+        originals = (server.RATE_LIMIT_ENABLED, server.rate_limiter)
+        server.RATE_LIMIT_ENABLED = True
+        server.rate_limiter = server.InProcessRateLimiter(1000)
+        try:
+            status, granted, ip_capacity = asyncio.run(exercise())
+        finally:
+            server.RATE_LIMIT_ENABLED, server.rate_limiter = originals
+        print(f"Response Status (Throttled Agency): {status}")
+        print(f"Requests granted afterwards: {granted} of {ip_capacity}")
+
+        assert status == 429, "Throttled agency did not return 429 status code"
+        assert granted == ip_capacity, "Agency 429 spent a token from the caller's IP bucket"
+        print("✅ A request refused by the agency bucket keeps the caller's IP token")
+
     def run_all_tests(self):
         """Run all tests in sequence"""
         print("\n=== Starting Car Rental SaaS Backend API Tests ===\n")
@@ -318,6 +597,14 @@ class CarRentalSaaSBackendTest:
         self.test_11_create_booking()
         self.test_12_security_protected_endpoints()
         self.test_13_role_based_access_control()
+        self.test_14_availability_and_overlap()
+        self.test_15_cursor_pagination()
+        self.test_16_catalog_not_modified()
+        self.test_17_csv_import_errors()
+        self.test_18_idempotent_booking()
+        self.test_19_login_rate_limit()
+        self.test_20_car_created_despite_rollup_failure()
+        self.test_21_agency_limit_spares_ip_bucket()
         
         print("\n=== All Tests Completed ===\n")
         print("Summary:")
@@ -327,6 +614,14 @@ class CarRentalSaaSBackendTest:
         print("✅ Agency Management: Can add cars, view cars, and view bookings")
         print("✅ Public Booking: Can view public car listings and create bookings")
         print("✅ Security: Protected endpoints require authentication and respect role-based access")
+        print("✅ Bookings: Booked cars leave availability and overlapping bookings are refused")
+        print("✅ Listings: Cursor paging walks the full result set")
+        print("✅ Catalog: An unchanged public catalog is revalidated with 304")
+        print("✅ Import: CSV import inserts valid rows and reports row errors")
+        print("✅ Idempotency: A retried Idempotency-Key replays the first booking")
+        print("✅ Rate Limits: Throttled requests get 429 with Retry-After")
+        print("✅ Rate Limits: An agency 429 leaves the caller's IP bucket untouched")
+        print("✅ Side Effects: A car stays created when its rollup update fails")
 
 if __name__ == "__main__":
     tester = CarRentalSaaSBackendTest()
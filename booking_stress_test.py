@@ -0,0 +1,181 @@
+import requests
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Base URL for the API (backend must be running against a local mongod)
+# Start it with RATE_LIMIT_ENABLED=false: every request here comes from one IP
+BASE_URL = "http://localhost:8001/api"
+
+# Number of bookings fired at the same car in each round
+PARALLEL_BOOKINGS = 300
+
+
+class BookingStressTest:
+    def __init__(self):
+        self.super_admin_email = "admin@carrentalsaas.com"
+        self.super_admin_password = "admin123"
+        self.agency_id = None
+        self.agency_token = None
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=PARALLEL_BOOKINGS))
+
+    def setup(self):
+        """Create an agency and an agency admin to own the cars under test"""
+        response = self.session.post(
+            f"{BASE_URL}/auth/login",
+            json={"email": self.super_admin_email, "password": self.super_admin_password}
+        )
+        assert response.status_code == 200, "Super admin login failed"
+        admin_headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+        suffix = uuid.uuid4().hex[:8]
+        response = self.session.post(
+            f"{BASE_URL}/admin/agencies",
+            headers=admin_headers,
+            json={
+                "name": f"Stress Agency {suffix}",
+                "email": f"stress-{suffix}@agency.com",
+                "phone": "123-456-7890",
+                "address": "1 Load Street",
+            }
+        )
+        assert response.status_code == 200, "Agency creation failed"
+        self.agency_id = response.json()["agency"]["agency_id"]
+
+        response = self.session.post(
+            f"{BASE_URL}/auth/register",
+            json={
+                "email": f"stress-admin-{suffix}@agency.com",
+                "password": "stress123",
+                "first_name": "Stress",
+                "last_name": "Admin",
+                "role": "agency_admin",
+                "agency_id": self.agency_id,
+            }
+        )
+        assert response.status_code == 200, "Agency admin registration failed"
+        self.agency_token = response.json()["token"]
+
+    def create_car(self):
+        response = self.session.post(
+            f"{BASE_URL}/agency/cars",
+            headers={"Authorization": f"Bearer {self.agency_token}"},
+            json={
+                "title": "Stress Car",
+                "model": "Model S",
+                "brand": "Brand",
+                "year": 2023,
+                "plate_number": f"ST-{uuid.uuid4().hex[:6]}",
+                "color": "Red",
+                "price_per_day": 40.0,
+                "agency_id": self.agency_id,
+            }
+        )
+        assert response.status_code == 200, "Car creation failed"
+        return response.json()["car"]["car_id"]
+
+    def book(self, car_id, pickup, return_date):
+        response = self.session.post(
+            f"{BASE_URL}/public/bookings",
+            json={
+                "car_id": car_id,
+                "client_email": "stress@example.com",
+                "client_name": "Stress Client",
+                "client_phone": "555-0100",
+                "pickup_date": pickup.isoformat(),
+                "return_date": return_date.isoformat(),
+                "pickup_location": "Airport",
+                "return_location": "Airport",
+            }
+        )
+        return response.status_code, (pickup, return_date)
+
+    def fire(self, requests_to_send):
+        with ThreadPoolExecutor(max_workers=PARALLEL_BOOKINGS) as executor:
+            futures = [executor.submit(self.book, *args) for args in requests_to_send]
+            return [future.result() for future in futures]
+
+    def test_01_identical_ranges(self):
+        """Hundreds of bookings for the same car and dates: exactly one wins"""
+        print(f"\n1. Firing {PARALLEL_BOOKINGS} identical bookings at one car")
+        car_id = self.create_car()
+        pickup = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=30)
+        results = self.fire([(car_id, pickup, pickup + timedelta(days=3))] * PARALLEL_BOOKINGS)
+
+        codes = [code for code, _ in results]
+        print(f"Accepted: {codes.count(200)}, Conflicts: {codes.count(409)}, Busy: {codes.count(503)}")
+        assert codes.count(200) == 1, f"Expected exactly one winner, got {codes.count(200)}"
+        # Losers either saw the winner's booking (409) or its lock (503 + Retry-After)
+        assert set(codes) - {200} <= {409, 503}, f"Unexpected status codes: {set(codes)}"
+        print("✅ Exactly one booking won")
+
+    def test_02_staggered_ranges(self):
+        """Overlapping ranges shifted by one day: accepted bookings never overlap"""
+        print(f"\n2. Firing {PARALLEL_BOOKINGS} staggered overlapping bookings at one car")
+        car_id = self.create_car()
+        base = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=60)
+        ranges = [
+            (car_id, base + timedelta(days=i % 30), base + timedelta(days=i % 30 + 3))
+            for i in range(PARALLEL_BOOKINGS)
+        ]
+        results = self.fire(ranges)
+
+        accepted = sorted(period for code, period in results if code == 200)
+        codes = {code for code, _ in results}
+        print(f"Accepted {len(accepted)} non-conflicting bookings")
+        # 503 means the car's days stayed locked by another attempt; clients retry it
+        assert codes <= {200, 409, 503}, f"Unexpected status codes: {codes}"
+        assert accepted, "No booking was accepted"
+        for (_, previous_return), (next_pickup, _) in zip(accepted, accepted[1:]):
+            assert next_pickup >= previous_return, "Two accepted bookings overlap"
+        print("✅ One winner per overlapping range")
+
+    def test_03_unrelated_cars(self):
+        """Bookings for distinct cars do not contend with each other"""
+        print("\n3. Firing parallel bookings at distinct cars")
+        car_ids = [self.create_car() for _ in range(20)]
+        pickup = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=30)
+        results = self.fire([(car_id, pickup, pickup + timedelta(days=3)) for car_id in car_ids])
+
+        codes = [code for code, _ in results]
+        assert codes.count(200) == len(car_ids), f"Unrelated cars conflicted: {codes}"
+        print("✅ Every car accepted its booking")
+
+    def test_04_boundary_days(self):
+        """Ranges that meet inside a UTC day: real overlaps lose, same-day neighbours both win"""
+        print(f"\n4. Firing {PARALLEL_BOOKINGS} bookings whose ranges share a boundary day")
+        day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=90)
+        half = PARALLEL_BOOKINGS // 2
+
+        # Overlap on the return day of the first range
+        car_id = self.create_car()
+        first = (car_id, day + timedelta(hours=10), day + timedelta(days=2, hours=10))
+        second = (car_id, day + timedelta(days=2, hours=8), day + timedelta(days=3))
+        codes = [code for code, _ in self.fire([first, second] * half)]
+        print(f"Overlapping: accepted {codes.count(200)}, conflicts {codes.count(409)}")
+        assert codes.count(200) == 1, f"Expected one winner across overlapping ranges, got {codes.count(200)}"
+
+        # Same day, no overlap: one booking per range must win
+        car_id = self.create_car()
+        morning = (car_id, day + timedelta(hours=10), day + timedelta(hours=18))
+        overnight = (car_id, day + timedelta(hours=19), day + timedelta(days=1, hours=9))
+        results = self.fire([morning, overnight] * half)
+        accepted = sorted(period for code, period in results if code == 200)
+        print(f"Same-day neighbours: accepted {len(accepted)}")
+        assert accepted == [morning[1:], overnight[1:]], f"Expected both ranges accepted once, got {accepted}"
+        print("✅ Boundary days decided by the exact overlap")
+
+    def run_all_tests(self):
+        print("\n=== Starting Booking Reservation Stress Tests ===\n")
+        self.setup()
+        self.test_01_identical_ranges()
+        self.test_02_staggered_ranges()
+        self.test_03_unrelated_cars()
+        self.test_04_boundary_days()
+        print("\n=== All Stress Tests Completed ===\n")
+
+
+if __name__ == "__main__":
+    tester = BookingStressTest()
+    tester.run_all_tests()
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Routes, Route, Link, useLocation } from 'react-router-dom';
 import { useAuth } from '../contexts/AuthContext';
 import axios from 'axios';
@@ -13,9 +13,77 @@ import {
   Edit,
   Trash2,
   Eye,
-  ExternalLink
+  ExternalLink,
+  Upload
 } from 'lucide-react';
 
+// List views ask the API for only the fields they render
+const FLEET_FIELDS = 'title,brand,model,year,color,plate_number,price_per_day,features,status';
+const BOOKING_FIELDS = 'car_id,client_name,client_email,client_phone,pickup_date,return_date,' +
+  'pickup_location,return_location,status,total_amount';
+const BOOKING_CAR_FIELDS = 'title,brand,model';
+
+// Follows the agency's server-sent event stream while the calling component is
+// mounted. fetch is used instead of EventSource so the bearer token travels in
+// a header rather than the URL. After a reconnect the handler gets a 'resync'
+// event, since anything published while disconnected was missed.
+const useAgencyEvents = (agencyId, onEvent) => {
+  const handler = useRef(onEvent);
+  handler.current = onEvent;
+
+  useEffect(() => {
+    if (!agencyId) return undefined;
+    const controller = new AbortController();
+    let retryDelay = 1000;
+    let connectedBefore = false;
+
+    const dispatch = (message) => {
+      let type = 'message';
+      let data = '';
+      message.split('\n').forEach((line) => {
+        if (line.startsWith('event: ')) type = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      });
+      if (data) handler.current(type, JSON.parse(data));
+    };
+
+    const connect = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`/api/agency/${agencyId}/events`, {
+            headers: { Authorization: axios.defaults.headers.common['Authorization'] },
+            signal: controller.signal
+          });
+          if (response.status === 401 || response.status === 403) return;
+          if (!response.ok) throw new Error(`Event stream returned ${response.status}`);
+          if (connectedBefore) handler.current('resync', {});
+          connectedBefore = true;
+          retryDelay = 1000;
+
+          const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+          let buffer = '';
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+            const messages = buffer.split('\n\n');
+            buffer = messages.pop();
+            messages.forEach(dispatch);
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          console.error('Event stream error:', error);
+        }
+        await new Promise(resolve => setTimeout(resolve, retryDelay));
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      }
+    };
+
+    connect();
+    return () => controller.abort();
+  }, [agencyId]);
+};
+
 const AgencyDashboard = () => {
   const { user, logout } = useAuth();
   const location = useLocation();
@@ -112,23 +180,21 @@ const AgencyDashboard = () => {
 
 const AgencyOverview = () => {
   const { user } = useAuth();
-  const [cars, setCars] = useState([]);
-  const [bookings, setBookings] = useState([]);
+  const [summary, setSummary] = useState(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
     fetchData();
   }, []);
 
+  useAgencyEvents(user.agency_id, (type) => {
+    if (type !== 'agency.status') fetchData();
+  });
+
   const fetchData = async () => {
     try {
-      const [carsResponse, bookingsResponse] = await Promise.all([
-        axios.get(`/api/agency/${user.agency_id}/cars`),
-        axios.get(`/api/agency/${user.agency_id}/bookings`)
-      ]);
-      
-      setCars(carsResponse.data.cars);
-      setBookings(bookingsResponse.data.bookings);
+      const response = await axios.get(`/api/agency/${user.agency_id}/summary`);
+      setSummary(response.data);
     } catch (error) {
       console.error('Error fetching data:', error);
     } finally {
@@ -144,11 +210,7 @@ const AgencyOverview = () => {
     );
   }
 
-  const todayBookings = bookings.filter(booking => 
-    new Date(booking.pickup_date).toDateString() === new Date().toDateString()
-  );
-
-  const pendingBookings = bookings.filter(booking => booking.status === 'pending');
+  const recentBookings = summary?.recent_bookings || [];
 
   return (
     <div>
@@ -166,7 +228,7 @@ const AgencyOverview = () => {
             </div>
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-500">Total Fleet</p>
-              <p className="text-2xl font-bold text-gray-900">{cars.length}</p>
+              <p className="text-2xl font-bold text-gray-900">{summary?.fleet.total || 0}</p>
             </div>
           </div>
         </div>
@@ -178,7 +240,7 @@ const AgencyOverview = () => {
             </div>
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-500">Today's Pickups</p>
-              <p className="text-2xl font-bold text-gray-900">{todayBookings.length}</p>
+              <p className="text-2xl font-bold text-gray-900">{summary?.pickups_today || 0}</p>
             </div>
           </div>
         </div>
@@ -190,7 +252,7 @@ const AgencyOverview = () => {
             </div>
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-500">Pending Bookings</p>
-              <p className="text-2xl font-bold text-gray-900">{pendingBookings.length}</p>
+              <p className="text-2xl font-bold text-gray-900">{summary?.bookings.by_status.pending || 0}</p>
             </div>
           </div>
         </div>
@@ -202,7 +264,7 @@ const AgencyOverview = () => {
             </div>
             <div className="ml-4">
               <p className="text-sm font-medium text-gray-500">Total Bookings</p>
-              <p className="text-2xl font-bold text-gray-900">{bookings.length}</p>
+              <p className="text-2xl font-bold text-gray-900">{summary?.bookings.total || 0}</p>
             </div>
           </div>
         </div>
@@ -260,8 +322,8 @@ const AgencyOverview = () => {
               </tr>
             </thead>
             <tbody className="bg-white divide-y divide-gray-200">
-              {bookings.slice(0, 5).map((booking) => {
-                const car = cars.find(c => c.car_id === booking.car_id);
+              {recentBookings.map((booking) => {
+                const car = booking.car;
                 return (
                   <tr key={booking.booking_id} className="hover:bg-gray-50">
                     <td className="px-6 py-4 whitespace-nowrap">
@@ -298,7 +360,7 @@ const AgencyOverview = () => {
             </tbody>
           </table>
           
-          {bookings.length === 0 && (
+          {recentBookings.length === 0 && (
             <div className="text-center py-8">
               <Calendar className="h-12 w-12 text-gray-400 mx-auto mb-4" />
               <p className="text-gray-500">No bookings yet. Share your booking link to get started!</p>
@@ -313,17 +375,57 @@ const AgencyOverview = () => {
 const FleetManagement = () => {
   const { user } = useAuth();
   const [cars, setCars] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [showCreateForm, setShowCreateForm] = useState(false);
+  const [importing, setImporting] = useState(false);
+  const [importResult, setImportResult] = useState(null);
 
   useEffect(() => {
     fetchCars();
   }, []);
 
-  const fetchCars = async () => {
+  useAgencyEvents(user.agency_id, (type, data) => {
+    if (type === 'car.created' || type === 'car.updated') {
+      setCars(prev => {
+        if (prev.some(car => car.car_id === data.car.car_id)) {
+          return prev.map(car => car.car_id === data.car.car_id ? data.car : car);
+        }
+        return type === 'car.created' ? [data.car, ...prev] : prev;
+      });
+    } else if (type === 'fleet.imported' || type === 'resync') {
+      fetchCars();
+    }
+  });
+
+  const handleImport = async (e) => {
+    const file = e.target.files[0];
+    e.target.value = '';
+    if (!file) return;
+
+    setImporting(true);
+    setImportResult(null);
+    try {
+      const response = await axios.post(`/api/agency/${user.agency_id}/cars/import`, file, {
+        headers: { 'Content-Type': 'text/csv' }
+      });
+      setImportResult(response.data);
+      fetchCars();
+    } catch (error) {
+      setImportResult({ message: error.response?.data?.detail || 'Import failed', errors: [] });
+    } finally {
+      setImporting(false);
+    }
+  };
+
+  const fetchCars = async (after = null) => {
     try {
-      const response = await axios.get(`/api/agency/${user.agency_id}/cars`);
-      setCars(response.data.cars);
+      const response = await axios.get(`/api/agency/${user.agency_id}/cars`, {
+        params: { after: after || undefined, fields: FLEET_FIELDS }
+      });
+      setCars(prev => after ? [...prev, ...response.data.cars] : response.data.cars);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Error fetching cars:', error);
     } finally {
@@ -331,6 +433,12 @@ const FleetManagement = () => {
     }
   };
 
+  const loadMore = async () => {
+    setLoadingMore(true);
+    await fetchCars(nextCursor);
+    setLoadingMore(false);
+  };
+
   if (loading) {
     return (
       <div className="flex items-center justify-center h-64">
@@ -346,15 +454,40 @@ const FleetManagement = () => {
           <h1 className="text-2xl font-bold text-gray-900">Fleet Management</h1>
           <p className="text-gray-600">Manage your car inventory and availability.</p>
         </div>
-        <button
-          onClick={() => setShowCreateForm(true)}
-          className="bg-primary text-white px-4 py-2 rounded-lg hover:bg-primary-600 flex items-center"
-        >
-          <Plus className="h-4 w-4 mr-2" />
-          Add Car
-        </button>
+        <div className="flex space-x-3">
+          <label className={`border border-gray-300 text-gray-700 px-4 py-2 rounded-lg hover:bg-gray-50 flex items-center cursor-pointer ${importing ? 'opacity-50' : ''}`}>
+            <Upload className="h-4 w-4 mr-2" />
+            {importing ? 'Importing...' : 'Import CSV'}
+            <input type="file" accept=".csv,text/csv" className="hidden" onChange={handleImport} disabled={importing} />
+          </label>
+          <button
+            onClick={() => setShowCreateForm(true)}
+            className="bg-primary text-white px-4 py-2 rounded-lg hover:bg-primary-600 flex items-center"
+          >
+            <Plus className="h-4 w-4 mr-2" />
+            Add Car
+          </button>
+        </div>
       </div>
 
+      {importResult && (
+        <div className="bg-white rounded-lg card-shadow p-4 mb-6">
+          <div className="flex justify-between items-center">
+            <p className="text-sm font-medium text-gray-900">{importResult.message}</p>
+            <button onClick={() => setImportResult(null)} className="text-sm text-gray-500 hover:text-gray-700">
+              Dismiss
+            </button>
+          </div>
+          {importResult.errors.length > 0 && (
+            <ul className="mt-2 text-sm text-red-600 space-y-1 max-h-40 overflow-y-auto">
+              {importResult.errors.map((error) => (
+                <li key={error.row}>Row {error.row}: {error.error}</li>
+              ))}
+            </ul>
+          )}
+        </div>
+      )}
+
       <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-6">
         {cars.map((car) => (
           <div key={car.car_id} className="bg-white rounded-lg card-shadow card-shadow-hover">
@@ -425,6 +558,18 @@ const FleetManagement = () => {
         ))}
       </div>
 
+      {nextCursor && (
+        <div className="text-center mt-8">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="border border-gray-300 text-gray-700 px-6 py-2 rounded-lg hover:bg-gray-50 disabled:opacity-50"
+          >
+            {loadingMore ? 'Loading...' : 'Load More Cars'}
+          </button>
+        </div>
+      )}
+
       {cars.length === 0 && (
         <div className="bg-white rounded-lg card-shadow">
           <div className="text-center py-12">
@@ -663,22 +808,64 @@ const CreateCarModal = ({ onClose, onSuccess }) => {
 const BookingsManagement = () => {
   const { user } = useAuth();
   const [bookings, setBookings] = useState([]);
-  const [cars, setCars] = useState([]);
+  const [cars, setCars] = useState({});
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchData();
   }, []);
 
-  const fetchData = async () => {
+  useAgencyEvents(user.agency_id, async (type, data) => {
+    if (type === 'resync') {
+      fetchData();
+      return;
+    }
+    if (type !== 'booking.created' && type !== 'booking.updated') return;
+
+    const { booking } = data;
+    setBookings(prev => {
+      if (prev.some(item => item.booking_id === booking.booking_id)) {
+        return prev.map(item => item.booking_id === booking.booking_id ? booking : item);
+      }
+      return type === 'booking.created' ? [booking, ...prev] : prev;
+    });
+    let car = data.car;
+    if (!car && !cars[booking.car_id]) {
+      const response = await axios.get(`/api/agency/${user.agency_id}/cars`, {
+        params: { car_id: booking.car_id, limit: 1, fields: BOOKING_CAR_FIELDS }
+      });
+      car = response.data.cars[0];
+    }
+    if (car) setCars(prev => ({ ...prev, [car.car_id]: car }));
+  });
+
+  const fetchData = async (after = null) => {
     try {
-      const [bookingsResponse, carsResponse] = await Promise.all([
-        axios.get(`/api/agency/${user.agency_id}/bookings`),
-        axios.get(`/api/agency/${user.agency_id}/cars`)
-      ]);
+      const bookingsResponse = await axios.get(`/api/agency/${user.agency_id}/bookings`, {
+        params: { after: after || undefined, fields: BOOKING_FIELDS }
+      });
+      const page = bookingsResponse.data.bookings;
       
-      setBookings(bookingsResponse.data.bookings);
-      setCars(carsResponse.data.cars);
+      // Only fetch the cars referenced by this page that we have not seen yet
+      const missingCarIds = [...new Set(page.map(booking => booking.car_id))]
+        .filter(carId => !cars[carId]);
+      let pageCars = [];
+      if (missingCarIds.length > 0) {
+        const carsResponse = await axios.get(`/api/agency/${user.agency_id}/cars`, {
+          params: { car_id: missingCarIds, limit: missingCarIds.length, fields: BOOKING_CAR_FIELDS },
+          paramsSerializer: { indexes: null }
+        });
+        pageCars = carsResponse.data.cars;
+      }
+      
+      setBookings(prev => after ? [...prev, ...page] : page);
+      setCars(prev => ({
+        ...prev,
+        ...Object.fromEntries(pageCars.map(car => [car.car_id, car]))
+      }));
+      setNextCursor(bookingsResponse.data.next_cursor);
     } catch (error) {
       console.error('Error fetching data:', error);
     } finally {
@@ -686,6 +873,12 @@ const BookingsManagement = () => {
     }
   };
 
+  const loadMore = async () => {
+    setLoadingMore(true);
+    await fetchData(nextCursor);
+    setLoadingMore(false);
+  };
+
   if (loading) {
     return (
       <div className="flex items-center justify-center h-64">
@@ -731,7 +924,7 @@ const BookingsManagement = () => {
             </thead>
             <tbody className="bg-white divide-y divide-gray-200">
               {bookings.map((booking) => {
-                const car = cars.find(c => c.car_id === booking.car_id);
+                const car = cars[booking.car_id];
                 return (
                   <tr key={booking.booking_id} className="hover:bg-gray-50">
                     <td className="px-6 py-4 whitespace-nowrap">
@@ -791,6 +984,18 @@ const BookingsManagement = () => {
             </tbody>
           </table>
           
+          {nextCursor && (
+            <div className="text-center py-4 border-t border-gray-200">
+              <button
+                onClick={loadMore}
+                disabled={loadingMore}
+                className="text-primary hover:text-primary-600 font-medium disabled:opacity-50"
+              >
+                {loadingMore ? 'Loading...' : 'Load More Bookings'}
+              </button>
+            </div>
+          )}
+
           {bookings.length === 0 && (
             <div className="text-center py-12">
               <Calendar className="h-16 w-16 text-gray-400 mx-auto mb-4" />
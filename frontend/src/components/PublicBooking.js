@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useParams } from 'react-router-dom';
 import axios from 'axios';
 import DatePicker from 'react-datepicker';
@@ -17,6 +17,10 @@ import {
   Shield
 } from 'lucide-react';
 
+// The catalog page renders only these fields
+const CATALOG_CAR_FIELDS = 'agency_id,title,brand,model,year,price_per_day,features';
+const CATALOG_AGENCY_FIELDS = 'name,address,phone,email';
+
 const PublicBooking = () => {
   const { agencyId } = useParams();
   const [agency, setAgency] = useState(null);
@@ -32,7 +36,9 @@ const PublicBooking = () => {
 
   const fetchAgencyData = async () => {
     try {
-      const response = await axios.get(`/api/public/agencies/${agencyId}/cars`);
+      const response = await axios.get(`/api/public/agencies/${agencyId}/cars`, {
+        params: { fields: CATALOG_CAR_FIELDS, agency_fields: CATALOG_AGENCY_FIELDS }
+      });
       setAgency(response.data.agency);
       setCars(response.data.cars);
     } catch (error) {
@@ -242,6 +248,9 @@ const BookingModal = ({ car, agency, onClose }) => {
   const [loading, setLoading] = useState(false);
   const [success, setSuccess] = useState(false);
   const [error, setError] = useState('');
+  // Reused when a submit is retried after a network failure, so the server
+  // can recognise the retry instead of creating a second booking
+  const idempotencyKey = useRef(null);
 
   const calculateDays = () => {
     const pickupDate = new Date(formData.pickup_date);
@@ -251,7 +260,33 @@ const BookingModal = ({ car, agency, onClose }) => {
     return diffDays || 1;
   };
 
-  const totalAmount = calculateDays() * car.price_per_day;
+  // The server applies the agency's seasonal, weekend and long-rental rules;
+  // the flat estimate only shows until its quote arrives
+  const [quote, setQuote] = useState(null);
+
+  useEffect(() => {
+    if (formData.return_date <= formData.pickup_date) {
+      setQuote(null);
+      return undefined;
+    }
+    let cancelled = false;
+    axios.get(`/api/public/agencies/${car.agency_id}/quotes`, {
+      params: {
+        from: formData.pickup_date.toISOString(),
+        to: formData.return_date.toISOString(),
+        car_id: car.car_id
+      }
+    })
+      .then(response => {
+        if (!cancelled) setQuote(response.data.quotes[0] || null);
+      })
+      .catch(() => {
+        if (!cancelled) setQuote(null);
+      });
+    return () => { cancelled = true; };
+  }, [car.agency_id, car.car_id, formData.pickup_date, formData.return_date]);
+
+  const totalAmount = quote ? quote.total_amount : calculateDays() * car.price_per_day;
 
   const handleSubmit = async (e) => {
     e.preventDefault();
@@ -271,10 +306,20 @@ const BookingModal = ({ car, agency, onClose }) => {
         message: formData.message
       };
 
-      await axios.post('/api/public/bookings', bookingData);
+      if (!idempotencyKey.current) {
+        idempotencyKey.current = crypto.randomUUID();
+      }
+      await axios.post('/api/public/bookings', bookingData, {
+        headers: { 'Idempotency-Key': idempotencyKey.current }
+      });
+      idempotencyKey.current = null;
       setSuccess(true);
     } catch (error) {
       console.error('Booking error:', error);
+      if (error.response) {
+        // The server answered, so edits to the form start a fresh request
+        idempotencyKey.current = null;
+      }
       setError(error.response?.data?.detail || 'Failed to create booking');
     } finally {
       setLoading(false);
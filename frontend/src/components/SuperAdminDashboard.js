@@ -14,6 +14,9 @@ import {
   DollarSign
 } from 'lucide-react';
 
+// The agencies table renders only these fields
+const AGENCY_FIELDS = 'name,email,phone,address,status,created_at';
+
 const SuperAdminDashboard = () => {
   const { user, logout } = useAuth();
   const location = useLocation();
@@ -209,17 +212,22 @@ const AdminOverview = () => {
 
 const AgenciesManagement = () => {
   const [agencies, setAgencies] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [showCreateForm, setShowCreateForm] = useState(false);
 
   useEffect(() => {
     fetchAgencies();
   }, []);
 
-  const fetchAgencies = async () => {
+  const fetchAgencies = async (after = null) => {
     try {
-      const response = await axios.get('/api/admin/agencies');
-      setAgencies(response.data.agencies);
+      const response = await axios.get('/api/admin/agencies', {
+        params: { after: after || undefined, fields: AGENCY_FIELDS }
+      });
+      setAgencies(prev => after ? [...prev, ...response.data.agencies] : response.data.agencies);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Error fetching agencies:', error);
     } finally {
@@ -227,6 +235,12 @@ const AgenciesManagement = () => {
     }
   };
 
+  const loadMore = async () => {
+    setLoadingMore(true);
+    await fetchAgencies(nextCursor);
+    setLoadingMore(false);
+  };
+
   if (loading) {
     return (
       <div className="flex items-center justify-center h-64">
@@ -300,6 +314,18 @@ const AgenciesManagement = () => {
             </tbody>
           </table>
           
+          {nextCursor && (
+            <div className="text-center py-4 border-t border-gray-200">
+              <button
+                onClick={loadMore}
+                disabled={loadingMore}
+                className="text-primary hover:text-primary-600 font-medium disabled:opacity-50"
+              >
+                {loadingMore ? 'Loading...' : 'Load More Agencies'}
+              </button>
+            </div>
+          )}
+
           {agencies.length === 0 && (
             <div className="text-center py-8">
               <Building2 className="h-12 w-12 text-gray-400 mx-auto mb-4" />
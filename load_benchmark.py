@@ -0,0 +1,489 @@
+"""Seeded multi-tenant load benchmark for the Car Rental SaaS API.
+
+    python load_benchmark.py seed [--agencies 2000 --cars-per-agency 100 --bookings-per-car 10]
+    python load_benchmark.py run [--duration 60 --concurrency 200]
+    python load_benchmark.py run --update-baseline
+    python load_benchmark.py run --no-compare
+
+`seed` bulk-inserts agencies, agency admins, cars and bookings straight into
+the local mongod the backend uses, then builds indexes and analytics rollups.
+`run` drives a weighted mix of the API routes against a running backend
+(scenarios() names the two it leaves out and why), reports RPS, p50/p95/p99
+latency and error rate per route, and exits non-zero when a route regresses
+against benchmark_baseline.json or that file is missing. Record it from a
+reference run with --update-baseline; --no-compare only reports. All traffic
+comes from one IP, so start the backend with RATE_LIMIT_ENABLED=false.
+
+Requires httpx in addition to the backend requirements.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+ROOT_URL = "http://localhost:8001"
+BASE_URL = f"{ROOT_URL}/api"
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/car_rental_saas")
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+SUPER_ADMIN = {"email": "admin@carrentalsaas.com", "password": "admin123"}
+AGENCY_ADMIN_PASSWORD = "bench123"
+INSERT_BATCH_SIZE = 10000
+IMPORT_ROWS_PER_REQUEST = 20
+
+# A route regresses when p95 grows or throughput drops by more than this share
+# of its baseline, or its error rate rises by more than ERROR_RATE_TOLERANCE
+LATENCY_TOLERANCE = 0.25
+THROUGHPUT_TOLERANCE = 0.25
+ERROR_RATE_TOLERANCE = 0.01
+
+BRANDS = {
+    "Toyota": ["Corolla", "Camry", "RAV4", "Yaris"],
+    "Volkswagen": ["Golf", "Polo", "Passat", "Tiguan"],
+    "Renault": ["Clio", "Megane", "Captur"],
+    "BMW": ["320i", "X1", "X3"],
+    "Hyundai": ["i10", "i20", "Tucson"],
+}
+COLORS = ["White", "Black", "Silver", "Blue", "Red", "Grey"]
+FEATURES = [
+    "GPS", "Automatic", "Manual", "Air Conditioning", "Baby Seat",
+    "Bluetooth", "USB Charging", "Backup Camera", "Sunroof", "Leather Seats"
+]
+LOCATIONS = ["Airport", "Downtown", "Train Station", "Harbor", "Hotel"]
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Seeder:
+    def __init__(self, agencies, cars_per_agency, bookings_per_car):
+        self.agencies = agencies
+        self.cars_per_agency = cars_per_agency
+        self.bookings_per_car = bookings_per_car
+        self.db = MongoClient(MONGO_URL).car_rental_saas
+
+    def flush(self, collection, docs):
+        if docs:
+            self.db[collection].insert_many(docs, ordered=False)
+            docs.clear()
+
+    def seed(self):
+        import server
+
+        print(f"\n=== Seeding {self.agencies} agencies, {self.agencies * self.cars_per_agency} cars, "
+              f"{self.agencies * self.cars_per_agency * self.bookings_per_car} bookings ===\n")
+        started = time.perf_counter()
+        # One hash shared by every seeded admin keeps seeding CPU-cheap
+        password_hash = server.hash_password(AGENCY_ADMIN_PASSWORD)
+        now = datetime.utcnow()
+        agencies, users, cars, bookings = [], [], [], []
+
+        for a in range(self.agencies):
+            agency_id = str(uuid.uuid4())
+            agencies.append({
+                "agency_id": agency_id,
+                "name": f"Bench Agency {a}",
+                "email": f"agency{a}@bench.example.com",
+                "phone": "555-0100",
+                "address": f"{a} Benchmark Avenue",
+                "description": "Seeded by load_benchmark.py",
+                "status": "active",
+                "created_at": now - timedelta(days=random.randint(30, 1000)),
+            })
+            users.append({
+                "user_id": str(uuid.uuid4()),
+                "email": f"admin{a}@bench.example.com",
+                "password": password_hash,
+                "first_name": "Bench",
+                "last_name": f"Admin {a}",
+                "role": "agency_admin",
+                "agency_id": agency_id,
+                "created_at": now,
+            })
+            for c in range(self.cars_per_agency):
+                car_id = str(uuid.uuid4())
+                brand = random.choice(list(BRANDS))
+                price = float(random.randint(25, 250))
+                cars.append({
+                    "car_id": car_id,
+                    "title": f"{brand} {c}",
+                    "model": random.choice(BRANDS[brand]),
+                    "brand": brand,
+                    "year": random.randint(2012, 2024),
+                    "plate_number": f"B{a:05d}-{c:04d}",
+                    "color": random.choice(COLORS),
+                    "price_per_day": price,
+                    "features": random.sample(FEATURES, random.randint(1, 5)),
+                    "agency_id": agency_id,
+                    "status": "available",
+                    "created_at": now - timedelta(days=random.randint(1, 900)),
+                })
+                # Mostly history, with the newest booking on each car in the future
+                pickup = now - timedelta(days=random.randint(700, 900))
+                for b in range(self.bookings_per_car):
+                    pickup += timedelta(days=random.randint(3, 60))
+                    days = random.randint(1, 10)
+                    return_date = pickup + timedelta(days=days)
+                    future = pickup > now
+                    booking_id = str(uuid.uuid4())
+                    bookings.append({
+                        "booking_id": booking_id,
+                        "car_id": car_id,
+                        "agency_id": agency_id,
+                        "client_email": f"client{b}@bench.example.com",
+                        "client_name": f"Client {b}",
+                        "client_phone": "555-0199",
+                        "pickup_date": pickup,
+                        "return_date": return_date,
+                        "pickup_location": random.choice(LOCATIONS),
+                        "return_location": random.choice(LOCATIONS),
+                        "message": None,
+                        "status": random.choice(["pending", "confirmed"]) if future
+                        else random.choice(["returned", "returned", "returned", "cancelled"]),
+                        "total_amount": price * days,
+                        "created_at": pickup - timedelta(days=random.randint(1, 30)),
+                    })
+                    pickup = return_date
+
+                if len(bookings) >= INSERT_BATCH_SIZE:
+                    self.flush("bookings", bookings)
+                if len(cars) >= INSERT_BATCH_SIZE:
+                    self.flush("cars", cars)
+
+            if len(agencies) >= INSERT_BATCH_SIZE:
+                self.flush("agencies", agencies)
+                self.flush("users", users)
+            if (a + 1) % 100 == 0:
+                print(f"  {a + 1}/{self.agencies} agencies ({time.perf_counter() - started:.0f}s)")
+
+        for collection, docs in (("agencies", agencies), ("users", users), ("cars", cars),
+                                 ("bookings", bookings)):
+            self.flush(collection, docs)
+
+        print("Building indexes and analytics rollups")
+        asyncio.run(self.finish(server))
+        print(f"✅ Seeding completed in {time.perf_counter() - started:.0f}s")
+
+    async def finish(self, server):
+        await server.ensure_indexes()
+        await server.rebuild_rollups()
+
+
+class LoadBenchmark:
+    def __init__(self, duration, concurrency, sample_agencies):
+        self.duration = duration
+        self.concurrency = concurrency
+        self.sample_agencies = sample_agencies
+        self.latencies = {}
+        self.errors = {}
+        self.super_admin_headers = None
+        self.tenants = []
+
+    async def setup(self, client):
+        """Log in once as the super admin and as a sample of seeded agency admins"""
+        response = await client.post(f"{BASE_URL}/auth/login", json=SUPER_ADMIN)
+        assert response.status_code == 200, "Super admin login failed"
+        self.super_admin_headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+        db = MongoClient(MONGO_URL).car_rental_saas
+        admins = list(db.users.aggregate([
+            {"$match": {"role": "agency_admin", "email": {"$regex": "@bench\\.example\\.com$"}}},
+            {"$sample": {"size": self.sample_agencies}},
+        ]))
+        assert admins, "No seeded agencies found, run `python load_benchmark.py seed` first"
+        for admin in admins:
+            response = await client.post(
+                f"{BASE_URL}/auth/login",
+                json={"email": admin["email"], "password": AGENCY_ADMIN_PASSWORD}
+            )
+            assert response.status_code == 200, f"Login failed for {admin['email']}"
+            car_ids = [car["car_id"] for car in db.cars.find(
+                {"agency_id": admin["agency_id"]}, {"car_id": 1}
+            ).limit(200)]
+            self.tenants.append({
+                "agency_id": admin["agency_id"],
+                "email": admin["email"],
+                "headers": {"Authorization": f"Bearer {response.json()['token']}"},
+                "car_ids": car_ids,
+            })
+
+    def scenarios(self):
+        """(name, weight, request builder, accepted status codes) for every route"""
+        def tenant():
+            return random.choice(self.tenants)
+
+        def future_range():
+            pickup = datetime.utcnow() + timedelta(days=random.randint(30, 400), hours=random.randint(0, 23))
+            return pickup, pickup + timedelta(days=random.randint(1, 7))
+
+        def public_booking():
+            t = tenant()
+            pickup, return_date = future_range()
+            return "POST", "/public/bookings", None, {
+                "car_id": random.choice(t["car_ids"]),
+                "client_email": "load@bench.example.com",
+                "client_name": "Load Client",
+                "client_phone": "555-0142",
+                "pickup_date": pickup.isoformat(),
+                "return_date": return_date.isoformat(),
+                "pickup_location": "Airport",
+                "return_location": "Airport",
+            }
+
+        def availability():
+            pickup, return_date = future_range()
+            return "GET", f"/public/agencies/{tenant()['agency_id']}/availability", None, {
+                "from": pickup.isoformat(), "to": return_date.isoformat()
+            }
+
+        def quotes():
+            pickup, return_date = future_range()
+            return "GET", f"/public/agencies/{tenant()['agency_id']}/quotes", None, {
+                "from": pickup.isoformat(), "to": return_date.isoformat()
+            }
+
+        def search():
+            # Mix cross-agency brand browsing with facets, one agency's fleet,
+            # a price band and the newest cars
+            params = random.choice([
+                {"brand": random.choice(list(BRANDS)), "facets": "true"},
+                {"agency_id": tenant()["agency_id"], "color": random.choice(COLORS)},
+                {"min_price": 30, "max_price": random.choice([60, 90, 120]), "sort": "price"},
+                {"sort": "-year"},
+            ])
+            return "GET", "/public/cars/search", None, params
+
+        def import_cars():
+            t = tenant()
+            return "POST", f"/agency/{t['agency_id']}/cars/import", t["headers"], [{
+                "title": "Imported Car", "model": "Clio", "brand": "Renault", "year": 2021,
+                "plate_number": f"I-{uuid.uuid4().hex[:8]}", "color": random.choice(COLORS),
+                "price_per_day": float(random.randint(25, 250)), "features": ["GPS"],
+            } for _ in range(IMPORT_ROWS_PER_REQUEST)]
+
+        def update_pricing():
+            t = tenant()
+            return "PUT", f"/agency/{t['agency_id']}/pricing", t["headers"], {
+                "seasons": [{"name": "Summer", "start": "06-15", "end": "08-31", "multiplier": 1.3}],
+                "weekend_multiplier": random.choice([1.0, 1.1, 1.2]),
+                "duration_tiers": [{"min_days": 7, "discount": 0.1}],
+            }
+
+        def events():
+            t = tenant()
+            return "STREAM", f"/agency/{t['agency_id']}/events", t["headers"], None
+
+        def create_car():
+            t = tenant()
+            return "POST", "/agency/cars", t["headers"], {
+                "title": "Load Car", "model": "Golf", "brand": "Volkswagen", "year": 2022,
+                "plate_number": f"L-{uuid.uuid4().hex[:8]}", "color": "White",
+                "price_per_day": 45.0, "features": ["GPS"], "agency_id": t["agency_id"],
+            }
+
+        def agency_get(path, params=None):
+            def build():
+                t = tenant()
+                return "GET", f"/agency/{t['agency_id']}/{path}", t["headers"], params
+            return build
+
+        def admin_get(path, params=None):
+            return lambda: ("GET", path, self.super_admin_headers, params)
+
+        def daily_params():
+            end = datetime.utcnow()
+            return {"from": (end - timedelta(days=30)).isoformat(), "to": end.isoformat()}
+
+        # Not driven: PUT /admin/agencies/{id}/status would suspend seeded
+        # agencies and lock their admins out mid-run, and POST
+        # /admin/analytics/rebuild recomputes every rollup over the whole
+        # dataset, a maintenance job rather than traffic
+        return [
+            ("GET /health", 2, lambda: ("GET", "/health", None, None), {200}),
+            ("GET /ready", 1, lambda: ("GET", "/ready", None, None), {200}),
+            ("GET /metrics", 1, lambda: ("GET", f"{ROOT_URL}/metrics", None, None), {200}),
+            ("POST /auth/login", 1, lambda: ("POST", "/auth/login", None, {
+                "email": tenant()["email"], "password": AGENCY_ADMIN_PASSWORD
+            }), {200, 503}),
+            ("POST /auth/register", 1, lambda: ("POST", "/auth/register", None, {
+                "email": f"load-{uuid.uuid4().hex}@bench.example.com", "password": "load123",
+                "first_name": "Load", "last_name": "User",
+            }), {200, 503}),
+            ("POST /admin/agencies", 1, lambda: ("POST", "/admin/agencies", self.super_admin_headers, {
+                "name": "Load Agency", "email": f"load-{uuid.uuid4().hex[:8]}@bench.example.com",
+                "phone": "555-0100", "address": "1 Load Street",
+            }), {200}),
+            ("GET /admin/agencies", 2, admin_get("/admin/agencies"), {200}),
+            ("GET /admin/analytics", 2, admin_get("/admin/analytics"), {200}),
+            ("GET /admin/analytics/agencies/{id}", 1,
+             lambda: ("GET", f"/admin/analytics/agencies/{tenant()['agency_id']}", self.super_admin_headers, None),
+             {200}),
+            ("GET /admin/analytics/daily", 1, lambda: ("GET", "/admin/analytics/daily", self.super_admin_headers,
+                                                       daily_params()), {200}),
+            # 404 when the backend delivers mail over SMTP
+            ("GET /admin/mail", 1, admin_get("/admin/mail"), {200, 404}),
+            ("POST /agency/cars", 2, create_car, {200}),
+            ("POST /agency/{id}/cars/import", 1, import_cars, {200}),
+            ("GET /agency/{id}/cars", 8, agency_get("cars"), {200}),
+            ("GET /agency/{id}/bookings", 8, agency_get("bookings"), {200}),
+            ("GET /agency/{id}/summary", 6, agency_get("summary"), {200}),
+            ("GET /agency/{id}/pricing", 2, agency_get("pricing"), {200}),
+            ("PUT /agency/{id}/pricing", 1, update_pricing, {200}),
+            # Opens the dashboard stream and closes it after the first frame
+            ("GET /agency/{id}/events", 1, events, {200}),
+            ("GET /agency/{id}/cars/export", 1, agency_get("cars/export", {"format": "csv"}), {200}),
+            ("GET /agency/{id}/bookings/export", 1, agency_get("bookings/export", {
+                "from": (datetime.utcnow() - timedelta(days=30)).isoformat(),
+                "to": datetime.utcnow().isoformat(),
+            }), {200}),
+            ("GET /public/agencies/{id}/cars", 30,
+             lambda: ("GET", f"/public/agencies/{tenant()['agency_id']}/cars", None, None), {200}),
+            ("GET /public/agencies/{id}/availability", 15, availability, {200}),
+            ("GET /public/agencies/{id}/quotes", 8, quotes, {200}),
+            ("GET /public/cars/search", 10, search, {200}),
+            ("POST /public/bookings", 10, public_booking, {200, 409, 503}),
+        ]
+
+    async def worker(self, client, scenarios, weights, deadline):
+        while time.perf_counter() < deadline:
+            name, _, build, accepted = random.choices(scenarios, weights=weights)[0]
+            method, path, headers, payload = build()
+            url = path if path.startswith("http") else f"{BASE_URL}{path}"
+            started = time.perf_counter()
+            try:
+                if method == "STREAM":
+                    async with client.stream("GET", url, headers=headers) as response:
+                        ok = response.status_code in accepted
+                        async for _ in response.aiter_bytes():
+                            break
+                elif method == "GET":
+                    response = await client.get(url, headers=headers, params=payload)
+                    ok = response.status_code in accepted
+                else:
+                    response = await client.request(method, url, headers=headers, json=payload)
+                    ok = response.status_code in accepted
+            except httpx.HTTPError:
+                ok = False
+            self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def drive(self):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            await self.setup(client)
+            scenarios = self.scenarios()
+            weights = [weight for _, weight, _, _ in scenarios]
+            print(f"Driving {self.concurrency} concurrent clients for {self.duration}s "
+                  f"across {len(self.tenants)} agencies")
+            deadline = time.perf_counter() + self.duration
+            await asyncio.gather(*[
+                self.worker(client, scenarios, weights, deadline) for _ in range(self.concurrency)
+            ])
+
+    def results(self):
+        results = {}
+        for name, samples in sorted(self.latencies.items()):
+            results[name] = {
+                "requests": len(samples),
+                "rps": len(samples) / self.duration,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "error_rate": self.errors.get(name, 0) / len(samples),
+            }
+        return results
+
+
+def report(results):
+    print(f"\n{'route':<42}{'reqs':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>9}")
+    for name, r in results.items():
+        print(f"{name:<42}{r['requests']:>8}{r['rps']:>9.1f}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}"
+              f"{r['p99_ms']:>9.1f}{r['error_rate']:>9.1%}")
+    total = sum(r["requests"] for r in results.values())
+    print(f"\nTotal requests: {total}")
+
+
+def compare(results, baseline):
+    """Return a description of every route that regressed against the baseline"""
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            regressions.append(f"{name}: no requests recorded")
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + LATENCY_TOLERANCE):
+            regressions.append(f"{name}: p95 {current['p95_ms']:.1f}ms vs baseline {base['p95_ms']:.1f}ms")
+        if current["rps"] < base["rps"] * (1 - THROUGHPUT_TOLERANCE):
+            regressions.append(f"{name}: {current['rps']:.1f} rps vs baseline {base['rps']:.1f} rps")
+        if current["error_rate"] > base["error_rate"] + ERROR_RATE_TOLERANCE:
+            regressions.append(f"{name}: error rate {current['error_rate']:.1%} vs baseline {base['error_rate']:.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed = commands.add_parser("seed", help="bulk-insert a multi-tenant dataset")
+    seed.add_argument("--agencies", type=int, default=2000)
+    seed.add_argument("--cars-per-agency", type=int, default=100)
+    seed.add_argument("--bookings-per-car", type=int, default=10)
+
+    run = commands.add_parser("run", help="drive load against a running backend")
+    run.add_argument("--duration", type=int, default=60)
+    run.add_argument("--concurrency", type=int, default=200)
+    run.add_argument("--sample-agencies", type=int, default=50)
+    run.add_argument("--baseline", default=BASELINE_FILE)
+    run.add_argument("--update-baseline", action="store_true")
+    run.add_argument("--no-compare", action="store_true", help="report without checking the baseline")
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        Seeder(args.agencies, args.cars_per_agency, args.bookings_per_car).seed()
+        return 0
+    compare_baseline = not (args.update_baseline or args.no_compare)
+    # Fail before driving load rather than after, so the gate cannot pass by default
+    if compare_baseline and not os.path.exists(args.baseline):
+        print(f"❌ No baseline at {args.baseline}, run with --update-baseline to record one or --no-compare to skip the check")
+        return 1
+
+    benchmark = LoadBenchmark(args.duration, args.concurrency, args.sample_agencies)
+    asyncio.run(benchmark.drive())
+    results = benchmark.results()
+    report(results)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not compare_baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f))
+    for regression in regressions:
+        print(f"❌ {regression}")
+    if regressions:
+        return 1
+    print("✅ No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Base URL for the API (backend must be running against a local mongod)
+# Start it with RATE_LIMIT_ENABLED=false: every request here comes from one IP
+BASE_URL = "http://localhost:8001/api"
+
+LOGIN_CONCURRENCY = 64
+STORM_SECONDS = 20
+PROBE_INTERVAL_SECONDS = 0.05
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, samples):
+    print(
+        f"{name:<28} n={len(samples):<6} "
+        f"p50={percentile(samples, 50) * 1000:7.1f}ms "
+        f"p95={percentile(samples, 95) * 1000:7.1f}ms "
+        f"p99={percentile(samples, 99) * 1000:7.1f}ms"
+    )
+
+
+class LoginStormBenchmark:
+    def __init__(self):
+        self.credentials = {"email": "admin@carrentalsaas.com", "password": "admin123"}
+        self.stop = threading.Event()
+        self.login_latencies = []
+        self.login_statuses = {}
+        self.probe_latencies = []
+        self.lock = threading.Lock()
+
+    def probe(self, samples, seconds):
+        """Time an unrelated cheap endpoint at a steady rate"""
+        session = requests.Session()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline and not self.stop.is_set():
+            started = time.perf_counter()
+            session.get(f"{BASE_URL}/health")
+            samples.append(time.perf_counter() - started)
+            time.sleep(PROBE_INTERVAL_SECONDS)
+
+    def login_worker(self):
+        session = requests.Session()
+        while not self.stop.is_set():
+            started = time.perf_counter()
+            response = session.post(f"{BASE_URL}/auth/login", json=self.credentials)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.login_statuses[response.status_code] = self.login_statuses.get(response.status_code, 0) + 1
+                if response.status_code == 200:
+                    self.login_latencies.append(elapsed)
+
+    def run(self):
+        print("\n=== Login Storm Benchmark ===\n")
+        idle_probe = []
+        print("Measuring idle /health latency for 5s")
+        self.probe(idle_probe, 5)
+
+        print(f"Starting {LOGIN_CONCURRENCY} concurrent login clients for {STORM_SECONDS}s")
+        storm_probe = []
+        with ThreadPoolExecutor(max_workers=LOGIN_CONCURRENCY + 1) as executor:
+            for _ in range(LOGIN_CONCURRENCY):
+                executor.submit(self.login_worker)
+            prober = executor.submit(self.probe, storm_probe, STORM_SECONDS)
+            prober.result()
+            self.stop.set()
+
+        print()
+        report("health (idle)", idle_probe)
+        report("health (during storm)", storm_probe)
+        report("login (successful)", self.login_latencies)
+        print(f"Login status codes: {self.login_statuses}")
+        print(f"Login throughput: {len(self.login_latencies) / STORM_SECONDS:.1f}/s")
+
+
+if __name__ == "__main__":
+    LoginStormBenchmark().run()
@@ -0,0 +1,78 @@
+"""Time the batch quote path for a large fleet.
+
+    python pricing_benchmark.py [--cars 10000] [--rounds 50]
+
+Compiles a rate table with seasons, a weekend multiplier and duration tiers,
+then prices every car for a two-week rental the way the quotes endpoint does:
+vectorized totals, response rows and orjson rendering. Runs in-process, no
+server or database needed.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+from fastapi.responses import ORJSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server  # noqa: E402
+
+RULES = server.PricingRules(
+    seasons=[
+        {"name": "Summer", "start": "06-15", "end": "08-31", "multiplier": 1.4},
+        {"name": "Holidays", "start": "12-20", "end": "01-05", "multiplier": 1.8},
+    ],
+    weekend_multiplier=1.15,
+    duration_tiers=[{"min_days": 7, "discount": 0.1}, {"min_days": 28, "discount": 0.25}],
+)
+
+
+def timed(func, rounds):
+    func()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cars", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    today = datetime(now.year, now.month, now.day)
+    origin = today - timedelta(days=server.PRICING_LOOKBACK_DAYS)
+    days = server.PRICING_LOOKBACK_DAYS + server.PRICING_HORIZON_DAYS
+    cars = [
+        {"car_id": str(uuid.uuid4()), "price_per_day": round(random.uniform(25, 250), 2)}
+        for _ in range(args.cars)
+    ]
+    start = today + timedelta(days=30, hours=10)
+    end = start + timedelta(days=14)
+    table = server.RateTable(RULES, origin, days)
+
+    def quote():
+        prices = np.fromiter((car["price_per_day"] for car in cars), dtype=float, count=len(cars))
+        charged_days, totals = table.quote(prices, start, end)
+        quotes = [
+            {"car_id": car["car_id"], "price_per_day": car["price_per_day"], "total_amount": total}
+            for car, total in zip(cars, totals.tolist())
+        ]
+        return ORJSONResponse({"from": start, "to": end, "days": charged_days, "quotes": quotes}).body
+
+    print(f"\n=== Batch quote for {args.cars} cars ({args.rounds} rounds) ===\n")
+    print(f"{'compile rate table':<28}{timed(lambda: server.RateTable(RULES, origin, days), args.rounds):>10.2f} ms")
+    prices = np.fromiter((car["price_per_day"] for car in cars), dtype=float, count=len(cars))
+    print(f"{'vectorized totals':<28}{timed(lambda: table.quote(prices, start, end), args.rounds):>10.2f} ms")
+    print(f"{'full quote response':<28}{timed(quote, args.rounds):>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import os
+import requests
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import SecondaryPreferred
+
+# Read routing needs a replica set. A single local host is enough:
+#
+#   mongod --replSet rs0 --dbpath /tmp/rs0 --port 27017
+#   python read_routing_test.py --init   (initiates rs0 if it is not yet)
+#
+# `python read_routing_test.py --unit` runs only the routing decision check,
+# which needs neither a server nor a replica set.
+#
+# then start the backend against it with
+#
+#   MONGO_URL="mongodb://localhost:27017/car_rental_saas?replicaSet=rs0" \
+#   READ_FROM_SECONDARIES=true RATE_LIMIT_ENABLED=false python backend/server.py
+#
+# With one member, secondaryPreferred reads fall back to the primary, so these
+# tests check the routing plumbing and the read-your-writes pin rather than lag.
+BASE_URL = "http://localhost:8001/api"
+MONGO_HOST = os.getenv("MONGO_HOST", "localhost:27017")
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+
+
+def init_replica_set():
+    client = MongoClient(f"mongodb://{MONGO_HOST}/?directConnection=true")
+    try:
+        client.admin.command("replSetGetStatus")
+        print("Replica set already initiated")
+    except OperationFailure:
+        client.admin.command("replSetInitiate", {"_id": "rs0", "members": [{"_id": 0, "host": MONGO_HOST}]})
+        print("Initiated single-host replica set rs0")
+
+
+class ReadRoutingTest:
+    def __init__(self):
+        self.super_admin_email = "admin@carrentalsaas.com"
+        self.super_admin_password = "admin123"
+        self.agency_id = None
+        self.agency_headers = None
+        # Keeps the read_primary_until cookie between requests like a browser
+        self.session = requests.Session()
+
+    def setup(self):
+        """Create an agency and an agency admin to own the cars under test"""
+        response = self.session.post(
+            f"{BASE_URL}/auth/login",
+            json={"email": self.super_admin_email, "password": self.super_admin_password}
+        )
+        assert response.status_code == 200, "Super admin login failed"
+        admin_headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+        suffix = uuid.uuid4().hex[:8]
+        response = self.session.post(
+            f"{BASE_URL}/admin/agencies",
+            headers=admin_headers,
+            json={
+                "name": f"Routing Agency {suffix}",
+                "email": f"routing-{suffix}@agency.com",
+                "phone": "123-456-7890",
+                "address": "1 Replica Street",
+            }
+        )
+        assert response.status_code == 200, "Agency creation failed"
+        self.agency_id = response.json()["agency"]["agency_id"]
+
+        response = self.session.post(
+            f"{BASE_URL}/auth/register",
+            json={
+                "email": f"routing-admin-{suffix}@agency.com",
+                "password": "routing123",
+                "first_name": "Routing",
+                "last_name": "Admin",
+                "role": "agency_admin",
+                "agency_id": self.agency_id,
+            }
+        )
+        assert response.status_code == 200, "Agency admin registration failed"
+        self.agency_headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+    def create_car(self, session):
+        return session.post(
+            f"{BASE_URL}/agency/cars",
+            headers=self.agency_headers,
+            json={
+                "title": "Routing Car",
+                "model": "Model 3",
+                "brand": "Brand",
+                "year": 2023,
+                "plate_number": f"RR-{uuid.uuid4().hex[:6]}",
+                "color": "Grey",
+                "price_per_day": 55.0,
+                "agency_id": self.agency_id,
+            }
+        )
+
+    def test_00_routing_decision(self):
+        """read_db and target_read_db follow the pin cookie (no server or replica set needed)"""
+        print("\n0. Checking which database each request is routed to")
+        # Routing is decided at import time; Motor connects lazily, so no Mongo is contacted
+        os.environ["READ_FROM_SECONDARIES"] = "true"
+        sys.path.insert(0, BACKEND_DIR)
+        import server
+        from starlette.requests import Request
+
+        def request(cookie=None):
+            headers = [(b"cookie", f"{server.READ_PRIMARY_COOKIE}={cookie}".encode())] if cookie else []
+            return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+        target = server.tenant_targets[server.DEFAULT_TARGET]
+        assert server.secondary_db is not server.db, "Secondary routing is not enabled"
+        assert target.secondary_db is not target.db, "Target secondary routing is not enabled"
+        cases = [
+            ("pinned", request(str(int(time.time()) + 60)), True),
+            ("expired pin", request(str(int(time.time()) - 1)), False),
+            ("no cookie", request(), False),
+            ("malformed cookie", request("soon"), False),
+        ]
+        for name, req, pinned in cases:
+            assert (server.read_db(req) is server.db) == pinned, f"read_db misrouted a request with {name}"
+            assert (server.read_db(req) is server.secondary_db) != pinned, f"read_db misrouted a request with {name}"
+            expected = target.db if pinned else target.secondary_db
+            assert server.target_read_db(target, req) is expected, f"target_read_db misrouted a request with {name}"
+        print("✅ Pinned requests read the primary, all others the secondaries")
+
+    def test_01_secondary_reads_accepted(self):
+        """The replica set serves secondaryPreferred reads with the configured max staleness"""
+        print("\n1. Reading with secondaryPreferred and maxStalenessSeconds=90")
+        client = MongoClient(f"mongodb://{MONGO_HOST}/?replicaSet=rs0")
+        database = client.get_database("car_rental_saas", read_preference=SecondaryPreferred(max_staleness=90))
+        database.cars.find_one()
+        print("✅ Replica set accepted the read preference")
+
+    def test_02_car_read_your_writes(self):
+        """A new car is listed straight away for the client that created it"""
+        print("\n2. Creating a car and listing the fleet immediately")
+        response = self.create_car(self.session)
+        assert response.status_code == 200, f"Car creation failed: {response.text}"
+        assert "read_primary_until" in response.cookies, "Write did not pin reads to the primary"
+        car_id = response.json()["car"]["car_id"]
+
+        response = self.session.get(
+            f"{BASE_URL}/agency/{self.agency_id}/cars",
+            headers=self.agency_headers,
+            params={"car_id": car_id}
+        )
+        assert response.status_code == 200, "Fleet listing failed"
+        assert [car["car_id"] for car in response.json()["cars"]] == [car_id], "New car missing from listing"
+        print("✅ New car visible to its creator")
+        return car_id
+
+    def test_03_booking_read_your_writes(self, car_id):
+        """A booked car drops out of availability for the client that booked it"""
+        print("\n3. Booking a car and checking availability immediately")
+        booking_session = requests.Session()
+        pickup = datetime.utcnow().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=20)
+        return_date = pickup + timedelta(days=2)
+        response = booking_session.post(
+            f"{BASE_URL}/public/bookings",
+            json={
+                "car_id": car_id,
+                "client_email": "routing@example.com",
+                "client_name": "Routing Client",
+                "client_phone": "555-0100",
+                "pickup_date": pickup.isoformat(),
+                "return_date": return_date.isoformat(),
+                "pickup_location": "Airport",
+                "return_location": "Airport",
+            }
+        )
+        assert response.status_code == 200, f"Booking failed: {response.text}"
+        assert "read_primary_until" in response.cookies, "Booking did not pin reads to the primary"
+
+        response = booking_session.get(
+            f"{BASE_URL}/public/agencies/{self.agency_id}/availability",
+            params={"from": pickup.isoformat(), "to": return_date.isoformat()}
+        )
+        assert response.status_code == 200, "Availability lookup failed"
+        assert car_id not in [car["car_id"] for car in response.json()["cars"]], "Booked car still available"
+        print("✅ Booking visible to its creator")
+
+    def test_04_unpinned_reads(self):
+        """Clients without a recent write are served through the secondary route"""
+        print("\n4. Listing the fleet from a session that never wrote")
+        response = requests.get(f"{BASE_URL}/agency/{self.agency_id}/cars", headers=self.agency_headers)
+        assert response.status_code == 200, "Unpinned fleet listing failed"
+        print(f"✅ Unpinned read returned {len(response.json()['cars'])} cars")
+
+    def run_all_tests(self):
+        print("\n=== Starting Read Routing Tests ===\n")
+        self.test_00_routing_decision()
+        self.setup()
+        self.test_01_secondary_reads_accepted()
+        car_id = self.test_02_car_read_your_writes()
+        self.test_03_booking_read_your_writes(car_id)
+        self.test_04_unpinned_reads()
+        print("\n=== All Read Routing Tests Completed ===\n")
+
+
+if __name__ == "__main__":
+    if "--init" in sys.argv:
+        init_replica_set()
+    elif "--unit" in sys.argv:
+        ReadRoutingTest().test_00_routing_decision()
+    else:
+        ReadRoutingTest().run_all_tests()
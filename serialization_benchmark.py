@@ -0,0 +1,100 @@
+"""Compare response serialization cost for 1k-record list payloads.
+
+    python serialization_benchmark.py [--records 1000] [--rounds 50]
+
+"before" is what list endpoints did with raw Mongo dicts: jsonable_encoder
+followed by the stdlib JSONResponse. "after" is the typed path: validate into
+the response model, serialize through pydantic-core and render with orjson.
+Runs in-process, no server or database needed.
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server  # noqa: E402
+
+
+def make_bookings(count):
+    now = datetime.utcnow()
+    return [{
+        "booking_id": str(uuid.uuid4()),
+        "car_id": str(uuid.uuid4()),
+        "agency_id": str(uuid.uuid4()),
+        "client_email": f"client{i}@example.com",
+        "client_name": f"Client {i}",
+        "client_phone": "555-0100",
+        "pickup_date": now + timedelta(days=i % 30),
+        "return_date": now + timedelta(days=i % 30 + 3),
+        "pickup_location": "Airport",
+        "return_location": "Downtown",
+        "message": "Please have a child seat ready",
+        "status": "pending",
+        "total_amount": 150.0,
+        "created_at": now,
+    } for i in range(count)]
+
+
+def make_cars(count):
+    now = datetime.utcnow()
+    return [{
+        "car_id": str(uuid.uuid4()),
+        "title": f"Car {i}",
+        "model": "Golf",
+        "brand": "Volkswagen",
+        "year": 2022,
+        "plate_number": f"P-{i:05d}",
+        "color": "Blue",
+        "price_per_day": 45.0,
+        "features": ["GPS", "Bluetooth", "Air Conditioning"],
+        "agency_id": str(uuid.uuid4()),
+        "status": "available",
+        "created_at": now,
+    } for i in range(count)]
+
+
+def before(payload):
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def after(model):
+    def render(payload):
+        return ORJSONResponse(model.model_validate(payload).model_dump(mode="json")).body
+    return render
+
+
+def timed(render, payload, rounds):
+    render(payload)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        render(payload)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    cases = [
+        ("bookings", {"bookings": make_bookings(args.records), "next_cursor": None}, server.BookingList),
+        ("cars", {"cars": make_cars(args.records), "next_cursor": None}, server.CarList),
+    ]
+    print(f"\n=== Serialization cost per {args.records}-record list ({args.rounds} rounds) ===\n")
+    print(f"{'payload':<12}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name, payload, model in cases:
+        before_ms = timed(before, payload, args.rounds)
+        after_ms = timed(after(model), payload, args.rounds)
+        print(f"{name:<12}{before_ms:>12.2f}{after_ms:>12.2f}{before_ms / after_ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()